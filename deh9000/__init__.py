@@ -1,5 +1,7 @@
 from __future__ import absolute_import
 
+__version__ = "0.1"
+
 from deh9000.actions import *
 from deh9000.ammo import *
 from deh9000.misc import *
@@ -8,7 +10,7 @@ from deh9000.sprites import *
 from deh9000.states import *
 from deh9000.weapons import *
 
-from deh9000.file import DehackedFile
+from deh9000.file import DehackedFile, load_many
 
 # For convenience, we create one global instance of a dehacked file.
 # This allows users to "from deh9000 import *" and refer to all the
@@ -22,12 +24,25 @@ sprnames = dehfile.sprnames
 weaponinfo = dehfile.weaponinfo
 
 def sql():
-	"""Open an SQLite console with DEH9000 virtual tables."""
-	from deh9000.sqlite import MakeTables, Shell
+	"""Open an SQLite console with DEH9000 virtual tables.
+
+	The files named on the command line are loaded into one
+	DehackedFile. If the first argument is --workspace, each file is
+	instead loaded as a separate patch, and the tables of all of them
+	can be queried together (see sqlite.MakeWorkspace()).
+	"""
+	from deh9000.sqlite import MakeTables, MakeWorkspace, Shell
 	import sys
-	f = DehackedFile()
-	for filename in sys.argv[1:]:
-		f.load(filename)
-	shell = Shell(f, db=MakeTables(f))
+	args = sys.argv[1:]
+	if args[:1] == ["--workspace"]:
+		# There is no single file for .dehload and .dehsave to use.
+		f = None
+		db = MakeWorkspace(args[1:])
+	else:
+		f = DehackedFile()
+		for filename in args:
+			f.load(filename)
+		db = MakeTables(f)
+	shell = Shell(f, db=db)
 	shell.cmdloop()
 
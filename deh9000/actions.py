@@ -7,6 +7,14 @@ particular frame.
   <https://doomwiki.org/wiki/DeHackEd#Code_pointers>
 """
 
+from __future__ import absolute_import
+
+from deh9000 import c
+
+# All Action objects are registered here; the states table stores the
+# registry index of each state's action rather than the object itself.
+registry = c.Registry()
+
 class Action():
 	"""Represents a callback function used to perform a particular action.
 
@@ -14,6 +22,7 @@ class Action():
 	"""
 	def __init__(self, name):
 		self.name = name
+		registry.index(self)
 
 	def __repr__(self):
 		return self.name
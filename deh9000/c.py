@@ -2,42 +2,411 @@
 
 from __future__ import print_function
 
+import collections.abc
 import copy
-import re
+import operator
 import unittest
+from array import array
 
-# Regexp that matches field assignment lines in dehacked files.
-FIELD_ASSIGNMENT_RE = re.compile(r"\s*(?P<deh_name>\w[\w \#\.\/]+[\w\#])*"
-                                 r"\s*=\s*"
-                                 r"\s*(?P<value>\-?\d+)"
-                                 r"\s*$", re.I)
+from deh9000 import deh_parser
+
+class EnumValue(int):
+	"""Integer value of an Enum that represents itself symbolically.
+
+	These behave as plain ints in every way (including str() and
+	formatting, so they can be written into a dehacked file), except
+	that repr() gives the name of the value, like an IntEnum.
+	"""
+	def __new__(cls, enum_type, value):
+		result = super(EnumValue, cls).__new__(cls, value)
+		result.enum_type = enum_type
+		return result
+
+	@property
+	def name(self):
+		return self.enum_type[self]
+
+	def __repr__(self):
+		if 0 <= self < len(self.enum_type):
+			return self.enum_type[self]
+		return int.__repr__(self)
+
+	__str__ = int.__repr__
 
 class Enum(list):
-	"""Wrapper around list that represents a C enum type."""
+	"""Wrapper around list that represents a C enum type.
+
+	The list holds the names of the values in order. A dictionary
+	mapping names back to values is built along with it, so index()
+	and the 'in' operator don't need to scan the list; for this
+	reason an Enum should not be modified after it is created.
+	"""
 	def __init__(self, values):
 		super(Enum, self).__init__(values)
+		self._values = {}
+		for index, name in enumerate(self):
+			self._values.setdefault(name, index)
+
+	def __contains__(self, name):
+		try:
+			return name in self._values
+		except TypeError:
+			return False
+
+	def index(self, name):
+		"""Get the value of the enum constant with the given name."""
+		try:
+			return self._values[name]
+		except (KeyError, TypeError):
+			raise ValueError("%r is not in %s" % (
+				name, type(self).__name__))
+
+	def value(self, value):
+		"""Get an EnumValue for the given name or integer value."""
+		if not isinstance(value, int):
+			value = self.index(value)
+		return EnumValue(self, value)
 
 	def create_globals(self, globals):
 		"""Create constants in the given global dict."""
 		for index, name in enumerate(self):
 			globals[name] = index
 
-class EnumSet(set):
-	"""Wrapper around set for representing a set of enum values.
+def _enum_bits(values):
+	"""Get the bitset (an int) with the bits in 'values' set."""
+	if isinstance(values, EnumSet):
+		return values.bits
+	bits = 0
+	for value in values:
+		bits |= 1 << value
+	return bits
+
+class EnumSet(collections.abc.MutableSet):
+	"""Set for representing a set of enum values.
 
 	This is in practical terms identical to a set of integers, but those
 	values are assumed to be indexes into an Enum and the __repr__ method
 	will represent the values in their symbolic form.
+
+	The set is stored as a bitset in a single Python int ('bits'), where
+	bit n is set if value n is in the set. Set operations between
+	EnumSets (union, difference etc.) are single integer operations,
+	and copying a set is O(1), since ints are immutable.
 	"""
-	def __init__(self, enum_type, values):
-		super(EnumSet, self).__init__(values)
+	__slots__ = ("enum_type", "bits")
+
+	def __init__(self, enum_type, values=()):
 		self.enum_type = enum_type
+		self.bits = _enum_bits(values)
+
+	@classmethod
+	def from_bits(cls, enum_type, bits):
+		"""Create an EnumSet from a bitset."""
+		result = cls.__new__(cls)
+		result.enum_type = enum_type
+		result.bits = bits
+		return result
+
+	def _from_iterable(self, values):
+		# Used by the collections.abc.Set mixin methods.
+		return EnumSet(self.enum_type, values)
+
+	def __contains__(self, value):
+		return (isinstance(value, int) and value >= 0
+		        and (self.bits >> value) & 1 == 1)
+
+	def __iter__(self):
+		bits = self.bits
+		while bits:
+			low = bits & -bits
+			yield low.bit_length() - 1
+			bits ^= low
+
+	def __len__(self):
+		return self.bits.bit_count()
 
 	def __repr__(self):
 		return "{%s}" % (
 			", ".join(self.enum_type[i] for i in self)
 		)
 
+	def __copy__(self):
+		return EnumSet.from_bits(self.enum_type, self.bits)
+
+	copy = __copy__
+
+	def add(self, value):
+		self.bits |= 1 << value
+
+	def discard(self, value):
+		if value in self:
+			self.bits ^= 1 << value
+
+	def pop(self):
+		"""Remove and return the lowest value in the set."""
+		if not self.bits:
+			raise KeyError("pop from an empty set")
+		low = self.bits & -self.bits
+		self.bits ^= low
+		return low.bit_length() - 1
+
+	def clear(self):
+		self.bits = 0
+
+	def __or__(self, other):
+		return EnumSet.from_bits(
+			self.enum_type, self.bits | _enum_bits(other))
+
+	def __and__(self, other):
+		return EnumSet.from_bits(
+			self.enum_type, self.bits & _enum_bits(other))
+
+	def __sub__(self, other):
+		return EnumSet.from_bits(
+			self.enum_type, self.bits & ~_enum_bits(other))
+
+	def __xor__(self, other):
+		return EnumSet.from_bits(
+			self.enum_type, self.bits ^ _enum_bits(other))
+
+	__ror__, __rand__, __rxor__ = __or__, __and__, __xor__
+
+	def __ior__(self, other):
+		self.bits |= _enum_bits(other)
+		return self
+
+	def __iand__(self, other):
+		self.bits &= _enum_bits(other)
+		return self
+
+	def __isub__(self, other):
+		self.bits &= ~_enum_bits(other)
+		return self
+
+	def __ixor__(self, other):
+		self.bits ^= _enum_bits(other)
+		return self
+
+	def __le__(self, other):
+		if isinstance(other, EnumSet):
+			return self.bits & ~other.bits == 0
+		return super(EnumSet, self).__le__(other)
+
+	def __eq__(self, other):
+		if isinstance(other, EnumSet):
+			return self.bits == other.bits
+		return super(EnumSet, self).__eq__(other)
+
+	__hash__ = None
+
+	# Named methods, as found on set:
+	def union(self, *others):
+		result = self.copy()
+		for other in others:
+			result |= other
+		return result
+
+	def intersection(self, *others):
+		result = self.copy()
+		for other in others:
+			result &= other
+		return result
+
+	def difference(self, *others):
+		result = self.copy()
+		for other in others:
+			result -= other
+		return result
+
+	def symmetric_difference(self, other):
+		return self ^ other
+
+	def update(self, *others):
+		for other in others:
+			self |= other
+
+	def difference_update(self, *others):
+		for other in others:
+			self -= other
+
+	def intersection_update(self, *others):
+		for other in others:
+			self &= other
+
+	def issubset(self, other):
+		return self <= EnumSet(self.enum_type, other)
+
+	def issuperset(self, other):
+		return EnumSet(self.enum_type, other) <= self
+
+# Type code of the arrays used to store struct fields. Values are C ints,
+# but some fields (eg. mobjinfo_t.flags) use the top bit of an unsigned
+# 32-bit value, so the arrays must be wider than array('i').
+COLUMN_TYPECODE = "q"
+
+def field_value(value):
+	"""Convert a value to the integer stored for it in a column.
+
+	Floats with an integral value are accepted (eg. 'tics * 1.5' in an
+	SQL query, or a computed speed), as fields used to hold whatever
+	was assigned to them. Other values that aren't integers raise
+	TypeError.
+	"""
+	if isinstance(value, float) and value.is_integer():
+		return int(value)
+	try:
+		return operator.index(value)
+	except TypeError:
+		raise TypeError("struct fields hold integers, not %r" % (
+			value,))
+
+class Registry(object):
+	"""Table that maps arbitrary values to small integers.
+
+	Struct fields are stored as integers. Fields which hold other kinds
+	of value (eg. action pointers) are declared with a Registry, and the
+	index of the value in the registry is stored instead. Index 0 is
+	always None, so a zeroed field reads back as None.
+	"""
+	def __init__(self):
+		self._values = [None]
+		self._indexes = {None: 0}
+
+	def index(self, value):
+		"""Get the index for the given value, adding it if needed."""
+		try:
+			return self._indexes[value]
+		except KeyError:
+			result = len(self._values)
+			self._values.append(value)
+			self._indexes[value] = result
+			return result
+
+	def __getitem__(self, index):
+		return self._values[index]
+
+	def __len__(self):
+		return len(self._values)
+
+class _Storage(object):
+	"""Column-oriented storage for the rows of one or more structs.
+
+	There is one array per StructField, keyed by the field's order
+	number, so a table of thousands of rows costs a handful of flat
+	buffers rather than thousands of objects. Object names are sparse
+	and kept in a dict keyed by row.
+
+	The storage also keeps a change journal, 'dirty', which maps each
+	row that has been written to a bitmask of the fields written (see
+	StructField.bit). Every write is recorded, even one that restores
+	the original value, so rows not in the journal are known to be
+	unchanged and diffs only need to look at the rows that are.
+
+	Copies are copy-on-write: a copy shares the column arrays (and the
+	object names) of the storage it was copied from, and a column is
+	only duplicated when one side first writes to it. The 'owned' set
+	lists the columns which may be written in place.
+
+	Indexes derived from the contents of a storage can register a
+	watcher callback in 'watchers'; it is called as watcher(index,
+	bits) after every write, just like the journal is updated. A mark
+	of every row (mark_all()) is reported with an index of None.
+	Watchers are not carried over to copies.
+	"""
+	def __init__(self, struct_type, length):
+		self.length = length
+		self.columns = {
+			prop.order: array(COLUMN_TYPECODE, [0]) * length
+			for prop in struct_type._struct_fields
+		}
+		self.owned = set(self.columns)
+		self.object_names = {}
+		self.names_owned = True
+		self.all_bits = (1 << len(struct_type._struct_fields)) - 1
+		self.dirty = {}
+		self.watchers = []
+
+	def copy(self):
+		result = _Storage.__new__(_Storage)
+		result.length = self.length
+		# Both sides now share everything, so neither owns it:
+		result.columns = dict(self.columns)
+		result.owned = set()
+		self.owned = set()
+		result.object_names = self.object_names
+		result.names_owned = self.names_owned = False
+		result.all_bits = self.all_bits
+		result.dirty = dict(self.dirty)
+		result.watchers = []
+		return result
+
+	def column(self, n):
+		"""Get a column for writing, duplicating it if it is shared."""
+		if n not in self.owned:
+			self.columns[n] = self.columns[n][:]
+			self.owned.add(n)
+		return self.columns[n]
+
+	def own_columns(self):
+		"""Get all the columns for writing (see column())."""
+		for n in self.columns:
+			self.column(n)
+		return self.columns
+
+	def names(self):
+		"""Get the object names dict for writing."""
+		if not self.names_owned:
+			self.object_names = dict(self.object_names)
+			self.names_owned = True
+		return self.object_names
+
+	def mark(self, index, bits):
+		"""Record in the journal that fields of a row were written."""
+		self.dirty[index] = self.dirty.get(index, 0) | bits
+		for watcher in self.watchers:
+			watcher(index, bits)
+
+	def mark_all(self):
+		"""Record in the journal that every row was written."""
+		self.dirty = dict.fromkeys(range(self.length), self.all_bits)
+		for watcher in self.watchers:
+			watcher(None, self.all_bits)
+
+	def delta(self, struct_type, rows):
+		"""Get a compact record of the journaled fields of some rows.
+
+		The result is a tuple with a (row, object_name, values) entry
+		for each row, where values is a tuple of (field position,
+		value) pairs for the fields that were written. Only ints,
+		strings, None and tuples are used, so deltas are cheap to
+		pickle or marshal. Registry fields hold registry indexes, so
+		a delta can only be applied by the same version of deh9000.
+		"""
+		fields = struct_type._struct_fields
+		columns, names = self.columns, self.object_names
+		result = []
+		for row in rows:
+			bits = self.dirty[row]
+			values = tuple(
+				(i, columns[prop.order][row])
+				for i, prop in enumerate(fields)
+				if bits & prop.bit)
+			result.append((row, names.get(row), values))
+		return tuple(result)
+
+	def apply_delta(self, struct_type, delta):
+		"""Write the values recorded by delta() back into rows."""
+		fields = struct_type._struct_fields
+		for row, name, values in delta:
+			bits = 0
+			for i, value in values:
+				prop = fields[i]
+				self.column(prop.order)[row] = value
+				bits |= prop.bit
+			self.mark(row, bits)
+			if name is not None:
+				self.names()[row] = name
+
 class StructField(property):
 	"""Helper wrapper around property() for declaring C struct fields.
 
@@ -47,28 +416,211 @@ class StructField(property):
 		class MyStruct(c.Struct):
 			DEHACKED_NAME = "My Struct Type"
 			field1 = c.StructField("First Field")
-			action = c.StructField(None)
+			action = c.StructField(None, registry=actions.registry)
 
 	The dehacked name for the field must be provided (which usually differs
 	to the property name used in the Doom source). Providing a value of
 	"None" indicates that although a value can be stored for that field,
 	no output should be ever produced to represent it. This is commonly
 	used when the field represents a pointer type.
+
+	Values are stored as integers (see field_value()); fields which hold
+	other values must provide a Registry that maps them to integers.
+
+	Every write is recorded in the storage's change journal, using the
+	field's 'bit' (assigned by StructMeta from the field's position in
+	the struct).
 	"""
 	instance_order = 0
-	def __init__(prop, deh_name):
+	def __init__(prop, deh_name, registry=None):
 		field_number = StructField.instance_order
 		StructField.instance_order += 1
 		prop.order = field_number
 		prop.deh_name = deh_name
-
-		def getter(self):
-			return self._fields[field_number]
-		def setter(self, value):
-			self._fields[field_number] = value
+		prop.registry = registry
+		prop.bit = 0
+
+		if registry is None:
+			def getter(self):
+				return self._store.columns[field_number][
+					self._index]
+			def setter(self, value):
+				store, index = self._store, self._index
+				if field_number in store.owned:
+					col = store.columns[field_number]
+				else:
+					col = store.column(field_number)
+				try:
+					col[index] = value
+				except TypeError:
+					col[index] = field_value(value)
+				dirty = store.dirty
+				dirty[index] = dirty.get(index, 0) | prop.bit
+				if store.watchers:
+					store.mark(index, prop.bit)
+		else:
+			def getter(self):
+				return registry[self._store.columns[
+					field_number][self._index]]
+			def setter(self, value):
+				store, index = self._store, self._index
+				if field_number in store.owned:
+					col = store.columns[field_number]
+				else:
+					col = store.column(field_number)
+				col[index] = registry.index(value)
+				dirty = store.dirty
+				dirty[index] = dirty.get(index, 0) | prop.bit
+				if store.watchers:
+					store.mark(index, prop.bit)
 		super(StructField, prop).__init__(getter, setter)
 
-class Struct(object):
+# Templates for the per-type methods generated by StructMeta. Each struct
+# type gets its own copy_from(), diff(), __eq__() and dehacked_output()
+# with the field accesses unrolled, rather than looping over fields and
+# going through getattr().
+_COPY_FROM_TEMPLATE = """
+def copy_from(self, other):
+	if type(self) is not type(other):
+		raise AssertionError(
+			"Structs must be of the same type, %%r != %%r" %% (
+				type(self), type(other)))
+	self.object_name = other.object_name
+	dst, i = self._store.own_columns(), self._index
+	src, j = other._store.columns, other._index
+%(copies)s
+	self._store.mark(i, all_bits)
+"""
+
+_DIFF_TEMPLATE = """
+def diff(self, other=None):
+	if other is None:
+		other = self.original
+	if type(other) is not type(self):
+		return generic_diff(self, other)
+	a, i = self._store.columns, self._index
+	b, j = other._store.columns, other._index
+	result = []
+%(compares)s
+	return result
+"""
+
+_EQ_TEMPLATE = """
+def __eq__(self, other):
+	if type(other) is not type(self):
+		return NotImplemented
+	a, i = self._store.columns, self._index
+	b, j = other._store.columns, other._index
+	return (True%(compares)s)
+"""
+
+_DEHACKED_OUTPUT_TEMPLATE = """
+def dehacked_output(self, fields=None, array_index=0):
+	if fields is None:
+		a, i = self._store.columns, self._index
+		results = [%(outputs)s]
+	else:
+		results = [
+			"%%s = %%s" %% (deh_names[f], getattr(self, f))
+			for f in fields if deh_names[f]
+		]
+	if not results:
+		return ""
+	return "\\n".join([self.dehacked_header(array_index)] + results)
+"""
+
+class StructMeta(type):
+	"""Metaclass for Struct that compiles each struct type's layout.
+
+	The layout of a struct type is computed once, when the class is
+	created, instead of being rediscovered through dir() every time it
+	is needed:
+
+	  _struct_fields: tuple of StructField properties, in field order.
+	  _field_names:   tuple of the C field names, in field order.
+	  _field_index:   dict mapping C field name to position in order.
+	  _deh_names:     dict mapping C field name to dehacked name.
+	  _deh_fields:    dict mapping dehacked name to C field name.
+
+	Specialized versions of copy_from(), diff(), __eq__() and
+	dehacked_output() are also generated for each type, unless the class
+	body defines its own.
+	"""
+	def __init__(cls, name, bases, namespace):
+		super(StructMeta, cls).__init__(name, bases, namespace)
+		props = []
+		for f in dir(cls):
+			value = getattr(cls, f)
+			if isinstance(value, StructField):
+				props.append((f, value))
+		props.sort(key=lambda x: x[1].order)
+		cls._struct_fields = tuple(prop for _, prop in props)
+		cls._field_names = tuple(f for f, _ in props)
+		cls._field_index = {
+			f: i for i, f in enumerate(cls._field_names)}
+		cls._deh_names = {f: prop.deh_name for f, prop in props}
+		cls._deh_fields = {
+			prop.deh_name: f for f, prop in props
+			if prop.deh_name is not None}
+		for i, prop in enumerate(cls._struct_fields):
+			prop.bit = 1 << i
+		# Struct itself keeps the generic implementations.
+		if bases != (object,):
+			cls._compile_methods(namespace)
+
+	def _compile_methods(cls, namespace):
+		fields = [(f, prop.order)
+		          for f, prop in zip(cls._field_names,
+		                             cls._struct_fields)]
+		copies = "".join(
+			"\tdst[%d][i] = src[%d][j]\n" % (n, n)
+			for _, n in fields)
+		compares = "".join(
+			"\tif a[%d][i] != b[%d][j]: result.append(%r)\n" % (
+				n, n, f)
+			for f, n in fields)
+		eq_compares = "".join(
+			" and a[%d][i] == b[%d][j]" % (n, n)
+			for _, n in fields)
+		outputs = []
+		env = {
+			"all_bits": (1 << len(fields)) - 1,
+			"deh_names": cls._deh_names,
+			"generic_diff": Struct.diff,
+		}
+		for prop in cls._struct_fields:
+			if prop.deh_name is None:
+				continue
+			if prop.registry is None:
+				value = "a[%d][i]" % prop.order
+			else:
+				reg = "registry%d" % prop.order
+				env[reg] = prop.registry
+				value = "%s[a[%d][i]]" % (reg, prop.order)
+			outputs.append("%r %% (%s,)" % (
+				prop.deh_name.replace("%", "%%") + " = %s",
+				value))
+		source = "".join([
+			_COPY_FROM_TEMPLATE % {"copies": copies or "\tpass\n"},
+			_DIFF_TEMPLATE % {"compares": compares},
+			_EQ_TEMPLATE % {"compares": eq_compares},
+			_DEHACKED_OUTPUT_TEMPLATE % {
+				"outputs": ", ".join(outputs)},
+		])
+		code = compile(source, "<struct %s>" % cls.__name__, "exec")
+		exec(code, env)
+		for name in ("copy_from", "diff", "__eq__", "dehacked_output"):
+			if name in namespace:
+				continue
+			func = env[name]
+			func.__doc__ = getattr(Struct, name).__doc__
+			func.__qualname__ = "%s.%s" % (cls.__qualname__, name)
+			setattr(cls, name, func)
+		# Structs are mutable and compare by value:
+		if "__hash__" not in namespace:
+			cls.__hash__ = None
+
+class Struct(object, metaclass=StructMeta):
 	"""Base class for a type that emulate a C struct.
 
 	Fields are declared using the StructField type; the order in which
@@ -78,6 +630,11 @@ class Struct(object):
 	also remembered, so that they can be diffed against later when
 	changes are made.
 
+	Field values live in column storage (see StructArray). A struct
+	that is instantiated directly owns a single-row storage of its own,
+	while the elements of a StructArray are lightweight views onto a
+	row of the array's storage.
+
 	Example:
 		class Coordinate(c.Struct):
 			DEHACKED_NAME = "Co-ordinate"
@@ -94,62 +651,113 @@ class Struct(object):
 	"""
 
 	def __init__(self, *args, **kwargs):
-		self.object_name = None
-		# Start with all fields initialized to zero, then override.
-		self._fields = {}
-		self.clear()
-		self.set_values(*args, **kwargs)
+		# All fields start initialized to zero; then override.
+		self._store = _Storage(type(self), 1)
+		self._index = 0
+		self._array = None
 		# The 'original' pointer points back to the original struct
 		# that this instance was copy.copy()d from. By default, the
 		# struct points to itself as the original.
-		self.original = self
+		self._original = None
+		self.set_values(*args, **kwargs)
+		self._store.dirty.clear()
+
+	@classmethod
+	def _view(cls, array, index):
+		"""Create a struct that is a view onto a row of an array."""
+		result = cls.__new__(cls)
+		result._store = array._store
+		result._index = index
+		result._array = array
+		return result
+
+	@property
+	def original(self):
+		if self._array is not None:
+			return self._array.original[self._index]
+		if self._original is None:
+			return self
+		return self._original
+
+	@original.setter
+	def original(self, value):
+		if self._array is not None:
+			raise AttributeError("can't set original of array "
+			                     "element")
+		self._original = value
+
+	@property
+	def object_name(self):
+		return self._store.object_names.get(self._index)
+
+	@object_name.setter
+	def object_name(self, value):
+		names = self._store.object_names
+		if names.get(self._index) == value:
+			return
+		names = self._store.names()
+		if value is None:
+			del names[self._index]
+		else:
+			names[self._index] = value
 
 	def clear(self):
 		"""Set all field values to zero."""
-		for f in self.field_names():
-			setattr(self, f, 0)
+		for col in self._store.own_columns().values():
+			col[self._index] = 0
+		self._store.mark(self._index, self._store.all_bits)
+
+	def reset_to_original(self):
+		"""Restore all fields to their original values.
+
+		The struct is also removed from the change journal.
+		"""
+		self.copy_from(self.original)
+		self._store.dirty.pop(self._index, None)
+
+	def delta(self):
+		"""Get a compact record of the fields written to the struct.
+
+		See _Storage.delta() for the format. The delta can be applied
+		to another struct of the same type with apply_delta().
+		"""
+		rows = []
+		if self._index in self._store.dirty:
+			rows.append(self._index)
+		return self._store.delta(type(self), rows)
+
+	def apply_delta(self, delta):
+		"""Apply a delta returned by delta() to this struct."""
+		self._store.apply_delta(type(self), tuple(
+			(self._index, name, values)
+			for _, name, values in delta))
 
 	@classmethod
-	def header_regexp(cls):
-		return re.compile(
-			r"%s\s+(?P<index>\d+)(\s*\((?P<name>.*)\))?\s*$" % (
-				cls.DEHACKED_NAME))
+	def header_keyword(cls):
+		return cls.DEHACKED_NAME.split()[0]
 
 	@classmethod
 	def field_names(cls):
-		props = []
-		for f in dir(cls):
-			value = getattr(cls, f)
-			if isinstance(value, StructField):
-				props.append((f, value))
-		props = sorted(props, key=lambda x: x[1].order)
-		return [name for name, _ in props]
+		return list(cls._field_names)
 
-	def _apply_assignment(self, stream, deh_name, value):
-		try:
-			field = self.deh_field_name(deh_name)
-			setattr(self, field, int(value))
-		except KeyError:
-			stream.exception("parse error: unknown field %r" % (
-				deh_name))
-
-	def parse_section(self, stream, index="0", name=None):
-		"""Parse a section, reading assignments from the given stream.
+	def apply_event(self, event):
+		"""Apply a parsed event (see deh_parser) to this struct.
 
-		It is assumed that each line will be an assignment that
-		conforms to FIELD_ASSIGNMENT_RE. The function will return once
-		an empty line is reached.
+		A SectionStart event just sets the object name, and returns
+		the struct itself, to which the FieldAssign events for the
+		section's fields are then applied.
 		"""
-		if name:
-			self.object_name = name
-		while True:
-			line = stream.readline()
-			if line.strip() == "":
-				break
-			m = FIELD_ASSIGNMENT_RE.match(line)
-			if not m:
-				stream.exception("parse error: %r" % line)
-			self._apply_assignment(stream, **m.groupdict())
+		if isinstance(event, deh_parser.SectionStart):
+			if event.name:
+				self.object_name = event.name
+			return self
+		if not isinstance(event, deh_parser.FieldAssign):
+			raise ValueError("syntax not recognized")
+		field = self._deh_fields.get(event.deh_name)
+		if field is None:
+			raise ValueError("parse error: unknown field %r" % (
+				event.deh_name))
+		setattr(self, field, event.value)
 
 	def copy_from(self, other):
 		"""Copy all field values from another struct.
@@ -162,9 +770,13 @@ class Struct(object):
 				type(self), type(other),
 			))
 		self.object_name = other.object_name
-		for field_name in self.field_names():
-			value = getattr(other, field_name)
-			setattr(self, field_name, value)
+		# Both structs have the same fields (and registries), so the
+		# raw column values can be copied across directly.
+		src_columns, src_index = other._store.columns, other._index
+		index = self._index
+		for n, col in self._store.own_columns().items():
+			col[index] = src_columns[n][src_index]
+		self._store.mark(index, self._store.all_bits)
 
 	def set_values(self, *args, **kwargs):
 		"""Set the values of all fields in the struct.
@@ -177,11 +789,16 @@ class Struct(object):
 		c.set_values(5, y=99)
 		"""
 		# Assign from args list:
-		field_names = self.field_names()
+		field_names = self._field_names
+		if len(args) > len(field_names):
+			raise ValueError("%r has only %d fields" % (
+				type(self).__name__, len(field_names)))
+		for field, value in zip(field_names, args):
+			setattr(self, field, value)
 
 		# Override with kwargs:
 		for field, value in kwargs.items():
-			if field not in field_names:
+			if field not in self._field_index:
 				raise ValueError("%r has no field %r" % (
 					type(self).__name__, field))
 			setattr(self, field, value)
@@ -192,37 +809,41 @@ class Struct(object):
 		Dictionary keys should correspond to field names; those that
 		do not will be ignored.
 		"""
-		field_names = self.field_names()
+		field_index = self._field_index
 		for k, v in values.items():
-			if k in field_names:
+			if k in field_index:
 				setattr(self, k, v)
 
 	@classmethod
 	def field_deh_name(cls, field):
 		"""For the given C field name, get the dehacked name."""
-		prop = getattr(cls, field)
-		return prop.deh_name
+		return cls._deh_names[field]
 
 	@classmethod
 	def deh_field_name(cls, deh_name):
 		"""For the given dehacked name, get the C field name."""
-		for field in cls.field_names():
-			if cls.field_deh_name(field) == deh_name:
-				return field
-		raise KeyError("%r has no field for name %r" % (
-			type(self).__name__, deh_name))
+		try:
+			return cls._deh_fields[deh_name]
+		except KeyError:
+			raise KeyError("%r has no field for name %r" % (
+				cls.__name__, deh_name))
 
 	def __copy__(self):
 		result = type(self)()
 		result.copy_from(self)
 		result.original = self.original
+		# The copy has the same original, so carries over the journal.
+		result._store.dirty.clear()
+		bits = self._store.dirty.get(self._index)
+		if bits:
+			result._store.mark(0, bits)
 		return result
 
 	def __repr__(self):
 		return "%s(%s)" % (
 			type(self).__name__,
 			", ".join("%s=%r" % (f, getattr(self, f))
-				for f in self.field_names()))
+				for f in self._field_names))
 
 	def dehacked_header(self, array_index):
 		result = "%s %d" % (self.DEHACKED_NAME, array_index)
@@ -237,7 +858,7 @@ class Struct(object):
 		included in the description.
 		"""
 		if fields is None:
-			fields = self.field_names()
+			fields = self._field_names
 		results = []
 		for field in fields:
 			deh_name = self.field_deh_name(field)
@@ -272,9 +893,10 @@ class Struct(object):
 		against the original values from instantiation time. A
 		list of differing field names is returned.
 		"""
-		other = other or self.original
+		if other is None:
+			other = self.original
 		return [
-			f for f in self.field_names()
+			f for f in self._field_names
 			if getattr(self, f) != getattr(other, f)
 		]
 
@@ -294,6 +916,13 @@ class StructArray(object):
 	      (3, 4),
 	      {'x': 5, 'y': 6},
 	  ])
+
+	The contents are stored column by column: each field is a single
+	typed array with one entry per element, and the elements returned
+	by indexing the array are lightweight views onto a row. This keeps
+	large tables (like the states table) compact. Copying an array with
+	copy.copy() is O(1): the copy shares its columns with the source
+	until one of them is written to.
 	"""
 
 	def __init__(self, struct_type, elements, one_indexed=False):
@@ -303,20 +932,20 @@ class StructArray(object):
 		self._struct_type = struct_type
 		self.one_indexed = one_indexed
 
-		copied_elements = []
+		elements = list(elements)
+		self._store = _Storage(struct_type, len(elements))
 		for i, el in enumerate(elements):
+			row = struct_type._view(self, i)
 			if isinstance(el, (list, tuple)):
-				el = struct_type(*el)
+				row.set_values(*el)
 			elif isinstance(el, dict):
-				el = struct_type(**el)
+				row.set_values(**el)
 			elif isinstance(el, struct_type):
-				el = copy.copy(el)
+				row.copy_from(el)
 			else:
 				raise ValueError("%r not of type %r" % (
 					el, struct_type))
-			copied_elements.append(el)
-
-		self._elements = tuple(copied_elements)
+		self._store.dirty.clear()
 
 		# The 'original' pointer points back to the original array
 		# that this instance was copy.copy()d from. By default, the
@@ -324,13 +953,22 @@ class StructArray(object):
 		self.original = self
 
 	def __iter__(self):
-		return iter(self._elements)
+		view = self._struct_type._view
+		for i in range(self._store.length):
+			yield view(self, i)
 	def __len__(self):
-		return len(self._elements)
+		return self._store.length
 	def __getitem__(self, i):
-		return self._elements[i]
+		if isinstance(i, slice):
+			return [self[j] for j in range(*i.indices(len(self)))]
+		i = operator.index(i)
+		if i < 0:
+			i += self._store.length
+		if not 0 <= i < self._store.length:
+			raise IndexError("array index out of range")
+		return self._struct_type._view(self, i)
 	def __getslice__(self, i, j):
-		return self._elements[i:j]
+		return self[i:j]
 
 	def copy_from(self, other):
 		assert self._struct_type == other._struct_type, (
@@ -341,12 +979,55 @@ class StructArray(object):
 			"Arrays must be equal length, %d != %d" % (
 				len(self), len(other),
 			))
-		for i, obj in enumerate(self):
-			obj.copy_from(other[i])
+		for n, col in other._store.columns.items():
+			self._store.column(n)[:] = col
+		self._store.object_names = dict(other._store.object_names)
+		self._store.names_owned = True
+		self._store.mark_all()
+
+	def changed_rows(self, field=None):
+		"""Get a sorted list of indexes of rows that have been written.
+
+		This comes from the change journal, so it includes rows which
+		were written but happen to still hold their original values.
+		If a field name is given, only rows where that field was
+		written are included.
+		"""
+		dirty = self._store.dirty
+		if field is None:
+			return sorted(dirty)
+		bit = getattr(self._struct_type, field).bit
+		return sorted(i for i, bits in dirty.items() if bits & bit)
+
+	def reset_to_original(self, rows=None):
+		"""Restore rows to their original values.
+
+		If no rows are given, every row in the change journal is
+		restored, and the array becomes identical to the original.
+		"""
+		if rows is None:
+			rows = list(self._store.dirty)
+		for i in rows:
+			self[i].reset_to_original()
+
+	def delta(self):
+		"""Get a compact record of the rows written to the array.
+
+		See _Storage.delta() for the format. The delta can be applied
+		to another array of the same type with apply_delta().
+		"""
+		return self._store.delta(
+			self._struct_type, sorted(self._store.dirty))
+
+	def apply_delta(self, delta):
+		"""Apply a delta returned by delta() to this array."""
+		self._store.apply_delta(self._struct_type, delta)
 
 	def __copy__(self):
-		result = type(self)(self._struct_type, self,
-		                    one_indexed=self.one_indexed)
+		result = type(self).__new__(type(self))
+		result._struct_type = self._struct_type
+		result.one_indexed = self.one_indexed
+		result._store = self._store.copy()
 		result.original = self.original
 		return result
 
@@ -356,24 +1037,29 @@ class StructArray(object):
 			"\n".join("\t%r," % x for x in self),
 		)
 
-	def header_regexp(self):
-		return self._struct_type().header_regexp()
+	def header_keyword(self):
+		return self._struct_type.header_keyword()
 
-	def parse_section(self, stream, index, **kwargs):
-		index = int(index)
+	def apply_event(self, event):
+		index = event.index
 		if self.one_indexed:
 			index -= 1
 		if index < 0 or index >= len(self):
-			stream.exception("assignment out of range: %d must be "
+			raise ValueError("assignment out of range: %d must be "
 			                 "in range 0-%d" % (index, len(self)))
-		self[index].parse_section(stream, **kwargs)
+		return self[index].apply_event(event)
 
 	def match_key(self):
 		return (StructArray, self._struct_type)
 
 	def dehacked_diffs(self, other=None):
+		# Against the original, only rows in the journal can differ.
+		if other is None:
+			rows = sorted(self._store.dirty)
+		else:
+			rows = range(len(self))
 		result = []
-		for i, el in enumerate(self):
+		for i in rows:
 			if other is not None:
 				other_el = other[i]
 			else:
@@ -381,7 +1067,7 @@ class StructArray(object):
 			array_index = i
 			if self.one_indexed:
 				array_index += 1
-			result.extend(el.dehacked_diffs(
+			result.extend(self[i].dehacked_diffs(
 				other_el, array_index=array_index))
 		return result
 
@@ -393,12 +1079,64 @@ class StructArray(object):
 			self[idx].object_name = name
 
 
+class TestEnum(unittest.TestCase):
+	COLORS = Enum(["RED", "GREEN", "BLUE", "CYAN"])
+
+	def test_lookup(self):
+		self.assertEqual(self.COLORS.index("BLUE"), 2)
+		self.assertIn("CYAN", self.COLORS)
+		self.assertNotIn("PINK", self.COLORS)
+		self.assertNotIn([], self.COLORS)
+		with self.assertRaises(ValueError):
+			self.COLORS.index("PINK")
+		g = {}
+		self.COLORS.create_globals(g)
+		self.assertEqual(g, {"RED": 0, "GREEN": 1, "BLUE": 2, "CYAN": 3})
+
+	def test_value(self):
+		blue = self.COLORS.value("BLUE")
+		self.assertEqual(blue, 2)
+		self.assertEqual((repr(blue), blue.name), ("BLUE", "BLUE"))
+		self.assertEqual(("%s" % blue, "{}".format(blue)), ("2", "2"))
+		self.assertEqual(self.COLORS.value(1), self.COLORS.value("GREEN"))
+		self.assertEqual(repr(self.COLORS.value(9)), "9")
+
+class TestEnumSet(unittest.TestCase):
+	COLORS = Enum(["RED", "GREEN", "BLUE", "CYAN"])
+
+	def test_set_operations(self):
+		s = EnumSet(self.COLORS, [2, 0])
+		self.assertEqual(repr(s), "{RED, BLUE}")
+		self.assertEqual(s.bits, 0b101)
+		self.assertEqual((len(s), list(s)), (2, [0, 2]))
+		self.assertEqual(s | {1}, {0, 1, 2})
+		self.assertEqual(s - EnumSet(self.COLORS, [0]), {2})
+		self.assertEqual(s & [2, 3], {2})
+		self.assertIn(2, s)
+		self.assertNotIn(1, s)
+		t = s.copy()
+		t.add(3)
+		t.remove(0)
+		self.assertEqual((s.bits, t.bits), (0b101, 0b1100))
+		self.assertEqual(t.pop(), 2)
+		with self.assertRaises(KeyError):
+			t.remove(2)
+
 class TestStruct(unittest.TestCase):
 	class Coordinate(Struct):
 		DEHACKED_NAME = "Co-ordinate"
 		y = StructField("Y Value")
 		x = StructField("X Value")
 
+	def test_float_values(self):
+		xy = TestStruct.Coordinate()
+		xy.x = 3.0
+		self.assertEqual(xy.x, 3)
+		self.assertIsInstance(xy.x, int)
+		with self.assertRaises(TypeError):
+			xy.y = 1.5
+		self.assertEqual(xy.y, 0)
+
 	def test_instantiate(self):
 		# Different styles of instantiation:
 		xy = TestStruct.Coordinate()
@@ -431,6 +1169,23 @@ class TestStruct(unittest.TestCase):
 		xy = TestStruct.Coordinate()
 		self.assertEqual(xy.field_names(), ["y", "x"])
 
+	def test_layout(self):
+		Coordinate = TestStruct.Coordinate
+		self.assertEqual(Coordinate._field_names, ("y", "x"))
+		self.assertEqual(Coordinate._field_index, {"y": 0, "x": 1})
+		self.assertEqual(Coordinate.deh_field_name("X Value"), "x")
+		with self.assertRaises(KeyError):
+			Coordinate.deh_field_name("Z Value")
+
+	def test_equality(self):
+		xy = TestStruct.Coordinate(10, 20)
+		self.assertEqual(xy, TestStruct.Coordinate(10, 20))
+		self.assertNotEqual(xy, TestStruct.Coordinate(10, 21))
+		self.assertEqual(xy.dehacked_output(array_index=3),
+		                 "Co-ordinate 3\n"
+		                 "Y Value = 10\n"
+		                 "X Value = 20")
+
 	def test_copy_from(self):
 		xy = TestStruct.Coordinate()
 		self.assertEqual(xy.x, 0)
@@ -560,6 +1315,38 @@ class TestStructArray(unittest.TestCase):
 			'Co-ordinate 1\nX Value = 40',
 		])
 
+	def test_element_views(self):
+		arr = StructArray(TestStruct.Coordinate, [
+			(10, 20),
+			(30, 40),
+		])
+		# Elements write through to the array's storage:
+		arr[1].x = 99
+		self.assertEqual(arr[1].x, 99)
+		self.assertEqual(arr[-1].x, 99)
+		self.assertEqual([el.y for el in arr], [10, 30])
+		with self.assertRaises(IndexError):
+			arr[2]
+
+		arr[0].object_name = "First"
+		arr2 = copy.copy(arr)
+		self.assertEqual(arr2[0].object_name, "First")
+		arr[1].x = 0
+		self.assertEqual(arr2[1].x, 99)
+		self.assertEqual(arr2[1].original.x, 0)
+
+	def test_registry_field(self):
+		registry = Registry()
+		class Pointer(Struct):
+			DEHACKED_NAME = "Pointer"
+			target = StructField(None, registry=registry)
+		arr = StructArray(Pointer, [(), ("foo",)])
+		self.assertEqual(arr[0].target, None)
+		self.assertEqual(arr[1].target, "foo")
+		arr[0].target = "bar"
+		self.assertEqual(arr[0].target, "bar")
+		self.assertEqual(len(registry), 3)
+
 
 if __name__ == '__main__':
 	unittest.main()
@@ -0,0 +1,366 @@
+"""On-disk cache of parsed dehacked files.
+
+Parsing a large patch takes much longer than applying the changes it makes,
+so a ParseCache stores the result of parsing each file as a compact delta
+(see DehackedFile.delta()) keyed by a hash of the file contents. Using the
+cache is opt-in, by passing one to DehackedFile.load():
+
+  cache = ParseCache("/tmp/deh9000-cache")
+  dehfile = deh9000.DehackedFile()
+  dehfile.load("mypatch.deh", cache=cache)
+  print(cache.stats())
+
+Cache entries are only valid for the deh9000 version (and table layouts)
+that wrote them, since deltas store raw field values and registry indexes,
+so the version is mixed into the key. The cache is limited in size: once it
+grows beyond max_bytes, the least recently used entries are removed.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import collections
+import hashlib
+import io
+import marshal
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zlib
+
+import deh9000
+from deh9000 import actions
+from deh9000 import deh_parser
+from deh9000 import file
+from deh9000 import tables
+
+# Suffix of cache entry files.
+ENTRY_SUFFIX = ".delta"
+
+# Version of the layout of cache entries, which is mixed into their keys.
+ENTRY_VERSION = 3
+
+# Name that warnings from parsing a file's contents are reported against;
+# see _parse_warning().
+_NEUTRAL_NAME = "<input>"
+
+# Default maximum size of a cache, in bytes.
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+CacheStats = collections.namedtuple(
+	"CacheStats", ("hits", "misses", "evictions", "bytes"))
+
+_format_key = None
+
+def get_format_key():
+	"""Get a key identifying the format of deltas.
+
+	This covers the deh9000 version and also the things that the delta
+	format depends on (the field layout of each table and the order of
+	the actions registry), so that a development tree where these have
+	changed doesn't read back stale entries. Other on-disk caches of
+	data in the same format should include it in their keys.
+	"""
+	global _format_key
+	if _format_key is None:
+		h = hashlib.sha256()
+		h.update(deh9000.__version__.encode())
+		for name in file.DehackedFile.TABLE_MODULE_VARS:
+			table = getattr(tables, name)
+			struct_type = getattr(
+				table, "_struct_type", type(table))
+			h.update(repr(struct_type._field_names).encode())
+		registry = actions.registry
+		h.update(repr([registry[i]
+		               for i in range(len(registry))]).encode())
+		_format_key = h.digest()
+	return _format_key
+
+def _parse_warning(warning):
+	"""Split a warning from parsing contents into (lineno, message)."""
+	prefix = _NEUTRAL_NAME + ":"
+	if warning.startswith(prefix):
+		lineno, sep, message = warning[len(prefix):].partition(": ")
+		if sep and lineno.isdigit():
+			return int(lineno), message
+	return None, warning
+
+def _format_warning(filename, warning):
+	lineno, message = warning
+	if lineno is None:
+		return message
+	return repr(deh_parser.DehackedParseException(
+		filename, lineno, message))
+
+class ParseCache(object):
+	"""Cache of parsed dehacked files, stored in a directory."""
+
+	def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._size = None
+		os.makedirs(directory, exist_ok=True)
+
+	def _path(self, data):
+		h = hashlib.sha256(get_format_key())
+		h.update(b"%d:" % ENTRY_VERSION)
+		h.update(data)
+		return os.path.join(self.directory,
+		                    h.hexdigest() + ENTRY_SUFFIX)
+
+	def _entries(self):
+		"""Returns a list of (mtime, size, path) for all entries."""
+		result = []
+		for entry in os.scandir(self.directory):
+			if entry.name.endswith(ENTRY_SUFFIX):
+				st = entry.stat()
+				result.append(
+					(st.st_mtime, st.st_size, entry.path))
+		return result
+
+	def size(self):
+		"""Get the total size in bytes of all cache entries."""
+		if self._size is None:
+			self._size = sum(
+				size for _, size, _ in self._entries())
+		return self._size
+
+	def _read(self, path):
+		try:
+			with open(path, "rb") as f:
+				data = f.read()
+			result = marshal.loads(zlib.decompress(data))
+		except (OSError, EOFError, ValueError, TypeError,
+		        zlib.error):
+			return None
+		# Touching the entry records when it was last used, for
+		# the LRU eviction in _evict().
+		try:
+			os.utime(path)
+		except OSError:
+			pass
+		return result
+
+	def _write(self, path, value):
+		data = zlib.compress(marshal.dumps(value))
+		# The size is worked out before the entry is written, so
+		# that it is counted once, replacing any old entry.
+		size = self.size()
+		try:
+			size -= os.path.getsize(path)
+		except OSError:
+			pass
+		fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+		with os.fdopen(fd, "wb") as f:
+			f.write(data)
+		os.replace(tmp_path, path)
+		self._size = size + len(data)
+		if self._size > self.max_bytes:
+			self._evict()
+
+	def _evict(self):
+		# Other processes may share the directory, so the size is
+		# recalculated from the directory contents.
+		entries = sorted(self._entries())
+		self._size = sum(size for _, size, _ in entries)
+		for _, size, path in entries:
+			if self._size <= self.max_bytes:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				continue
+			self._size -= size
+			self.evictions += 1
+
+	def load(self, dehfile, source, strict_mode=False, warnings=None):
+		"""Load a dehacked file, using the cache if possible.
+
+		This works the same as DehackedFile.load(), which calls it
+		when passed a cache.
+		"""
+		if source == "-":
+			source = sys.stdin
+		if isinstance(source, bytes):
+			data = source
+		elif isinstance(source, (str, os.PathLike)):
+			with open(source, "rb") as f:
+				data = f.read()
+		else:
+			data = source.read()
+		# Text read from a stream is parsed as it is, rather than
+		# being encoded here and decoded again by the parser with
+		# what might be a different codec.
+		if isinstance(data, str):
+			parse_source = io.StringIO(data)
+			key = b"t" + data.encode("utf-8", "surrogatepass")
+		else:
+			parse_source = data
+			key = b"b" + data
+		# Warnings are named after the source, as they would be
+		# without the cache. Entries are shared by every file with
+		# the same contents, so they hold warnings as (lineno,
+		# message) pairs, and the contents are parsed rather than the
+		# source, so that warnings are reported against a neutral
+		# name that is then removed.
+		filename = getattr(source, "name", source)
+		if not isinstance(filename, str):
+			filename = _NEUTRAL_NAME
+		path = self._path(key)
+		entry = self._read(path)
+		# In strict mode a patch with warnings should raise an
+		# exception, so it must be parsed again.
+		if entry is not None and not (strict_mode and entry[1]):
+			self.hits += 1
+			delta, entry_warnings = entry
+		else:
+			self.misses += 1
+			loaded = file.DehackedFile()
+			# The header fields are only in the delta if the
+			# patch sets them, so that others are left as they
+			# are when it is applied.
+			loaded.doom_version = loaded.patch_format = None
+			parse_warnings = []
+			try:
+				loaded.load(parse_source, strict_mode=strict_mode,
+				            warnings=parse_warnings)
+			except deh_parser.DehackedParseException as e:
+				e.filename = filename
+				raise
+			delta = loaded.delta()
+			entry_warnings = [_parse_warning(w)
+			                  for w in parse_warnings]
+			self._write(path, (delta, entry_warnings))
+		dehfile.apply_delta(delta)
+		entry_warnings = [_format_warning(filename, w)
+		                  for w in entry_warnings]
+		if warnings is not None:
+			warnings.extend(entry_warnings)
+		elif entry_warnings:
+			print("Warnings loading dehacked file:",
+			      file=sys.stderr)
+			for w in entry_warnings:
+				print(w, file=sys.stderr)
+
+	def stats(self):
+		"""Get a CacheStats with the hit, miss and eviction counts.
+
+		The counts are for lookups made through this object. 'bytes'
+		is the current total size of the cache.
+		"""
+		return CacheStats(self.hits, self.misses, self.evictions,
+		                  self.size())
+
+	def clear(self):
+		"""Remove all entries from the cache."""
+		for _, _, path in self._entries():
+			os.remove(path)
+		self._size = 0
+
+
+class TestParseCache(unittest.TestCase):
+	PATCH = (b"Patch File for DeHackEd64\n"
+	         b"Doom version = 21\n\n"
+	         b"Thing 1 (Zombieman)\n"
+	         b"Hit points = 30\n\n"
+	         b"Text 3 4\n"
+	         b"fooquux\n"
+	         b"Bogus\n")
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_hits(self):
+		cache = ParseCache(self.directory)
+		expected = file.DehackedFile()
+		expected.load(self.PATCH, warnings=[])
+		for _ in range(2):
+			warnings = []
+			dehfile = file.DehackedFile()
+			dehfile.load(self.PATCH, cache=cache,
+			             warnings=warnings)
+			self.assertEqual(dehfile.dehacked_diffs(),
+			                 expected.dehacked_diffs())
+			self.assertEqual(len(warnings), 1)
+		stats = cache.stats()
+		self.assertEqual((stats.hits, stats.misses), (1, 1))
+		self.assertGreater(stats.bytes, 0)
+		with self.assertRaises(Exception):
+			file.DehackedFile().load(
+				self.PATCH, strict_mode=True, cache=cache)
+
+	def test_unchanged_header(self):
+		# Header fields the patch doesn't set are left as they are.
+		cache = ParseCache(self.directory)
+		for _ in range(2):
+			dehfile = file.DehackedFile()
+			dehfile.patch_format = 5
+			dehfile.load(self.PATCH, cache=cache, warnings=[])
+			self.assertEqual(
+				(dehfile.doom_version, dehfile.patch_format),
+				(21, 5))
+		self.assertEqual(cache.stats().hits, 1)
+
+	def test_text_stream(self):
+		# Text is parsed as it is read, as it is without the cache.
+		value = "\u00e9\u00e8\u00ea"
+		patch = self.PATCH.decode() + "\nText 3 3\nfoo%s\n" % value
+		cache = ParseCache(self.directory)
+		for _ in range(2):
+			dehfile = file.DehackedFile()
+			dehfile.load(io.StringIO(patch), cache=cache,
+			             warnings=[])
+			self.assertEqual(dehfile.strings["foo"], value)
+		self.assertEqual(cache.stats().hits, 1)
+
+	def test_warning_filenames(self):
+		# Identical contents under two names are cached once, but
+		# their warnings name the file that was loaded.
+		cache = ParseCache(self.directory)
+		for name in ("a.deh", "b.deh"):
+			path = os.path.join(self.directory, name)
+			with open(path, "wb") as f:
+				f.write(self.PATCH)
+			warnings = []
+			file.DehackedFile().load(path, cache=cache,
+			                         warnings=warnings)
+			expected = []
+			file.DehackedFile().load(path, warnings=expected)
+			self.assertEqual(warnings, expected)
+			self.assertTrue(warnings[0].startswith(path + ":"))
+		self.assertEqual(cache.stats().hits, 1)
+
+	def test_size(self):
+		cache = ParseCache(self.directory)
+		dehfile = file.DehackedFile()
+		dehfile.load(self.PATCH, cache=cache, warnings=[])
+		self.assertEqual(cache.stats().bytes, ParseCache(
+			self.directory).size())
+		# An unreadable entry is overwritten:
+		path, = [e.path for e in os.scandir(self.directory)]
+		with open(path, "wb") as f:
+			f.write(b"junk")
+		cache = ParseCache(self.directory)
+		dehfile.load(self.PATCH, cache=cache, warnings=[])
+		self.assertEqual(cache.stats().misses, 1)
+		self.assertEqual(cache.stats().bytes, ParseCache(
+			self.directory).size())
+
+	def test_eviction(self):
+		cache = ParseCache(self.directory, max_bytes=1)
+		dehfile = file.DehackedFile()
+		dehfile.load(self.PATCH, cache=cache, warnings=[])
+		dehfile.load(self.PATCH + b"\n", cache=cache, warnings=[])
+		self.assertEqual(cache.stats().evictions, 2)
+		self.assertEqual(cache.stats().bytes, 0)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,204 @@
+"""Renumbering of states to defragment the states table.
+
+After many calls to StatesArray.parse() and states being freed and reused,
+the states of each actor end up scattered around the table, and states no
+longer in use may still hold modified values that appear in the patch.
+
+compact_states() renumbers the modified states in use so that the states of
+each mobj and weapon are contiguous, using a StateAllocator so that states
+with action pointers are only moved into states that can have one in a
+Vanilla patch. States that are unmodified, or whose ID is significant (see
+dedup.protected_states()), are left where they are. Every unused state is
+reset to its original values, which removes it from the patch.
+"""
+
+from __future__ import absolute_import
+
+import copy
+import unittest
+
+from deh9000.dedup import protected_states, trace_chains
+from deh9000.mobjs import mobjinfo_t
+from deh9000.states import *
+from deh9000.states_parser import StateAllocator, _action_capable_bits
+from deh9000.weapons import weaponinfo_t
+
+def _owner_groups(dehfile, movable):
+	"""Split the movable states into groups to be kept together.
+
+	Each mobj and weapon (in that order) gets a group of the movable
+	states it uses, in the order its chains visit them. States shared
+	by several owners go with the first; any left over (eg. following
+	on from a hard-coded state) form a final group.
+	"""
+	graph = dehfile.states.graph()
+	assigned = set()
+	groups = []
+	for table, fields in ((dehfile.mobjinfo, mobjinfo_t.state_fields),
+	                      (dehfile.weaponinfo,
+	                       weaponinfo_t.state_fields)):
+		for obj in table:
+			group = []
+			for f in fields:
+				for state_id in graph.chain(getattr(obj, f)):
+					if (state_id in movable
+					    and state_id not in assigned):
+						assigned.add(state_id)
+						group.append(state_id)
+			if group:
+				groups.append(group)
+	rest = sorted(movable - assigned)
+	if rest:
+		groups.append(rest)
+	return groups
+
+def _is_contiguous(group):
+	return max(group) - min(group) + 1 == len(group)
+
+def _plan(dehfile, groups, free, in_place):
+	"""Work out new state IDs for the groups not kept in place.
+
+	Returned is a dictionary mapping old state IDs to new ones, and a
+	set of groups (by index) whose new states can't have the action
+	pointers they need, so should be kept in place instead.
+	"""
+	states = dehfile.states
+	capable = _action_capable_bits(states.original)
+	actions = states._store.columns[state_t.action.order]
+	moving = [group for i, group in enumerate(groups)
+	          if i not in in_place]
+	pool = set(free)
+	for group in moving:
+		pool.update(group)
+	allocator = StateAllocator(states.original, pool)
+	mapping = {}
+	illegal = set()
+	for i, group in enumerate(groups):
+		if i in in_place:
+			continue
+		new_ids = allocator.allocate(
+			[actions[state_id] != 0 for state_id in group])
+		for state_id, new_id in zip(group, new_ids):
+			# Moving a state with an action pointer out of a state
+			# that can have one into one that can't would make it
+			# impossible to express in the patch.
+			if (actions[state_id] != 0
+			    and capable >> state_id & 1
+			    and not capable >> new_id & 1):
+				illegal.add(i)
+			if state_id != new_id:
+				mapping[state_id] = new_id
+	return mapping, illegal
+
+def compact_states(dehfile, fixed=()):
+	"""Renumber the states in use in the given DehackedFile.
+
+	'fixed' is a collection of extra state IDs to leave in place, eg.
+	states whose IDs are hard-coded into a source port. The plan is
+	worked out in full before anything is changed. Returned is a
+	dictionary mapping the old ID of each state that moved to its new
+	ID.
+
+	States that are not referenced from anywhere (including states
+	just returned by StatesArray.parse() but not yet assigned to a
+	mobj or weapon) are reset to their original values.
+	"""
+	states = dehfile.states
+	index = dehfile.reachability()
+	free = index.free_states()
+	used = [state_id for state_id in range(len(states))
+	        if state_id not in free]
+	keep = protected_states(dehfile)
+	keep.update(fixed)
+	modified = {state_id for state_id in states.changed_rows()
+	            if states[state_id].diff()}
+	movable = {state_id for state_id in used
+	           if state_id in modified and state_id not in keep}
+	groups = _owner_groups(dehfile, movable)
+
+	# Groups which are already contiguous don't need to move. Others
+	# which can't be moved legally are also kept in place, which
+	# changes the states available to the rest, so the plan is made
+	# again until every group can move.
+	in_place = {i for i, group in enumerate(groups)
+	            if _is_contiguous(group)}
+	while True:
+		mapping, illegal = _plan(dehfile, groups, free, in_place)
+		if not illegal:
+			break
+		in_place.update(illegal)
+
+	snapshots = {state_id: copy.copy(states[state_id])
+	             for state_id in mapping}
+	for state_id, new_id in mapping.items():
+		states[new_id].copy_from(snapshots[state_id])
+	for state_id in used:
+		state = states[mapping.get(state_id, state_id)]
+		if state.nextstate in mapping:
+			state.nextstate = mapping[state.nextstate]
+	for table, fields in ((dehfile.mobjinfo, mobjinfo_t.state_fields),
+	                      (dehfile.weaponinfo,
+	                       weaponinfo_t.state_fields)):
+		for obj in table:
+			for f in fields:
+				state_id = getattr(obj, f)
+				if state_id in mapping:
+					setattr(obj, f, mapping[state_id])
+	free = index.free_states()
+	states.reset_to_original([state_id
+	                          for state_id in states.changed_rows()
+	                          if state_id in free])
+	return mapping
+
+
+class TestCompactStates(unittest.TestCase):
+	DEFSTR = """
+	  Spawn:
+	    TROO AB 10 A_Look
+	    Loop
+	  Death:
+	    TROO I 8
+	    TROO J 8 A_Scream
+	    TROO K -1
+	    Stop
+	"""
+
+	def setUp(self):
+		from deh9000.file import DehackedFile
+		self.dehfile = DehackedFile()
+
+	def parse_into(self, mobj_id, defstr, alloc_states=None):
+		labels = self.dehfile.states.parse(defstr, alloc_states)
+		mobj = self.dehfile.mobjinfo[mobj_id]
+		mobj.spawnstate = labels["Spawn"]
+		mobj.deathstate = labels["Death"]
+
+	def test_compact(self):
+		dehfile = self.dehfile
+		for mobj_id in range(1, len(dehfile.mobjinfo)):
+			dehfile.mobjinfo[mobj_id].clear_states()
+		# Fragment the table by parsing into every third free state,
+		# and leave some modified states unused:
+		self.parse_into(1, self.DEFSTR)
+		self.parse_into(2, self.DEFSTR)
+		free = sorted(dehfile.free_states())
+		self.parse_into(3, self.DEFSTR, set(free[::3]))
+		dehfile.mobjinfo[1].clear_states()
+		self.assertFalse(_is_contiguous(dehfile.mobj_states(3)))
+		before = trace_chains(dehfile)
+		num_diffs = len(dehfile.states.dehacked_diffs())
+
+		mapping = compact_states(dehfile)
+		self.assertTrue(mapping)
+		self.assertEqual(trace_chains(dehfile), before)
+		for mobj_id in (2, 3):
+			self.assertTrue(
+				_is_contiguous(dehfile.mobj_states(mobj_id)))
+		# The states freed by clearing the first actor were reset:
+		self.assertLess(len(dehfile.states.dehacked_diffs()), num_diffs)
+		# Every action pointer can still be expressed:
+		dehfile.dehacked_diffs()
+		self.assertEqual(compact_states(dehfile), {})
+
+if __name__ == "__main__":
+	unittest.main()
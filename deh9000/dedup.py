@@ -0,0 +1,310 @@
+"""Merging of identical chains of states.
+
+Patches built with StatesArray.parse() often contain many copies of the
+same animation; for example, several monsters may share an identical gib
+animation that ends in "Stop". Each copy uses up states from the fixed-size
+states table, which is a scarce resource.
+
+dedup_states() finds states that behave identically by hash-consing: each
+state in use is given a class number determined by its fields and the class
+of the state that follows it, working bottom-up from the ends of chains.
+Loops are handled as a whole, by the smallest rotation of the fields of
+their states. States of the same class are then merged into one, and every
+reference to them (from mobjinfo, weaponinfo and the nextstate of other
+states) is rewritten to point to it, leaving the others free for reuse.
+
+Only states that the patch has changed are merged away, and only when every
+reference to them is from a row that the patch has changed too, so that
+rows which still hold their original values are never rewritten. The
+original states that changed states lead on to are classified as well, so
+a changed state can be merged into an identical original one.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import unittest
+
+from deh9000.reachability import FLASH_ACTIONS
+from deh9000.mobjs import mobjinfo_t
+from deh9000.states import *
+from deh9000.states_array import StatesArray
+from deh9000.states_parser import _action_capable_bits
+from deh9000.state_graph import NO_SUCCESSOR
+from deh9000.weapons import weaponinfo_t
+
+def protected_states(dehfile):
+	"""Get the set of states which must not be merged into others.
+
+	These are states whose ID is significant, rather than just what
+	they contain: the null state, states hard-coded into the Doom
+	source, and the states that A_FireCGun and A_FirePlasma find by
+	their position in the table.
+	"""
+	index = dehfile.reachability()
+	result = {S_NULL}
+	result.update(StatesArray.HARDCODED_STATES)
+	for slot, entry in index.slots.items():
+		if slot[0] == "flash":
+			result.update((entry - 1, entry))
+	actions = dehfile.states._store.columns[state_t.action.order]
+	flash_actions = {state_t.action.registry.index(a)
+	                 for a in FLASH_ACTIONS}
+	for state_id in range(len(actions)):
+		if actions[state_id] in flash_actions:
+			result.add(state_id)
+	return result
+
+def _smallest_rotation(keys):
+	"""Returns the start index of the lexicographically smallest
+	rotation of the given list, and the period of that rotation."""
+	length = len(keys)
+	start = min(range(length), key=lambda i: keys[i:] + keys[:i])
+	rotation = keys[start:] + keys[:start]
+	for period in range(1, length + 1):
+		if (length % period == 0
+		    and rotation[period:] + rotation[:period] == rotation):
+			return start, period
+
+def state_classes(states, used):
+	"""Assign a class number to each of the given states.
+
+	'used' is a collection of state IDs, which must include every state
+	that follows on from them. Returned is a dictionary mapping each
+	state ID to a class number; two states with the same class number
+	behave identically.
+	"""
+	columns = states._store.columns
+	nextstate = columns[state_t.nextstate.order]
+	field_columns = [columns[getattr(state_t, name).order]
+	                 for name in state_t._field_names
+	                 if name != "nextstate"]
+	rows = {state_id: tuple(column[state_id]
+	                        for column in field_columns)
+	        for state_id in used}
+	graph = states.graph()
+	succ = graph.succ
+	interned = {}
+	def intern(key):
+		return interned.setdefault(key, len(interned))
+
+	classes = {}
+	# The states in a loop are classified by their position in the
+	# smallest rotation of the loop, so that identical loops get the
+	# same classes however they are entered.
+	_, loops = graph.components()
+	for loop in loops.values():
+		if loop[0] not in rows:
+			continue
+		keys = [rows[state_id] for state_id in loop]
+		start, period = _smallest_rotation(keys)
+		rotation = keys[start:] + keys[:start]
+		loop_class = intern(("loop", tuple(rotation[:period])))
+		for i, state_id in enumerate(loop):
+			classes[state_id] = intern(
+				(loop_class, (i - start) % period))
+
+	for state_id in sorted(rows):
+		# Find the states on the way to one already classified, then
+		# classify them from the end backwards.
+		path = []
+		while state_id not in classes:
+			path.append(state_id)
+			state_id = succ[state_id]
+			if state_id == NO_SUCCESSOR:
+				break
+		for state_id in reversed(path):
+			if succ[state_id] == NO_SUCCESSOR:
+				next_class = ("raw", nextstate[state_id])
+			else:
+				next_class = classes[succ[state_id]]
+			classes[state_id] = intern((rows[state_id], next_class))
+	return classes
+
+def _choose_kept(members, protected, actions, capable):
+	"""Choose which states of a class to keep."""
+	kept = [state_id for state_id in members if state_id in protected]
+	if kept:
+		return kept
+	# Keep a state of the kind that the class needs: action-capable if
+	# it has an action, otherwise plain, so that the scarce
+	# action-capable states are the ones freed up.
+	has_action = actions[members[0]] != 0
+	return [min(members, key=lambda state_id: (
+		bool(capable >> state_id & 1) != has_action, state_id))]
+
+def _mergeable_states(dehfile, used, changed):
+	"""Get the states of 'used' that may be merged away.
+
+	These are the states in 'changed' that are not referenced by any
+	row outside of it: an unchanged state in use, or a mobjinfo or
+	weaponinfo row that the patch hasn't changed.
+	"""
+	index = dehfile.reachability()
+	succ = dehfile.states.graph().succ
+	pinned = {succ[state_id] for state_id in range(len(succ))
+	          if state_id not in changed
+	          and not index.is_state_free(state_id)}
+	for table, fields in ((dehfile.mobjinfo, mobjinfo_t.state_fields),
+	                      (dehfile.weaponinfo,
+	                       weaponinfo_t.state_fields)):
+		changed_rows = set(table.changed_rows())
+		for row_id, obj in enumerate(table):
+			if row_id not in changed_rows:
+				pinned.update(getattr(obj, f) for f in fields)
+	return {state_id for state_id in used
+	        if state_id in changed and state_id not in pinned}
+
+def dedup_states(dehfile):
+	"""Merge identical chains of states in the given DehackedFile.
+
+	Returned is a dictionary mapping the ID of each state that was
+	merged away to the ID of the state that replaced it. The states
+	merged away are reset to their original values and are free for
+	reuse afterwards. Only states changed by the patch are merged
+	away, so an unmodified file is left as it is.
+	"""
+	states = dehfile.states
+	index = dehfile.reachability()
+	succ = states.graph().succ
+	changed = {state_id for state_id in states.changed_rows()
+	           if not index.is_state_free(state_id)}
+	# The changed states and every state that follows on from them.
+	used = set()
+	for state_id in changed:
+		while state_id != NO_SUCCESSOR and state_id not in used:
+			used.add(state_id)
+			state_id = succ[state_id]
+	used = sorted(used)
+	classes = state_classes(states, used)
+	mergeable = _mergeable_states(dehfile, used, changed)
+	kept_states = protected_states(dehfile).union(
+		state_id for state_id in used if state_id not in mergeable)
+	actions = states._store.columns[state_t.action.order]
+	capable = _action_capable_bits(states.original)
+
+	members_by_class = collections.defaultdict(list)
+	for state_id in used:
+		members_by_class[classes[state_id]].append(state_id)
+	replacement = {}
+	for members in members_by_class.values():
+		if len(members) < 2:
+			continue
+		kept = _choose_kept(members, kept_states, actions, capable)
+		for state_id in members:
+			if state_id not in kept:
+				replacement[state_id] = kept[0]
+	if not replacement:
+		return replacement
+
+	# Work out all the changes before making any, since the graph
+	# changes as they are made.
+	nextstate_changes = [
+		(state_id, replacement[succ[state_id]])
+		for state_id in used
+		if state_id not in replacement
+		and succ[state_id] in replacement]
+	for state_id, new_next in nextstate_changes:
+		states[state_id].nextstate = new_next
+	for table, fields in ((dehfile.mobjinfo, mobjinfo_t.state_fields),
+	                      (dehfile.weaponinfo,
+	                       weaponinfo_t.state_fields)):
+		for obj in table:
+			for f in fields:
+				state_id = getattr(obj, f)
+				if state_id in replacement:
+					setattr(obj, f, replacement[state_id])
+	states.reset_to_original(sorted(replacement))
+	return replacement
+
+def trace_chains(dehfile, count=20):
+	"""Get what every actor and weapon shows, for checking that
+	changes to the states table don't change their behaviour.
+
+	Returned is a list with, for each entry point of each actor and
+	weapon, the (sprite, frame, tics, action) of up to 'count' states
+	shown from it.
+	"""
+	states = dehfile.states
+	def trace(entry):
+		result = []
+		for _ in range(count):
+			state = states[entry]
+			result.append((state.sprite, state.frame, state.tics,
+			               state.action))
+			if entry == S_NULL or state.tics < 0:
+				break
+			entry = state.nextstate
+		return result
+	return ([[trace(getattr(mobj, f)) for f in mobjinfo_t.state_fields]
+	         for mobj in dehfile.mobjinfo] +
+	        [[trace(getattr(weapon, f))
+	          for f in weaponinfo_t.state_fields]
+	         for weapon in dehfile.weaponinfo])
+
+
+class TestDedupStates(unittest.TestCase):
+	DEFSTR = """
+	  Spawn:
+	    TROO AB 10 A_Look
+	    Loop
+	  See:
+	    TROO ABAB 3 A_Chase
+	    Loop
+	  Death:
+	    TROO I 8
+	    TROO J 8 A_Scream
+	    TROO K 6 A_Fall
+	    TROO L -1
+	    Stop
+	"""
+
+	def setUp(self):
+		from deh9000.file import DehackedFile
+		self.dehfile = DehackedFile()
+
+	def test_dedup(self):
+		mobjinfo = self.dehfile.mobjinfo
+		for mobj in mobjinfo:
+			mobj.clear_states()
+		for mobj_id in (1, 2):
+			labels = self.dehfile.states.parse(self.DEFSTR)
+			mobjinfo[mobj_id].spawnstate = labels["Spawn"]
+			mobjinfo[mobj_id].seestate = labels["See"]
+			mobjinfo[mobj_id].deathstate = labels["Death"]
+		before = trace_chains(self.dehfile)
+		num_free = len(self.dehfile.free_states())
+		replacement = dedup_states(self.dehfile)
+		self.assertEqual(trace_chains(self.dehfile), before)
+		# The second copy is merged into the first, and the loop of
+		# the See animation shrinks to two states:
+		self.assertEqual(len(replacement), 10 + 2)
+		self.assertEqual(len(self.dehfile.free_states()),
+		                 num_free + len(replacement))
+		self.assertEqual(self.dehfile.mobj_states(1),
+		                 self.dehfile.mobj_states(2))
+		for state_id in replacement:
+			self.assertEqual(self.dehfile.states[state_id],
+			                 self.dehfile.states.original[state_id])
+		self.assertEqual(dedup_states(self.dehfile), {})
+
+	def test_protected(self):
+		# Every state hard-coded into the source is kept, even though
+		# it's identical to another state.
+		states = self.dehfile.states
+		states[S_PLAY_RUN1].copy_from(states[S_PLAY])
+		before = trace_chains(self.dehfile)
+		replacement = dedup_states(self.dehfile)
+		self.assertEqual(trace_chains(self.dehfile), before)
+		for state_id in StatesArray.HARDCODED_STATES:
+			self.assertNotIn(state_id, replacement)
+
+	def test_unmodified(self):
+		# Identical original states are left alone.
+		from deh9000.file import DehackedFile
+		self.assertEqual(dedup_states(self.dehfile), {})
+		self.assertEqual(self.dehfile.dehacked_diffs(),
+		                 DehackedFile().dehacked_diffs())
+
+if __name__ == "__main__":
+	unittest.main()
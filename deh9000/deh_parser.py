@@ -1,25 +1,38 @@
 """Main module for parsing dehacked files.
 
-The main function in this module is called parse_dehacked_file(). This takes
-as an argument a list objects which implement the following two methods:
-
-header_regexp() - This is a function that, when called, will return a regexp.
-The parser will read the dehacked file one line at a time, and it is expected
-that each line it encounters will match one of the regexps returned by these
-methods. It is expected that the regexp will use named capture groups.
-
-parse_section(stream, **params) - If a line matches the regexp returned by
-header_regexp(), this function is invoked, and passed an instance of
-DehackedInputStream that allows more data to be read from the file using the
-methods it implements. Furthermore, any values from named capture groups
-matched by the header regexp are passed to the function as named parameters.
+Parsing happens in two stages. iter_dehacked_events() reads a dehacked file
+and turns it into a stream of events, one for each meaningful construct in
+the file (see the event types below). This stage knows nothing about the
+tables being patched, and only holds one line of the file in memory at a
+time, so it can also be used on its own to scan through or analyze patches.
+
+The second stage, apply_events(), applies a stream of events to a list of
+section objects, each of which implements the following two methods:
+
+header_keyword() - Returns the keyword that identifies which events are
+delivered to the object. SectionStart events are delivered to the object
+whose keyword matches the event's kind (eg. "Thing"); TextReplace events go
+to the "Text" object, and PropertyAssign events to the object whose keyword
+is the property name (eg. "Doom version"). Keywords are case insensitive.
+
+apply_event(event) - Applies an event to the object. When passed a
+SectionStart event, this returns the object that the following FieldAssign
+and PointerAssign events in that section are delivered to (by calling its
+own apply_event() method). A ValueError should be raised if the event cannot
+be applied.
+
+The main function, parse_dehacked_file(), just connects the two stages.
 """
 
 from __future__ import absolute_import
 from __future__ import print_function
 
+import collections
+import io
+import os
 import re
 import sys
+import unittest
 
 # A dehacked64 file must start with one of these lines:
 HEADER_LINES = [
@@ -28,7 +41,69 @@ HEADER_LINES = [
 
 # Lines which match this regexp are comment lines and will be stripped out of
 # the input stream.
-COMMENT_LINE_RE = re.compile("\s*#")
+COMMENT_LINE_RE = re.compile(r"\s*#")
+
+# Regexp that matches the start of Text sections.
+TEXT_HEADER_RE = re.compile(r"\s*Text"
+                            r"\s+(?P<from_len>\d+)"
+                            r"\s+(?P<to_len>\d+)"
+                            r"\s*$", re.I)
+
+# Regexp that matches the start of every other type of section, eg.
+# "Thing 1 (Zombieman)" or "Pointer 12 (Frame 34)".
+SECTION_HEADER_RE = re.compile(r"\s*(?P<kind>[A-Za-z]+)"
+                               r"\s+(?P<index>\d+)"
+                               r"(\s*\((?P<name>.*)\))?"
+                               r"\s*$")
+
+# Regexp for matching field assignments within a section:
+FIELD_ASSIGNMENT_RE = re.compile(r"\s*(?P<deh_name>\w[\w \#\.\/]+[\w\#])*"
+                                 r"\s*=\s*"
+                                 r"\s*(?P<value>\-?\d+)"
+                                 r"\s*$", re.I)
+
+# Regexp for matching top-level property assignments (outside of a section),
+# eg. "Doom version = 19".
+PROPERTY_ASSIGNMENT_RE = re.compile(r"\s*(?P<deh_name>[^=]*\S)"
+                                    r"\s*=\s*"
+                                    r"(?P<value>.*\S)\s*$")
+
+# Pointer sections only have one "field", which is reported as a
+# PointerAssign event rather than a FieldAssign event:
+POINTER_FIELD_NAME = "Codep Frame"
+
+# Amount of input that DehackedInputStream reads from its stream at once.
+CHUNK_SIZE = 64 * 1024
+
+# The events generated by iter_dehacked_events(). Every event records the
+# number of the line in the file that it came from.
+
+# Start of a section, eg. "Frame 12 (Imp attack)" has kind="Frame",
+# index=12, name="Imp attack". 'name' is None if not present.
+SectionStart = collections.namedtuple(
+	"SectionStart", ("kind", "index", "name", "lineno"))
+
+# "deh_name = value" within a section. 'value' is an integer.
+FieldAssign = collections.namedtuple(
+	"FieldAssign", ("deh_name", "value", "lineno"))
+
+# "Codep Frame = frame" within "Pointer ptr" section.
+PointerAssign = collections.namedtuple(
+	"PointerAssign", ("ptr", "frame", "lineno"))
+
+# Text section replacing the string 'old' with 'new'.
+TextReplace = collections.namedtuple(
+	"TextReplace", ("old", "new", "lineno"))
+
+# Top-level "deh_name = value" assignment. 'value' is a string.
+PropertyAssign = collections.namedtuple(
+	"PropertyAssign", ("deh_name", "value", "lineno"))
+
+# Part of the file that could not be parsed. These events are only
+# generated when not in strict mode (in strict mode an exception is raised
+# instead).
+ParseWarning = collections.namedtuple(
+	"ParseWarning", ("filename", "lineno", "message"))
 
 class DehackedParseException(Exception):
 	"""An error caused by a failure to parse a Dehacked file."""
@@ -42,38 +117,89 @@ class DehackedParseException(Exception):
 		return "%s:%d: %s" % (self.filename, self.lineno, self.message)
 
 class DehackedInputStream(object):
-	"""Wrapper around an I/O stream for reading Dehacked files."""
+	"""Wrapper around an I/O stream for reading Dehacked files.
+
+	Input is read from the stream in large chunks into a buffer, and
+	lines and Text payloads are then sliced straight out of the buffer
+	rather than being read from the stream a character at a time.
+	"""
 	def __init__(self, stream):
+		self.name = getattr(stream, "name", "<input>")
 		self.stream = stream
+		self.data = ""
+		self.pos = 0
+		self.eof = False
 		self.lineno = 0
 
+	def _fill(self):
+		"""Read another chunk of input into the buffer.
+
+		Data before the current position has been consumed already,
+		so it is discarded.
+		"""
+		chunk = self.stream.read(CHUNK_SIZE)
+		if not chunk:
+			self.eof = True
+		# Support DOS text file format; but skip the (slow) replace
+		# for the common case of a file with Unix line endings. A
+		# chunk ending in the middle of a CRLF pair is completed
+		# first, so that the pair isn't split in two.
+		elif "\r" in chunk:
+			if chunk.endswith("\r"):
+				chunk += self.stream.read(1)
+			chunk = chunk.replace("\r\n", "\n")
+		self.data = self.data[self.pos:] + chunk
+		self.pos = 0
+
 	def read(self, nbytes):
 		"""Read the specified number of bytes from the input."""
-		result = ''
-		while len(result) < nbytes:
-			c = self.stream.read(1)
-			# Strip out \r\n - support DOS text file format.
-			if c == '\r':
-				continue
-			if c == '\n':
-				self.lineno += 1
-			result += c
+		while len(self.data) - self.pos < nbytes and not self.eof:
+			self._fill()
+		data, start = self.data, self.pos
+		end = start + nbytes
+		result = data[start:end]
+		# Any stray carriage returns are stripped out, and don't
+		# count towards the number of bytes read.
+		while "\r" in result:
+			result = result.replace("\r", "")
+			while len(result) < nbytes:
+				if end >= len(data):
+					if self.eof:
+						break
+					self.pos = end
+					self._fill()
+					data, end = self.data, 0
+				more = data[end:end + nbytes - len(result)]
+				end += len(more)
+				result += more
+		self.pos = end
+		self.lineno += result.count("\n")
+		if len(result) < nbytes:
+			self.exception("unexpected end of file reading %d "
+			               "bytes" % nbytes)
 		return result
 
 	def readline(self):
 		"""Read a line from input stream, stripping out comments."""
 		while True:
-			line = self.stream.readline()
-			if line == "":
-				break
+			data, start = self.data, self.pos
+			end = data.find("\n", start) + 1
+			if end == 0:
+				if not self.eof:
+					self._fill()
+					continue
+				if start >= len(data):
+					return ""
+				end = len(data)
+			self.pos = end
 			self.lineno += 1
-			if not COMMENT_LINE_RE.match(line):
-				break
-		return line
+			line = data[start:end]
+			if "#" not in line or not COMMENT_LINE_RE.match(line):
+				return line
 
 	def exception(self, message):
 		raise DehackedParseException(
-			self.stream.name,
+			self.name,
 			self.lineno,
 			message,
 		)
@@ -82,8 +208,8 @@ class TopLevelProperty(object):
 	"""Helper class that is used to parse top-level "fields".
 
 	This class implements the section protocol described above, but only
-	parses a single line and uses the value to set a single property of an
-	object.
+	accepts PropertyAssign events for a single property name, and uses the
+	value to set a single property of an object.
 	"""
 	def __init__(self, deh_name, obj, propname, converter=None):
 		self.deh_name = deh_name
@@ -91,12 +217,23 @@ class TopLevelProperty(object):
 		self.propname = propname
 		self.converter = converter or (lambda x: x)
 
-	def header_regexp(self):
-		return re.compile(r"\s*%s\s*=\s*(?P<value>.*\S)\s*$" % (
-			self.deh_name), re.I)
+	def header_keyword(self):
+		return self.deh_name
+
+	def apply_event(self, event):
+		if not isinstance(event, PropertyAssign):
+			raise ValueError("syntax not recognized")
+		setattr(self.obj, self.propname, self.converter(event.value))
 
-	def parse_section(self, stream, value):
-		setattr(self.obj, self.propname, self.converter(value))
+def _open_source(source):
+	"""Returns (stream, close) for the given event source."""
+	if isinstance(source, bytes):
+		return io.TextIOWrapper(io.BytesIO(source)), True
+	if source == "-":
+		return sys.stdin, False
+	if isinstance(source, (str, os.PathLike)):
+		return open(source, "r"), True
+	return source, False
 
 def _read_header(stream):
 	line = stream.readline()
@@ -104,45 +241,194 @@ def _read_header(stream):
 		stream.exception("dehacked file must start with the line "
 		                 "%r" % HEADER_LINES[0])
 
-def _parse_line(sections, stream, line):
-	if line.strip() == "":
-		return
-	for regex, obj in sections:
-		m = regex.match(line)
-		if m:
-			params = m.groupdict()
-			obj.parse_section(stream, **params)
-			break
-	else:
-		stream.exception("syntax not recognized: %r" % line.rstrip())
+def _section_line_event(stream, line, kind, index):
+	m = FIELD_ASSIGNMENT_RE.match(line)
+	if not m:
+		stream.exception("parse error: %r" % line)
+	deh_name, value = m.group("deh_name", "value")
+	if kind == "pointer" and deh_name == POINTER_FIELD_NAME:
+		return PointerAssign(index, int(value), stream.lineno)
+	return FieldAssign(deh_name, int(value), stream.lineno)
+
+def _top_level_event(stream, line):
+	lineno = stream.lineno
+	m = TEXT_HEADER_RE.match(line)
+	if m:
+		from_len, to_len = m.group("from_len", "to_len")
+		old = stream.read(int(from_len))
+		new = stream.read(int(to_len))
+		return TextReplace(old, new, lineno)
+	m = SECTION_HEADER_RE.match(line)
+	if m:
+		kind, index, name = m.group("kind", "index", "name")
+		return SectionStart(kind, int(index), name, lineno)
+	m = PROPERTY_ASSIGNMENT_RE.match(line)
+	if m:
+		return PropertyAssign(m.group("deh_name"), m.group("value"),
+		                      lineno)
+	stream.exception("syntax not recognized: %r" % line.rstrip())
 
-def _parse_stream(sections, stream, strict_mode):
+def _iter_stream_events(stream, strict_mode):
 	_read_header(stream)
-	warnings = []
+	section = None
 	while True:
 		line = stream.readline()
 		if line == "":
 			break
+		if line.strip() == "":
+			# A blank line ends the current section.
+			section = None
+			continue
 		try:
-			_parse_line(sections, stream, line)
+			if section is not None:
+				yield _section_line_event(
+					stream, line, *section)
+				continue
+			event = _top_level_event(stream, line)
+			if isinstance(event, SectionStart):
+				section = (event.kind.lower(), event.index)
+			yield event
 		except DehackedParseException as e:
 			if strict_mode:
 				raise
-			warnings.append(repr(e))
+			# Skip the rest of a broken section.
+			section = None
+			yield ParseWarning(e.filename, e.lineno, e.message)
 
-	if not strict_mode and warnings:
-		print("Warnings loading dehacked file:", file=sys.stderr)
-		for w in warnings:
-			print(w, file=sys.stderr)
+def iter_dehacked_events(source, strict_mode=False):
+	"""Generate a stream of events by parsing a dehacked file.
 
-def parse_dehacked_file(filename, objects, strict_mode=False):
-	"""Load a dehacked file from the given filename.
+	'source' can be a filename, an open file object, the contents of a
+	file as bytes, or "-" to read from stdin. The file is read a chunk
+	at a time as the events are consumed.
 
-	'objects' is a list of objects which are expected to conform to the
-	protocol described above.
+	In strict mode, a DehackedParseException is raised on the first
+	error in the file; otherwise a ParseWarning event is generated and
+	parsing continues with the next line.
 	"""
-	sections = [(o.header_regexp(), o) for o in objects]
-	with open(filename, "r") as f:
+	f, close = _open_source(source)
+	try:
 		stream = DehackedInputStream(f)
-		_parse_stream(sections, stream, strict_mode)
+		for event in _iter_stream_events(stream, strict_mode):
+			yield event
+	finally:
+		if close:
+			f.close()
+
+def apply_events(events, objects, filename="<input>", strict_mode=False):
+	"""Apply a stream of events to a list of section objects.
+
+	'objects' is a list of objects which are expected to conform to the
+	protocol described above. In strict mode a DehackedParseException is
+	raised if an event cannot be applied; otherwise a list of warnings
+	(which includes any ParseWarning events) is returned.
+	"""
+	by_keyword = {}
+	for obj in objects:
+		by_keyword[obj.header_keyword().lower()] = obj
+	warnings = []
+	target = None
+	for event in events:
+		try:
+			if isinstance(event, ParseWarning):
+				target = None
+				warnings.append(repr(DehackedParseException(
+					*event)))
+				continue
+			if isinstance(event, (FieldAssign, PointerAssign)):
+				if target is None:
+					raise ValueError("assignment outside "
+					                 "of a section")
+				target.apply_event(event)
+				continue
+			target = None
+			if isinstance(event, SectionStart):
+				keyword = event.kind
+			elif isinstance(event, TextReplace):
+				keyword = "Text"
+			else:
+				keyword = event.deh_name
+			obj = by_keyword.get(keyword.lower())
+			if obj is None:
+				raise ValueError("syntax not recognized: "
+				                 "%r" % (keyword,))
+			result = obj.apply_event(event)
+			if isinstance(event, SectionStart):
+				target = result
+		except ValueError as e:
+			target = None
+			exc = DehackedParseException(
+				filename, event.lineno, str(e))
+			if strict_mode:
+				raise exc
+			warnings.append(repr(exc))
+	return warnings
+
+def parse_dehacked_file(source, objects, strict_mode=False, warnings=None):
+	"""Load a dehacked file from the given source.
+
+	'source' is anything accepted by iter_dehacked_events(), and
+	'objects' is a list of objects which are expected to conform to the
+	protocol described above. Warnings are printed to stderr, unless a
+	'warnings' list is given, in which case they are appended to it.
+	"""
+	filename = getattr(source, "name", source)
+	if not isinstance(filename, str):
+		filename = "<input>"
+	result = apply_events(
+		iter_dehacked_events(source, strict_mode=strict_mode),
+		objects, filename=filename, strict_mode=strict_mode)
+
+	if warnings is not None:
+		warnings.extend(result)
+	elif result:
+		print("Warnings loading dehacked file:", file=sys.stderr)
+		for w in result:
+			print(w, file=sys.stderr)
+
+class TestEvents(unittest.TestCase):
+	PATCH = (b"Patch File for DeHackEd64\r\n"
+	         b"Doom version = 19\r\n"
+	         b"\r\n"
+	         b"# A comment\r\n"
+	         b"Thing 1 (Zombieman)\r\n"
+	         b"Hit points = 30\r\n"
+	         b"\r\n"
+	         b"Pointer 3 (Frame 9)\r\n"
+	         b"Codep Frame = 12\r\n"
+	         b"\r\n"
+	         b"Text 3 4\r\n"
+	         b"fooquux\r\n")
+
+	def test_events(self):
+		self.assertEqual(list(iter_dehacked_events(self.PATCH)), [
+			PropertyAssign("Doom version", "19", 2),
+			SectionStart("Thing", 1, "Zombieman", 5),
+			FieldAssign("Hit points", 30, 6),
+			SectionStart("Pointer", 3, "Frame 9", 8),
+			PointerAssign(3, 12, 9),
+			TextReplace("foo", "quux", 11),
+		])
+
+	def test_small_chunks(self):
+		global CHUNK_SIZE
+		old_size, CHUNK_SIZE = CHUNK_SIZE, 3
+		try:
+			events = list(iter_dehacked_events(self.PATCH))
+		finally:
+			CHUNK_SIZE = old_size
+		self.assertEqual(events,
+		                 list(iter_dehacked_events(self.PATCH)))
+
+	def test_errors(self):
+		patch = self.PATCH + b"Bogus line\n"
+		events = list(iter_dehacked_events(patch))
+		self.assertEqual(events[-1],
+		                 ParseWarning("<input>", 13,
+		                              "syntax not recognized: "
+		                              "'Bogus line'"))
+		with self.assertRaises(DehackedParseException):
+			list(iter_dehacked_events(patch, strict_mode=True))
 
+if __name__ == "__main__":
+	unittest.main()
@@ -3,19 +3,27 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import concurrent.futures
 import copy
+import glob
+import os
 import unittest
 
+from deh9000 import c
+from deh9000 import compact
+from deh9000 import dedup
 from deh9000 import deh_parser
 from deh9000 import interactive
+from deh9000 import states_parser
 from deh9000 import tables
-from deh9000.actions import A_FireCGun, A_FirePlasma
-from deh9000.mobjs import mobjinfo_t
-from deh9000.sprites import spritenum_t
+from deh9000.reachability import ReachabilityIndex
 from deh9000.states import *
 from deh9000.states_array import CodePointers, StatesArray
 from deh9000.string_repls import StringReplacements
-from deh9000.weapons import weaponinfo_t
+
+# Pristine StringReplacements that new DehackedFiles are copied from;
+# created on first use by _base_strings().
+_BASE_STRINGS = None
 
 DEHACKED_HEADER_FORMAT = """
 Patch File for DeHackEd64
@@ -28,6 +36,13 @@ Patch format = %(patch_format)s
 """
 
 
+def _base_strings():
+    global _BASE_STRINGS
+    if _BASE_STRINGS is None:
+        _BASE_STRINGS = StringReplacements()
+    return _BASE_STRINGS
+
+
 class DehackedFile(object):
     """Class that represents an entire dehacked file.
 
@@ -57,36 +72,74 @@ class DehackedFile(object):
 	  file = deh9000.DehackedFile()
 	  file.load_from_module(modified_tables)
 
+	A new DehackedFile is a sparse overlay on the tables in tables.py:
+	the table copies share their storage with the originals until they
+	are written to, so creating a file is cheap and its memory cost is
+	proportional to the changes made. Variants of a file can be made the
+	same way with fork():
+
+	  base = deh9000.DehackedFile()
+	  base.mobjinfo[deh9000.MT_POSSESSED1].spawnhealth *= 2
+	  for speed in range(10, 20):
+	      variant = base.fork()
+	      variant.mobjinfo[deh9000.MT_POSSESSED1].speed = speed
+	      variant.save("speed%d.deh" % speed)
+
 	"""
     TABLE_MODULE_VARS = ("ammodata", "miscdata", "mobjinfo", "states", "weaponinfo")
 
     def __init__(self, module=None, base_module=tables):
-        # Build up a list of "parts", by copying the tables from
-        # tables.py to use as a base. We make copies of the tables so
-        # that each DehackedFile has its own independently mutable
-        # version.
+        # Copy the tables from tables.py to use as a base. The copies
+        # share storage with the originals until written, so each
+        # DehackedFile has its own independently mutable version
+        # without paying for a full copy of every table.
+        self._set_parts(
+            [copy.copy(getattr(base_module, name))
+             for name in DehackedFile.TABLE_MODULE_VARS],
+            copy.copy(_base_strings()))
+
+        if module is not None:
+            self.load_from_module(module)
+
+        self.doom_version = 19
+        self.patch_format = 6
+
+    def _set_parts(self, tables, strings):
+        # Build up the list of "parts" from the given table copies.
         self.parts = []
-        for name in DehackedFile.TABLE_MODULE_VARS:
-            obj = copy.copy(getattr(base_module, name))
+        for name, obj in zip(DehackedFile.TABLE_MODULE_VARS, tables):
             self.parts.append(obj)
             setattr(self, name, obj)
 
-        self.strings = StringReplacements()
+        self.strings = strings
         self.sprnames = self.strings.sprnames
 
         # Set a couple of hooks in the states array which make the API
         # for DECORATE-format parsing a bit nicer.
         self.states.get_alloc_states = self.free_states
+        self._reachability = None
         self.states.assign_sprites = self.assign_sprites
 
-        if module is not None:
-            self.load_from_module(module)
-
         self.parts.append(CodePointers(self.states))
         self.parts.append(self.strings)
 
-        self.doom_version = 19
-        self.patch_format = 6
+    def fork(self):
+        """Returns a new DehackedFile that is a copy of this one.
+
+		The new file starts with all the changes made to this file so
+		far, and the two can then be changed independently. Like a new
+		DehackedFile, the fork shares storage with this file until
+		either is written to, so forking costs time proportional to
+		the number of modified rows rather than the size of the tables.
+		"""
+        result = DehackedFile.__new__(DehackedFile)
+        result._set_parts(
+            [copy.copy(getattr(self, name))
+             for name in DehackedFile.TABLE_MODULE_VARS],
+            copy.copy(self.strings))
+        result.doom_version = self.doom_version
+        result.patch_format = self.patch_format
+        return result
 
     def load_from_module(self, module):
         """Load tables from the given module.
@@ -99,6 +152,35 @@ class DehackedFile(object):
             table = getattr(module, name)
             part.copy_from(table)
 
+    def changed_rows(self):
+        """Returns a dict describing what has been changed in this file.
+
+		Keys are table names (eg. "states") and values are sorted lists
+		of the indexes of rows that have been written. Replaced strings
+		are listed under "strings". Tables with no changes are omitted.
+		This is read from the change journals and does not need to scan
+		the tables.
+		"""
+        result = {}
+        for name in DehackedFile.TABLE_MODULE_VARS:
+            part = getattr(self, name)
+            if isinstance(part, c.Struct):
+                rows = sorted(part._store.dirty)
+            else:
+                rows = part.changed_rows()
+            if rows:
+                result[name] = rows
+        keys = self.strings.changed_keys()
+        if keys:
+            result["strings"] = keys
+        return result
+
+    def reset_to_original(self):
+        """Undo all changes, restoring every table to its original."""
+        for name in DehackedFile.TABLE_MODULE_VARS:
+            getattr(self, name).reset_to_original()
+        self.strings.reset_to_original()
+
     def dehacked_header(self):
         return DEHACKED_HEADER_FORMAT.strip() % {
             'doom_version': self.doom_version,
@@ -107,25 +189,11 @@ class DehackedFile(object):
 
     def mobj_states(self, mobj_id):
         """Returns a set of all states used by the given mobj."""
-        states = self.states
-        mobjinfo = self.mobjinfo
-        mobj = mobjinfo[mobj_id]
-        result = set()
-        for field in mobjinfo_t.state_fields:
-            state_id = getattr(mobj, field)
-            result |= set(states.walk(state_id))
-        return c.EnumSet(statenum_t, result)
+        return self.reachability().mobj_states(mobj_id)
 
     def weapon_states(self, weapon_id):
         """Returns a set of all states used by the given weapon."""
-        states = self.states
-        weaponinfo = self.weaponinfo
-        weapon = weaponinfo[weapon_id]
-        result = set()
-        for field in weaponinfo_t.state_fields:
-            state_id = getattr(weapon, field)
-            result |= set(states.walk(state_id))
-        return c.EnumSet(statenum_t, result)
+        return self.reachability().weapon_states(weapon_id)
 
     def _run_reclaim(self, callback, strategies, avoid_strategies):
         last_strategy = "(start)"
@@ -150,45 +218,62 @@ class DehackedFile(object):
         # Ran out of strategies; did we achieve the goal?
         return callback(last_strategy)
 
+    def reachability(self):
+        """Get the ReachabilityIndex of states and sprites in use.
+
+		The index is built the first time this is called, and from
+		then on is kept up to date as the tables are changed.
+		"""
+        if self._reachability is None:
+            self._reachability = ReachabilityIndex(
+                self.states, self.mobjinfo, self.weaponinfo)
+        return self._reachability
+
     def free_states(self):
         """Returns a set of the indexes of all unreferenced states."""
-        marked = {0}
-        states = self.states
-        # Mark all chains beginning from the hard-coded states. These
-        # are states which are referenced directly in the source code.
-        for state_id in set(StatesArray.HARDCODED_STATES):
-            marked |= set(states.walk(state_id))
-        # Add all states used by mobjs (referenced from mobjinfo).
-        for mobj_id in range(len(self.mobjinfo)):
-            marked |= self.mobj_states(mobj_id)
-        # Add all weapon states (referenced from weaponinfo).
-        for weapon_id, weapon in enumerate(self.weaponinfo):
-            weaponstates = self.weapon_states(weapon_id)
-            marked |= weaponstates
-            # There is a special case - if any of the states used
-            # by this weapon invoke A_FirePlasma or A_FireCGun,
-            # they can jump to weapon.flashstate+1, so we must mark
-            # this state any others that follow it.
-            actions = {states[sid].action for sid in weaponstates}
-            if A_FirePlasma in actions or A_FireCGun in actions:
-                second_state_id = weapon.flashstate + 1
-                marked |= set(states.walk(second_state_id))
-        # Make a set with all state numbers. What's not marked?
-        allstates = set(range(len(states)))
-        return c.EnumSet(statenum_t, allstates.difference(marked))
+        return self.reachability().free_states()
 
     def free_sprites(self):
         """Returns a set of indexes of unused sprites."""
-        # Iterate over all non-free states and mark sprite numbers.
-        free_states = self.free_states()
-        used_sprites = set()
-        for state_id, state in enumerate(self.states):
-            if state_id not in free_states:
-                used_sprites.add(state.sprite)
-        # Make a set of all sprite numbers. What's not marked?
-        allsprites = set(range(len(spritenum_t)))
-        return c.EnumSet(spritenum_t,
-                         allsprites.difference(used_sprites))
+        return self.reachability().free_sprite_ids()
+
+    def parse_many(self, defstrs, workers=None):
+        """Parse many lists of states in DECORATE format at once.
+
+		'defstrs' is a dictionary mapping targets (eg. mobj numbers)
+		to strings to parse. This works like calling states.parse()
+		for each, but finds free states and sprites only once and
+		plans where all of the states go together, and either all of
+		them are parsed or nothing is changed. Returned is a
+		dictionary mapping each target to its labels dictionary. See
+		StatesArray.parse_many().
+		"""
+        return self.states.parse_many(defstrs, workers=workers)
+
+    def dedup_states(self):
+        """Merge identical chains of states to free up states.
+
+		States in use that behave identically (same fields, followed
+		by identical states) are merged into one, and references to
+		them from mobjinfo, weaponinfo and other states are rewritten.
+		Only states changed by this file are merged away, and original
+		rows are never rewritten. States hard-coded into the Doom
+		source are never merged away. Returned is a dictionary mapping each state merged away to
+		the state that replaced it; see dedup.py.
+		"""
+        return dedup.dedup_states(self)
+
+    def compact_states(self, fixed=()):
+        """Renumber modified states so each actor's are contiguous.
+
+		States with action pointers are only moved to states where
+		the pointer can be set in a Vanilla patch, and states that
+		are hard-coded into the Doom source, unmodified or in 'fixed'
+		stay where they are. Unreferenced states are reset to their
+		original values. Returned is a dictionary mapping the old ID
+		of each state moved to its new ID; see compact.py.
+		"""
+        return compact.compact_states(self, fixed)
 
     def assign_sprites(self, spritenames):
         """Ensure that the given sprite names are in sprnames.
@@ -199,13 +284,14 @@ class DehackedFile(object):
 		names requested.
 		"""
         spritenames = [s.upper() for s in spritenames]
+        wanted = set(spritenames)
         free_sprite_ids = self.free_sprites()
         # There is a subset of free_sprite_ids we can use, because
         # there is a corner case where a sprite is free but also in
         # the spritenames list we're trying to assign.
         have_ids = {spr_id for spr_id in free_sprite_ids
-                    if self.sprnames[spr_id] not in spritenames}
-        need = {name for name in spritenames
+                    if self.sprnames[spr_id] not in wanted}
+        need = {name for name in wanted
                 if name not in self.sprnames}
         if len(need) > len(have_ids):
             raise OverflowError(
@@ -248,16 +334,60 @@ class DehackedFile(object):
         with open(filename, "w") as f:
             f.write(result_text)
 
-    def load(self, filename, strict_mode=False):
-        """Load a Dehacked file from the given filename."""
-        deh_parser.parse_dehacked_file(filename, self.parts + [
+    def load(self, source, strict_mode=False, warnings=None, cache=None):
+        """Load a Dehacked file.
+
+		'source' is a filename, or anything else accepted by
+		deh_parser.iter_dehacked_events() (a file object, the file
+		contents as bytes, or "-" for stdin). Warnings are printed to
+		stderr unless a list is passed as 'warnings' to collect them.
+		A cache.ParseCache can be given to reuse the results of
+		previously parsing the same file contents.
+		"""
+        if cache is not None:
+            cache.load(self, source, strict_mode=strict_mode,
+                       warnings=warnings)
+            return
+        deh_parser.parse_dehacked_file(source, self.parts + [
             deh_parser.TopLevelProperty(
                 "Doom version", self, "doom_version", int,
             ),
             deh_parser.TopLevelProperty(
                 "Patch format", self, "patch_format", int,
             ),
-        ], strict_mode=strict_mode)
+        ], strict_mode=strict_mode, warnings=warnings)
+
+    def delta(self):
+        """Get a compact record of all changes made to the file.
+
+		The delta is built from the change journals and holds only
+		plain tuples, ints and strings, so it is much smaller and
+		faster to pickle than the file itself. apply_delta() replays
+		it onto another file.
+		"""
+        return (
+            self.doom_version,
+            self.patch_format,
+            tuple(getattr(self, name).delta()
+                  for name in DehackedFile.TABLE_MODULE_VARS),
+            self.strings.delta(),
+        )
+
+    def apply_delta(self, delta):
+        """Apply changes recorded by delta() to this file.
+
+		Header fields that are None in the delta (see cache.py) are left
+		as they are.
+		"""
+        doom_version, patch_format, tables, strings = delta
+        if doom_version is not None:
+            self.doom_version = doom_version
+        if patch_format is not None:
+            self.patch_format = patch_format
+        for name, table_delta in zip(DehackedFile.TABLE_MODULE_VARS,
+                                     tables):
+            getattr(self, name).apply_delta(table_delta)
+        self.strings.apply_delta(strings)
 
     def interactive(self, args=None, level=None):
         """Start a source port testing this dehacked file.
@@ -271,5 +401,167 @@ class DehackedFile(object):
         interactive.start_interactive(self, args=args, level=level)
 
 
+
+def _load_delta(filename, strict_mode):
+    # Runs in a load_many() worker process.
+    warnings = []
+    dehfile = DehackedFile()
+    dehfile.load(filename, strict_mode=strict_mode, warnings=warnings)
+    return dehfile.delta(), warnings
+
+
+def load_many(filenames, workers=None, strict_mode=False):
+    """Load many Dehacked files in parallel using a pool of processes.
+
+	Files are parsed in worker processes, which send back a compact
+	delta of each file (see DehackedFile.delta()) rather than the file
+	itself. This is a generator that yields (filename, dehfile,
+	warnings) tuples in the order that files finish loading, where
+	'warnings' is the list of warnings from loading the file. If
+	'workers' is not given, one worker is used per CPU.
+
+	A file that fails to load does not stop the others: it is yielded
+	as (filename, None, [error]), where 'error' is the exception that
+	was raised loading it (eg. OSError or DehackedParseException).
+	Files that have not started loading are cancelled if the generator
+	is closed early.
+	"""
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = {
+            executor.submit(_load_delta, filename, strict_mode): filename
+            for filename in filenames
+        }
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                filename = futures.pop(future)
+                try:
+                    delta, warnings = future.result()
+                except Exception as e:
+                    yield filename, None, [e]
+                    continue
+                dehfile = DehackedFile()
+                dehfile.apply_delta(delta)
+                yield filename, dehfile, warnings
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+class TestDehackedFile(unittest.TestCase):
+
+    def test_changed_rows(self):
+        dehfile = DehackedFile()
+        self.assertEqual(dehfile.changed_rows(), {})
+        dehfile.states[S_PISTOL].tics = 99
+        dehfile.mobjinfo[3].speed = dehfile.mobjinfo[3].speed
+        dehfile.strings.sprnames[0] = "XXXX"
+        self.assertEqual(dehfile.changed_rows(), {
+            "states": [S_PISTOL],
+            "mobjinfo": [3],
+            "strings": ["SPOT"],
+        })
+        # Rewriting the original value is still journaled, but
+        # doesn't produce a diff:
+        self.assertEqual(len(dehfile.dehacked_diffs()), 3)
+
+    def test_reset_to_original(self):
+        dehfile = DehackedFile()
+        dehfile.states[S_PISTOL].tics = 99
+        dehfile.states[S_PISTOL].action = None
+        dehfile.miscdata.max_health = 1
+        dehfile.strings["foo"] = "bar"
+        dehfile.states.reset_to_original(rows=[S_PISTOL])
+        self.assertEqual(dehfile.states[S_PISTOL].tics, 1)
+        self.assertEqual(set(dehfile.changed_rows()),
+                         {"miscdata", "strings"})
+        dehfile.reset_to_original()
+        self.assertEqual(dehfile.changed_rows(), {})
+        self.assertEqual(dehfile.dehacked_diffs()[1:],
+                         ["# No difference was found!"])
+
+    def test_fork(self):
+        base = DehackedFile()
+        base.states[S_PISTOL].tics = 5
+        fork = base.fork()
+        fork.states[S_PISTOL + 1].tics = 7
+        fork.strings["foo"] = "bar"
+        base.states[S_PISTOL].tics = 6
+        self.assertEqual(fork.states[S_PISTOL].tics, 5)
+        self.assertEqual(base.states[S_PISTOL + 1].tics,
+                         tables.states[S_PISTOL + 1].tics)
+        self.assertNotIn("foo", base.strings)
+        self.assertEqual(fork.changed_rows(), {
+            "states": [S_PISTOL, S_PISTOL + 1],
+            "strings": ["foo"],
+        })
+        # Neither file has changed the shared base tables:
+        self.assertEqual(tables.states[S_PISTOL].tics, 1)
+
+    def test_delta(self):
+        dehfile = DehackedFile()
+        dehfile.doom_version = 21
+        dehfile.states[S_PISTOL].tics = 99
+        dehfile.states[S_PISTOL].action = None
+        dehfile.mobjinfo[3].object_name = "Imp"
+        dehfile.mobjinfo[3].speed = 5
+        dehfile.miscdata.max_health = 1
+        dehfile.strings["foo"] = "bar"
+        other = DehackedFile()
+        other.apply_delta(dehfile.delta())
+        self.assertEqual(other.dehacked_diffs(),
+                         dehfile.dehacked_diffs())
+        self.assertEqual(other.changed_rows(), dehfile.changed_rows())
+        self.assertEqual(other.mobjinfo[3].object_name, "Imp")
+
+    def test_load_many(self):
+        paths = sorted(glob.glob(os.path.join(
+            os.path.dirname(__file__), "examples", "deh_files", "*.deh")))
+        results = list(load_many(paths, workers=2))
+        self.assertEqual(sorted(r[0] for r in results), paths)
+        for path, dehfile, warnings in results:
+            expected = DehackedFile()
+            expected.load(path, warnings=[])
+            self.assertEqual(dehfile.dehacked_diffs(),
+                             expected.dehacked_diffs())
+
+        # A file that fails to load is reported on its own:
+        missing = os.path.join(os.path.dirname(__file__), "missing.deh")
+        results = dict((r[0], r[1:]) for r in load_many(
+            [missing] + paths[:2], workers=2))
+        self.assertEqual(sorted(results), sorted([missing] + paths[:2]))
+        dehfile, warnings = results.pop(missing)
+        self.assertIsNone(dehfile)
+        self.assertIsInstance(warnings[0], OSError)
+        for dehfile, warnings in results.values():
+            self.assertIsNotNone(dehfile)
+
+    def test_parse_many(self):
+        dehfile = DehackedFile()
+        for mobj in dehfile.mobjinfo:
+            mobj.clear_states()
+        defstrs = {
+            1: "Spawn:\nZZZZ AB 5 A_Look\nLoop",
+            2: "Pin(S_TROO_STND): Spawn:\nTROO A 5\nZZZZ C 5 A_Chase\n"
+               "Loop",
+        }
+        labels = dehfile.parse_many(defstrs)
+        self.assertEqual(labels[2]["Spawn"], S_TROO_STND)
+        for mobj_id in (1, 2):
+            dehfile.mobjinfo[mobj_id].spawnstate = labels[mobj_id]["Spawn"]
+        self.assertFalse(dehfile.mobj_states(1) & dehfile.mobj_states(2))
+        sprite = dehfile.sprnames.index("ZZZZ")
+        self.assertEqual(
+            dehfile.states[labels[1]["Spawn"]].sprite, sprite)
+
+        # Nothing changes if the states can't all be allocated:
+        changed = dehfile.changed_rows()
+        free = dehfile.states.allocator().free_states()
+        with self.assertRaises(states_parser.StateRemapException):
+            dehfile.parse_many({1: "Pin(S_SARG_STND): TROO A -1\nStop",
+                                2: "Pin(S_SARG_STND): TROO B -1\nStop"})
+        self.assertEqual(dehfile.changed_rows(), changed)
+        self.assertEqual(dehfile.states.allocator().free_states(), free)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -43,9 +43,16 @@ class mobjinfo_t(c.Struct):
     activesound = c.StructField("Action sound")
     flags = c.StructField("Bits")
 
+    # Doom64-specific fields. These are present in the tables but
+    # Dehacked64 patches cannot change them, so they have no name.
+    palette = c.StructField(None)
+    alpha = c.StructField(None)
+    raisestate = c.StructField(None)
+
     # Which fields are references to entries in the states table?
     state_fields = ("spawnstate", "seestate", "painstate", "meleestate",
-                    "missilestate", "deathstate", "xdeathstate")
+                    "missilestate", "deathstate", "xdeathstate",
+                    "raisestate")
     # Which fields are references to entries in the S_sfx table?
     sound_fields = ("seesound", "attacksound", "painsound", "deathsound",
                     "activesound")
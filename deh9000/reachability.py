@@ -0,0 +1,324 @@
+"""Incrementally maintained index of the states and sprites in use.
+
+A state is in use if it can be reached by following the chain of states
+(see StatesArray.walk()) from one of the "roots" that reference states:
+
+ * The states hard-coded into the Doom source (StatesArray.HARDCODED_STATES).
+ * The state_fields of every mobjinfo_t and weaponinfo_t.
+ * weapon.flashstate + 1, for weapons that use A_FirePlasma or A_FireCGun,
+   as those action pointers can jump to it.
+
+A sprite is in use if any state in use (or the null state) shows it.
+
+Rather than finding these by walking every chain from scratch each time,
+ReachabilityIndex keeps a reference count for each state: the number of
+distinct root entry states whose chain includes it. It watches the tables
+for writes, and when a root field changes only the chains of the old and
+new entry states are updated; when the nextstate or tics of a state change,
+only the chains passing through that state are walked again. Queries for
+whether a state or sprite is free are then simple lookups.
+"""
+
+from __future__ import absolute_import
+
+import unittest
+
+from deh9000 import c
+from deh9000.actions import A_FireCGun, A_FirePlasma
+from deh9000.mobjs import mobjinfo_t
+from deh9000.sprites import spritenum_t
+from deh9000.states import *
+from deh9000.states_array import StatesArray
+from deh9000.weapons import weaponinfo_t, wp_chaingun
+
+# Actions which jump to the weapon's flashstate + 1.
+FLASH_ACTIONS = (A_FirePlasma, A_FireCGun)
+
+class ReachabilityIndex(object):
+	"""Index of the states and sprites in use by a DehackedFile.
+
+	The index is built once, and is then kept up to date by watching
+	writes to the states, mobjinfo and weaponinfo tables.
+	"""
+	def __init__(self, states, mobjinfo, weaponinfo):
+		self.states = states
+		self.mobjinfo = mobjinfo
+		self.weaponinfo = weaponinfo
+		self._state_bits = state_t.nextstate.bit | state_t.tics.bit
+		self._flash_actions = {
+			state_t.action.registry.index(a)
+			for a in FLASH_ACTIONS}
+		self._mobj_bits = 0
+		for f in mobjinfo_t.state_fields:
+			self._mobj_bits |= getattr(mobjinfo_t, f).bit
+		self._weapon_bits = 0
+		for f in weaponinfo_t.state_fields:
+			self._weapon_bits |= getattr(weaponinfo_t, f).bit
+		self._build()
+		# The chains come from the states' graph, which _build() has
+		# created, so its watcher runs first and the graph is always
+		# up to date by the time _states_written() is called.
+		states._store.watchers.append(self._states_written)
+		mobjinfo._store.watchers.append(self._mobjinfo_written)
+		weaponinfo._store.watchers.append(self._weaponinfo_written)
+
+	def _build(self):
+		num_states = len(self.states)
+		# Number of root entries whose chain includes each state:
+		self.refcount = [0] * num_states
+		# The sprite that each state in use was counted against:
+		self.state_sprite = [0] * num_states
+		# Number of states in use showing each sprite:
+		self.sprite_refs = [0] * len(spritenum_t)
+		self.free = c.EnumSet.from_bits(
+			statenum_t, (1 << num_states) - 1)
+		self.free_sprites = c.EnumSet.from_bits(
+			spritenum_t, (1 << len(spritenum_t)) - 1)
+		# Root slots (eg. ("mobj", 3, "seestate")) mapped to the
+		# state they reference, and the number of slots referencing
+		# each entry state:
+		self.slots = {}
+		self.roots = {}
+		# Weapons which reference each entry state:
+		self.weapon_entries = {}
+		# Chain of states for each entry state, and the entry states
+		# whose chains include each state. chain_bits has the same
+		# chains as bitsets:
+		self.chains = {}
+		self.chain_bits = {}
+		self.containing = {}
+		# The null state is always in use.
+		self._incref(S_NULL)
+		for state_id in StatesArray.HARDCODED_STATES:
+			self._set_slot(("hard", state_id), state_id)
+		for mobj_id in range(len(self.mobjinfo)):
+			self._update_mobj(mobj_id)
+		for weapon_id in range(len(self.weaponinfo)):
+			self._update_weapon(weapon_id)
+
+	def _incref(self, state_id):
+		count = self.refcount[state_id]
+		self.refcount[state_id] = count + 1
+		if count == 0:
+			self.free.discard(state_id)
+			sprite = self.states._store.columns[
+				state_t.sprite.order][state_id]
+			self.state_sprite[state_id] = sprite
+			self._incref_sprite(sprite)
+
+	def _decref(self, state_id):
+		count = self.refcount[state_id] - 1
+		self.refcount[state_id] = count
+		if count == 0:
+			self.free.add(state_id)
+			self._decref_sprite(self.state_sprite[state_id])
+
+	def _incref_sprite(self, sprite):
+		if 0 <= sprite < len(self.sprite_refs):
+			self.sprite_refs[sprite] += 1
+			self.free_sprites.discard(sprite)
+
+	def _decref_sprite(self, sprite):
+		if 0 <= sprite < len(self.sprite_refs):
+			self.sprite_refs[sprite] -= 1
+			if self.sprite_refs[sprite] == 0:
+				self.free_sprites.add(sprite)
+
+	def _add_chain(self, entry):
+		graph = self.states.graph()
+		chain = graph.chain(entry)
+		self.chains[entry] = chain
+		self.chain_bits[entry] = graph.chain_bits(entry)
+		for state_id in chain:
+			self.containing.setdefault(state_id, set()).add(entry)
+			self._incref(state_id)
+
+	def _remove_chain(self, entry):
+		del self.chain_bits[entry]
+		for state_id in self.chains.pop(entry):
+			self.containing[state_id].discard(entry)
+			self._decref(state_id)
+
+	def _set_slot(self, slot, entry):
+		old = self.slots.get(slot)
+		if old == entry:
+			return
+		is_weapon = slot[0] == "weapon"
+		if old is not None:
+			del self.slots[slot]
+			if is_weapon:
+				self.weapon_entries[old].discard(slot[1])
+			count = self.roots[old] - 1
+			if count:
+				self.roots[old] = count
+			else:
+				del self.roots[old]
+				self._remove_chain(old)
+		if entry is not None:
+			self.slots[slot] = entry
+			if is_weapon:
+				self.weapon_entries.setdefault(
+					entry, set()).add(slot[1])
+			count = self.roots.get(entry, 0)
+			self.roots[entry] = count + 1
+			if count == 0:
+				self._add_chain(entry)
+
+	def _update_mobj(self, mobj_id):
+		mobj = self.mobjinfo[mobj_id]
+		for f in mobjinfo_t.state_fields:
+			self._set_slot(("mobj", mobj_id, f), getattr(mobj, f))
+
+	def _update_weapon(self, weapon_id):
+		weapon = self.weaponinfo[weapon_id]
+		for f in weaponinfo_t.state_fields:
+			self._set_slot(("weapon", weapon_id, f),
+			               getattr(weapon, f))
+		self._update_flash(weapon_id)
+
+	def _update_flash(self, weapon_id):
+		# The flashstate+1 rule: applies if any state used by the
+		# weapon has one of the FLASH_ACTIONS.
+		actions = self.states._store.columns[state_t.action.order]
+		weapon = self.weaponinfo[weapon_id]
+		entry = None
+		for f in weaponinfo_t.state_fields:
+			chain = self.chains[self.slots[
+				("weapon", weapon_id, f)]]
+			if any(actions[s] in self._flash_actions
+			       for s in chain):
+				entry = weapon.flashstate + 1
+				break
+		self._set_slot(("flash", weapon_id), entry)
+
+	def _states_written(self, index, bits):
+		if index is None:
+			self._build()
+			return
+		if bits & state_t.sprite.bit and self.refcount[index]:
+			sprite = self.states._store.columns[
+				state_t.sprite.order][index]
+			self._decref_sprite(self.state_sprite[index])
+			self.state_sprite[index] = sprite
+			self._incref_sprite(sprite)
+		entries = self.containing.get(index)
+		if not entries:
+			return
+		entries = set(entries)
+		if bits & self._state_bits:
+			for entry in entries:
+				self._add_chain_again(entry)
+		if bits & (self._state_bits | state_t.action.bit):
+			weapon_ids = set()
+			for entry in entries:
+				weapon_ids.update(
+					self.weapon_entries.get(entry, ()))
+			for weapon_id in weapon_ids:
+				self._update_flash(weapon_id)
+
+	def _add_chain_again(self, entry):
+		# The old chain is only removed after the new one has been
+		# added, so that states in both aren't briefly freed.
+		old_chain = self.chains.pop(entry)
+		del self.chain_bits[entry]
+		self._add_chain(entry)
+		new_chain = set(self.chains[entry])
+		for state_id in old_chain:
+			self._decref(state_id)
+			if state_id not in new_chain:
+				self.containing[state_id].discard(entry)
+
+	def _mobjinfo_written(self, index, bits):
+		if index is None:
+			self._build()
+		elif bits & self._mobj_bits:
+			self._update_mobj(index)
+
+	def _weaponinfo_written(self, index, bits):
+		if index is None:
+			self._build()
+		elif bits & self._weapon_bits:
+			self._update_weapon(index)
+
+	def is_state_free(self, state_id):
+		"""Returns True if the given state is not in use."""
+		return self.refcount[state_id] == 0
+
+	def is_sprite_free(self, sprite_id):
+		"""Returns True if the given sprite is not in use."""
+		return sprite_id in self.free_sprites
+
+	def free_states(self):
+		"""Returns an EnumSet of all states not in use."""
+		return self.free.copy()
+
+	def free_sprite_ids(self):
+		"""Returns an EnumSet of all sprites not in use."""
+		return self.free_sprites.copy()
+
+	def _slot_states(self, kind, index, fields):
+		bits = 0
+		for f in fields:
+			bits |= self.chain_bits[self.slots[(kind, index, f)]]
+		return c.EnumSet.from_bits(statenum_t, bits)
+
+	def mobj_states(self, mobj_id):
+		"""Returns an EnumSet of all states used by the given mobj."""
+		return self._slot_states("mobj", mobj_id,
+		                         mobjinfo_t.state_fields)
+
+	def weapon_states(self, weapon_id):
+		"""Returns an EnumSet of all states used by the given weapon."""
+		return self._slot_states("weapon", weapon_id,
+		                         weaponinfo_t.state_fields)
+
+
+class TestReachabilityIndex(unittest.TestCase):
+	def setUp(self):
+		from deh9000.file import DehackedFile
+		self.dehfile = DehackedFile()
+		self.index = self.dehfile.reachability()
+
+	def assertIndexCorrect(self):
+		fresh = ReachabilityIndex(self.dehfile.states,
+		                          self.dehfile.mobjinfo,
+		                          self.dehfile.weaponinfo)
+		self.assertEqual(self.index.free, fresh.free)
+		self.assertEqual(self.index.free_sprites, fresh.free_sprites)
+
+	def test_root_fields(self):
+		free = sorted(self.index.free)
+		state_id = free[0]
+		self.dehfile.states[state_id].nextstate = free[1]
+		self.assertTrue(self.index.is_state_free(state_id))
+		self.dehfile.mobjinfo[1].seestate = state_id
+		self.assertFalse(self.index.is_state_free(state_id))
+		self.assertFalse(self.index.is_state_free(free[1]))
+		self.assertIndexCorrect()
+		self.dehfile.mobjinfo[1].seestate = 0
+		self.assertTrue(self.index.is_state_free(free[1]))
+		self.assertIndexCorrect()
+
+	def test_chains(self):
+		states = self.dehfile.states
+		# Cut the player's run animation short, then restore it:
+		states[S_PLAY_RUN1].nextstate = S_PLAY_RUN1
+		self.assertTrue(self.index.is_state_free(S_PLAY_RUN2))
+		self.assertIndexCorrect()
+		states[S_PLAY_RUN1].tics = -1
+		states.reset_to_original()
+		self.assertFalse(self.index.is_state_free(S_PLAY_RUN2))
+		self.assertIndexCorrect()
+
+	def test_flash_rule(self):
+		weapon = self.dehfile.weaponinfo[wp_chaingun]
+		flash = weapon.flashstate + 1
+		self.assertFalse(self.index.is_state_free(flash))
+		for state_id in self.dehfile.weapon_states(wp_chaingun):
+			self.dehfile.states[state_id].action = None
+		self.assertIndexCorrect()
+		self.dehfile.states[weapon.atkstate].action = A_FireCGun
+		self.assertIndexCorrect()
+
+if __name__ == "__main__":
+	unittest.main()
@@ -2,7 +2,9 @@
 
 This uses the SQLite "virtual table" functionality to make the tables
 associated with a given DehackedFile object accessible via SQL. The table
-contents can be queried and modified via SQL.
+contents can be queried and modified via SQL. Alternatively, materialize()
+copies the tables into native SQLite tables for faster queries, and
+sync_back() writes changes made to them back to the DehackedFile.
 
 Based on the apsw (Another Python SQLite Wrapper) library; also included
 is a subclass of the apsw.Shell class that implements DEH9000-related
@@ -12,6 +14,12 @@ subcommands to load and save Dehacked files.
 from __future__ import absolute_import
 from __future__ import print_function
 
+import io
+import math
+import os
+import shutil
+import sys
+import tempfile
 import unittest
 
 import apsw
@@ -20,9 +28,9 @@ from deh9000 import actions
 from deh9000 import c
 from deh9000 import strings
 from deh9000.ammo import ammotype_t
-from deh9000.file import DehackedFile
+from deh9000.file import DehackedFile, load_many
 from deh9000.mobjs import mobjtype_t
-from deh9000.states import state_t, S_PISTOL
+from deh9000.states import state_t, S_PISTOL, S_PLAY_RUN1
 from deh9000.states import statenum_t
 from deh9000.weapons import weapontype_t
 
@@ -31,9 +39,192 @@ TABLES = {
     "miscdata": None,
     "mobjinfo": mobjtype_t,
     "states": statenum_t,
+    "strings": None,
     "weaponinfo": weapontype_t,
 }
 
+# Constraint operators that BestIndex() can use to narrow a scan:
+_EQ = apsw.SQLITE_INDEX_CONSTRAINT_EQ
+_RANGE_OPS = (
+    apsw.SQLITE_INDEX_CONSTRAINT_GT,
+    apsw.SQLITE_INDEX_CONSTRAINT_GE,
+    apsw.SQLITE_INDEX_CONSTRAINT_LT,
+    apsw.SQLITE_INDEX_CONSTRAINT_LE,
+)
+
+# Column number that SQLite uses for the rowid.
+COLUMN_SQLITE_ROWID = -1
+
+
+def _identity(value):
+    return value
+
+
+def _best_index(table, constraints, orderbys):
+    """Shared implementation of BestIndex() for the table types.
+
+	Constraints on columns that hold the row number (table.SEEK_COLUMNS)
+	become a seek to a single row or a range of rows, and equality
+	constraints on the columns in table.lookup_columns() use the
+	table's lookup() method. The constraints used are listed in the
+	index string, which is decoded by _filter_rows(). SQLite checks
+	the rows returned against the constraints again, so the rows
+	returned only have to include every matching row.
+	"""
+    num_rows = max(len(table), 1)
+    lookup_columns = table.lookup_columns()
+    used = []
+    plan = []
+    estimated_rows = num_rows
+    for column, op in constraints:
+        if column in table.SEEK_COLUMNS and op == _EQ:
+            estimated_rows = 1
+        elif column in table.SEEK_COLUMNS and op in _RANGE_OPS:
+            estimated_rows = max(estimated_rows // 4, 1)
+        elif column in lookup_columns and op == _EQ:
+            estimated_rows = 1
+        else:
+            used.append(None)
+            continue
+        used.append(len(plan))
+        plan.append("%d:%d" % (column, op))
+
+    # Rows are always returned in order, so an ORDER BY on the row
+    # number only can be consumed.
+    descending = {desc for _, desc in orderbys}
+    order_consumed = (
+        bool(orderbys) and len(descending) == 1 and
+        all(column in table.SEEK_COLUMNS for column, _ in orderbys))
+    indexnum = 1 if order_consumed and True in descending else 0
+    if not plan and not indexnum:
+        return (None, 0, None, order_consumed, float(num_rows))
+    # Each row visited costs one call to Column() per column
+    # read; a lookup costs about the same as visiting a row.
+    cost = float(estimated_rows + len(plan))
+    return (used, indexnum, " ".join(plan), order_consumed, cost)
+
+
+def _seek_range(op, value, start, stop):
+    """Narrow the range [start, stop) by a constraint on the row number."""
+    if value is None:
+        # Comparisons with NULL are never true.
+        return 0, 0
+    if not isinstance(value, (int, float)):
+        return start, stop
+    if op == _EQ:
+        if value != int(value):
+            return 0, 0
+        return max(start, int(value)), min(stop, int(value) + 1)
+    elif op == apsw.SQLITE_INDEX_CONSTRAINT_GT:
+        return max(start, math.floor(value) + 1), stop
+    elif op == apsw.SQLITE_INDEX_CONSTRAINT_GE:
+        return max(start, math.ceil(value)), stop
+    elif op == apsw.SQLITE_INDEX_CONSTRAINT_LT:
+        return start, min(stop, math.ceil(value))
+    elif op == apsw.SQLITE_INDEX_CONSTRAINT_LE:
+        return start, min(stop, math.floor(value) + 1)
+    return start, stop
+
+
+def _filter_rows(table, indexnum, indexname, constraintargs):
+    """Get the row numbers to visit for a plan from _best_index()."""
+    start, stop = 0, len(table)
+    matches = None
+    for item, value in zip((indexname or "").split(), constraintargs):
+        column, op = (int(x) for x in item.split(":"))
+        if column in table.SEEK_COLUMNS:
+            start, stop = _seek_range(op, value, start, stop)
+        else:
+            rows = set(table.lookup(column, value))
+            matches = rows if matches is None else matches & rows
+    if matches is None:
+        rows = range(start, max(start, stop))
+    else:
+        rows = sorted(row for row in matches if start <= row < stop)
+    if indexnum == 1:
+        rows = rows[::-1]
+    return rows
+
+
+class _WriteBuffer(object):
+    """Implementation of the transaction methods of apsw.VTTable.
+
+	Writes made during a transaction are not applied straight away, but
+	are held in the 'pending' dict and applied together when SQLite
+	commits the transaction, so the underlying DehackedFile only ever
+	sees whole transactions. Rolling back a transaction or a savepoint
+	discards writes from the buffer, and a statement run outside an
+	explicit transaction that fails part-way through changes nothing.
+
+	Inside an explicit transaction, SQLite does not ask virtual tables
+	to undo just the statement that failed, so the rows it wrote before
+	the failure stay in the buffer and are applied if the transaction
+	is committed. Each row is written whole, though: every value of a
+	row is converted and checked before any of them is buffered, so
+	committing can't fail and no row is left half-written.
+
+	Subclasses implement _apply() to apply the pending writes, and
+	_truncate() to discard rows inserted since a savepoint.
+	"""
+
+    def __init__(self):
+        self.pending = {}
+        self.in_transaction = False
+        # (level, pending writes, number of rows) for each savepoint:
+        self._savepoints = []
+        self._begin_rows = None
+
+    def _buffer_write(self, key, value):
+        """Record a write, or apply it if no transaction is open."""
+        self._buffer_writes({key: value})
+
+    def _buffer_writes(self, writes):
+        """Record writes, or apply them if no transaction is open."""
+        if self.in_transaction:
+            self.pending.update(writes)
+        else:
+            self._apply(writes)
+
+    def Begin(self):
+        self.pending = {}
+        self.in_transaction = True
+        self._savepoints = []
+        self._begin_rows = len(self)
+
+    def Sync(self):
+        # Every pending write was checked when it was made, so there
+        # is nothing that can fail at commit time.
+        pass
+
+    def Commit(self):
+        pending = self.pending
+        self.pending = {}
+        self.in_transaction = False
+        self._savepoints = []
+        self._apply(pending)
+
+    def Rollback(self):
+        self.pending = {}
+        self.in_transaction = False
+        self._savepoints = []
+        if self._begin_rows is not None:
+            self._truncate(self._begin_rows)
+
+    def Savepoint(self, level):
+        self.Release(level)
+        self._savepoints.append((level, dict(self.pending), len(self)))
+
+    def Release(self, level):
+        while self._savepoints and self._savepoints[-1][0] >= level:
+            self._savepoints.pop()
+
+    def RollbackTo(self, level):
+        self.Release(level + 1)
+        if self._savepoints and self._savepoints[-1][0] == level:
+            _, pending, num_rows = self._savepoints[-1]
+            self.pending = dict(pending)
+            self._truncate(num_rows)
+
 
 class Cursor(object):
     """Implements the apsw.VTCursor interface.
@@ -43,29 +234,49 @@ class Cursor(object):
 	"""
 
     def __init__(self, table):
-        self.position = 0
         self.table = table
+        self.getters = table.getters
+        self.rows = range(len(table))
+        self.index = 0
+        self.position = 0
 
     def Close(self):
         pass
 
     def Column(self, number):
-        return self.table[number, self.position]
+        if number == COLUMN_SQLITE_ROWID:
+            return self.position
+        if self.table.pending:
+            return self.table[number, self.position]
+        return self.getters[number](self.position)
+
+    def ColumnNoChange(self, number):
+        # Called for the columns that an UPDATE doesn't set, which
+        # then don't need to be read or compared at all.
+        return apsw.no_change
 
     def Eof(self):
-        return self.position >= len(self.table)
+        return self.index >= len(self.rows)
 
     def Filter(self, indexnum, indexname, constraintargs):
-        pass
+        self.rows = _filter_rows(self.table, indexnum, indexname,
+                                 constraintargs)
+        self.index = 0
+        self._seek()
+
+    def _seek(self):
+        if self.index < len(self.rows):
+            self.position = self.rows[self.index]
 
     def Next(self):
-        self.position += 1
+        self.index += 1
+        self._seek()
 
     def Rowid(self):
         return self.position
 
 
-class Table(object):
+class Table(_WriteBuffer):
     """Implementation of the apsw.VTTable interface.
 
 	This wraps a c.StructArray object as a virtual table that can be
@@ -79,17 +290,56 @@ class Table(object):
     COLUMN_ROWID = 0
     COLUMN_ENUM_NAME = 1
     COLUMN_OBJECT_NAME = 2
+    # Columns whose value is the row number:
+    SEEK_COLUMNS = (COLUMN_SQLITE_ROWID, COLUMN_ROWID)
 
     def __init__(self, struct_array, enum_type):
+        super().__init__()
         self.struct_array = struct_array
         self.enum_type = enum_type
         self.data_columns = type(struct_array[0]).field_names()
+        fields = [getattr(type(struct_array[0]), colname)
+                  for colname in self.data_columns]
+        num_metadata = len(Table.METADATA_COLUMNS)
+        # Functions for each column, by column number, that:
+        #  getters: read the SQL value of a row.
+        #  encoders: convert an SQL value to the value stored.
+        #  decoders: convert a stored value back to an SQL value.
+        #  setters: store a value in a row, returning the field bit.
+        self.getters = [
+            self._metadata_getter(column)
+            for column in range(num_metadata)
+        ] + [self._data_getter(field) for field in fields]
+        self.encoders = [
+            self._metadata_encoder(column)
+            for column in range(num_metadata)
+        ] + [self._data_encoder(field) for field in fields]
+        self.decoders = [_identity] * num_metadata + [
+            self._data_decoder(field) for field in fields]
+        self.setters = [
+            self._metadata_setter(column)
+            for column in range(num_metadata)
+        ] + [self._data_setter(field) for field in fields]
 
     def column_names(self):
         return Table.METADATA_COLUMNS + self.data_columns
 
     def BestIndex(self, constraints, orderbys):
-        pass
+        return _best_index(self, constraints, orderbys)
+
+    def lookup_columns(self):
+        """Get the columns that lookup() can find values in."""
+        if self.enum_type:
+            return (Table.COLUMN_ENUM_NAME,)
+        return ()
+
+    def lookup(self, column, value):
+        """Get the rows where the given column has the given value."""
+        if value in self.enum_type:
+            row = self.enum_type.index(value)
+            if row < len(self):
+                return [row]
+        return []
 
     def Open(self):
         return Cursor(self)
@@ -102,24 +352,96 @@ class Table(object):
     def __len__(self):
         return len(self.struct_array)
 
-    def _metadata_cell(self, row, column):
+    def _metadata_getter(self, column):
         if column == Table.COLUMN_ROWID:
-            return row
+            return int
         elif column == Table.COLUMN_ENUM_NAME and self.enum_type:
-            return self.enum_type[row]
+            enum_type = self.enum_type
+            def getter(row):
+                # Tables can have more rows than their enum has names.
+                if row < len(enum_type):
+                    return enum_type[row]
+            return getter
         elif column == Table.COLUMN_OBJECT_NAME:
-            return self.struct_array[row].object_name
+            store = self.struct_array._store
+            def getter(row):
+                return store.object_names.get(row)
+            return getter
+        else:
+            return lambda row: None
+
+    def _data_getter(self, field):
+        """Get a function that reads a field's column by row number.
+
+		Values are read straight out of the array's column storage,
+		rather than through a struct view for each row.
+		"""
+        columns = self.struct_array._store.columns
+        order = field.order
+        if field.registry is None:
+            def getter(row):
+                return columns[order][row]
+            return getter
+        decode = self._data_decoder(field)
+        def getter(row):
+            return decode(columns[order][row])
+        return getter
+
+    def _data_decoder(self, field):
+        if field.registry is None:
+            return _identity
+        registry = field.registry
+        convert = self._convert_to_sql_value
+        # SQL values of the registry entries, by registry index; the
+        # registry can grow, so this is extended as needed.
+        sql_values = []
+        def decode(index):
+            if index >= len(sql_values):
+                sql_values.extend(
+                    convert(registry[i])
+                    for i in range(len(sql_values), len(registry)))
+            return sql_values[index]
+        return decode
+
+    def _data_encoder(self, field):
+        if field.registry is None:
+            # Raises TypeError for values that can't be stored.
+            return c.field_value
+        registry = field.registry
+        def encode(value):
+            return registry.index(
+                self._convert_from_sql_value(field, value))
+        return encode
+
+    def _data_setter(self, field):
+        store = self.struct_array._store
+        order, bit = field.order, field.bit
+        def setter(row, value):
+            store.column(order)[row] = value
+            return bit
+        return setter
+
+    def _metadata_encoder(self, column):
+        if column == Table.COLUMN_OBJECT_NAME:
+            return _identity
+        def encode(value):
+            raise IndexError("Cannot change field %r" % (
+                Table.METADATA_COLUMNS[column]))
+        return encode
+
+    def _metadata_setter(self, column):
+        def setter(row, value):
+            self.struct_array[row].object_name = value
+            return 0
+        return setter
 
     def __getitem__(self, key):
         (column, row) = key
         if column == -1:
             return row
-        if column < len(Table.METADATA_COLUMNS):
-            return self._metadata_cell(row, column)
-        data_column = column - len(Table.METADATA_COLUMNS)
-        colname = self.data_columns[data_column]
-        result = getattr(self.struct_array[row], colname)
-        return self._convert_to_sql_value(result)
+        if key in self.pending:
+            return self.decoders[column](self.pending[key])
+        return self.getters[column](row)
 
     def _convert_to_sql_value(self, value):
         # We represent action pointers by their string name:
@@ -138,28 +460,39 @@ class Table(object):
 
         return value
 
-    def _set_metadata_cell(self, row, column, value):
-        if column == Table.COLUMN_OBJECT_NAME:
-            self.struct_array[row].object_name = value
-        else:
-            raise IndexError("Cannot change field %r" % (
-                Table.METADATA_COLUMNS[column]))
-
     def __setitem__(self, key, value):
         (column, row) = key
-        if column < len(Table.METADATA_COLUMNS):
-            return self._set_metadata_cell(row, column, value)
-        data_column = column - len(Table.METADATA_COLUMNS)
-        colname = self.data_columns[data_column]
-        obj = self.struct_array[row]
-        field = getattr(type(obj), colname)
-        value = self._convert_from_sql_value(field, value)
-        setattr(obj, colname, value)
+        self._buffer_write(key, self.encoders[column](value))
+
+    def _apply(self, writes):
+        # Writes are applied row by row, so that watchers of the
+        # array see each row change once with all its fields.
+        by_row = {}
+        for (column, row), value in writes.items():
+            by_row.setdefault(row, []).append((column, value))
+        store = self.struct_array._store
+        setters = self.setters
+        for row in sorted(by_row):
+            bits = 0
+            for column, value in by_row[row]:
+                bits |= setters[column](row, value)
+            if bits:
+                store.mark(row, bits)
+
+    def _truncate(self, num_rows):
+        # Rows can't be inserted into struct arrays.
+        pass
 
     def UpdateChangeRow(self, rowid, newrowid, fields):
+        # Every value is encoded before any is written, so that a
+        # value which can't be stored leaves the whole row unchanged.
+        writes = {}
         for column, value in enumerate(fields):
+            if value is apsw.no_change:
+                continue
             if self[column, rowid] != value:
-                self[column, rowid] = value
+                writes[column, rowid] = self.encoders[column](value)
+        self._buffer_writes(writes)
 
     def UpdateDeleteRow(self, rowid):
         raise NotImplementedError()
@@ -168,7 +501,7 @@ class Table(object):
         raise NotImplementedError()
 
 
-class StringsTable(object):
+class StringsTable(_WriteBuffer):
     """Implementation of the apsw.VTTable interface.
 
 	This wraps a deh9000 StringReplacements object producing a table that
@@ -177,10 +510,13 @@ class StringsTable(object):
     COLUMN_NAME = 0
     COLUMN_KEY = 1
     COLUMN_VALUE = 2
+    SEEK_COLUMNS = (COLUMN_SQLITE_ROWID,)
 
     def __init__(self, string_repls):
+        super().__init__()
         self.string_repls = string_repls
         self._populate_table(strings)
+        self.getters = [self._name, self._key, self._value]
 
     def _populate_table(self, mod):
         """Add all symbolic named strings from imported module.
@@ -188,26 +524,49 @@ class StringsTable(object):
 		Module in this case is the deh9000.strings module.
 		"""
         self.table_entries = []
-        used_keys = set()
+        # Rows of the table with each name and key:
+        self.name_rows = {}
+        self.key_rows = {}
         for name in sorted(dir(mod)):
             if name.startswith("__"):
                 continue
             key = getattr(mod, name)
             if not isinstance(key, str):
                 continue
-            self.table_entries.append((name, key))
-            used_keys.add(key)
+            self._add_entry(name, key)
 
         # Add unnamed entries:
         for key, value in self.string_repls.items():
-            if key not in used_keys:
-                self.table_entries.append(('', key))
+            if key not in self.key_rows:
+                self._add_entry('', key)
+
+    def _add_entry(self, name, key):
+        row = len(self.table_entries)
+        self.table_entries.append((name, key))
+        self.name_rows.setdefault(name, []).append(row)
+        self.key_rows.setdefault(key, []).append(row)
+        return row
 
     def column_names(self):
         return ["name", "key", "value"]
 
     def BestIndex(self, constraints, orderbys):
-        pass
+        return _best_index(self, constraints, orderbys)
+
+    def lookup_columns(self):
+        """Get the columns that lookup() can find values in."""
+        return (StringsTable.COLUMN_NAME, StringsTable.COLUMN_KEY)
+
+    def lookup(self, column, value):
+        """Get the rows where the given column has the given value."""
+        if column == StringsTable.COLUMN_NAME:
+            index = self.name_rows
+        else:
+            index = self.key_rows
+        try:
+            return index.get(value, [])
+        except TypeError:
+            return []
 
     def Open(self):
         return Cursor(self)
@@ -220,26 +579,51 @@ class StringsTable(object):
     def __len__(self):
         return len(self.table_entries)
 
+    def _name(self, row):
+        return self.table_entries[row][StringsTable.COLUMN_NAME]
+
+    def _key(self, row):
+        return self.table_entries[row][StringsTable.COLUMN_KEY]
+
+    def _value(self, row):
+        key = self.table_entries[row][StringsTable.COLUMN_KEY]
+        if key in self.pending:
+            return self.pending[key]
+        return self.string_repls[key]
+
     def __getitem__(self, key):
         (column, row) = key
         if column == -1:
             return row
-        elif column == StringsTable.COLUMN_VALUE:
-            x = self.table_entries[row][StringsTable.COLUMN_KEY]
-            return self.string_repls[x]
-        else:
-            return self.table_entries[row][column]
+        return self.getters[column](row)
 
     def __setitem__(self, key, value):
         (column, row) = key
         if column == StringsTable.COLUMN_VALUE:
             x = self.table_entries[row][StringsTable.COLUMN_KEY]
-            self.string_repls[x] = value
+            self._buffer_write(x, value)
         else:
             raise IndexError('cannot change name or key fields')
 
+    def _apply(self, writes):
+        for key, value in writes.items():
+            self.string_repls[key] = value
+
+    def _truncate(self, num_rows):
+        """Remove rows inserted since the table had num_rows rows."""
+        while len(self.table_entries) > num_rows:
+            row = len(self.table_entries) - 1
+            name, key = self.table_entries.pop()
+            for index, value in ((self.name_rows, name),
+                                 (self.key_rows, key)):
+                index[value].remove(row)
+                if not index[value]:
+                    del index[value]
+
     def UpdateChangeRow(self, rowid, newrowid, fields):
         for column, value in enumerate(fields):
+            if value is apsw.no_change:
+                continue
             if self[column, rowid] != value:
                 self[column, rowid] = value
 
@@ -251,16 +635,28 @@ class StringsTable(object):
         name, key, value = fields
         if rowid is not None:
             raise ValueError("expecting no existing row")
-        if key in self.string_repls:
+        if key in self.string_repls or key in self.key_rows:
             raise KeyError("row for key %r already present" % (
                 key,))
         if name:
             raise ValueError(
                 "name must be empty when inserting new row")
-        result = len(self.table_entries)
-        self.string_repls[key] = value
-        self.table_entries.append((name, key))
-        return result
+        self._buffer_write(key, value)
+        return self._add_entry(name, key)
+
+
+def _make_table(dehfile, tablename):
+    """Create the table object for one of the tables in TABLES."""
+    array = getattr(dehfile, tablename)
+    if tablename == "strings":
+        return StringsTable(array)
+    # miscdata is a single struct rather than an array; it is wrapped
+    # in an array that shares its storage, so that writes reach it.
+    if isinstance(array, c.Struct):
+        struct = array
+        array = c.StructArray(type(struct), [])
+        array._store = struct._store
+    return Table(array, TABLES[tablename])
 
 
 class Module(object):
@@ -280,15 +676,7 @@ class Module(object):
         if tablename not in TABLES:
             raise ValueError("valid tables: %s" % (
                 "; ".join(TABLES.keys())))
-        array = getattr(self.dehfile, tablename)
-        # Hack for miscdata
-        if isinstance(array, c.Struct):
-            array = c.StructArray(type(array), [array])
-        if tablename == "strings":
-            table = StringsTable(array)
-        else:
-            table = Table(array, TABLES[tablename])
-
+        table = _make_table(self.dehfile, tablename)
         create_sql = "CREATE TABLE %s (%s);" % (
             tablename, ", ".join(table.column_names()),
         )
@@ -298,23 +686,34 @@ class Module(object):
 
 
 class Shell(apsw.Shell):
-    """Extension of apsw.Shell with commands to read/write .deh files."""
+    """Extension of apsw.Shell with commands to read/write .deh files.
+
+	'dehfile' is the DehackedFile that the tables were made from, or
+	None for a workspace (see MakeWorkspace()), whose tables are not
+	backed by a single file; the .deh commands then report an error.
+	"""
 
     def __init__(self, dehfile, *args, **kwargs):
         self.dehfile = dehfile
         super().__init__(*args, **kwargs)
 
+    def _get_dehfile(self):
+        if self.dehfile is None:
+            raise self.Error("Dehacked commands are not available on a "
+                             "workspace of several patches")
+        return self.dehfile
+
     def command_dehload(self, cmd):
         """dehload FILE: Load Dehacked patch from FILE."""
-        self.dehfile.load(cmd[0])
+        self._get_dehfile().load(cmd[0])
 
     def command_dehsave(self, cmd):
         """dehsave FILE: Write Dehacked patch to FILE."""
-        self.dehfile.save(cmd[0])
+        self._get_dehfile().save(cmd[0])
 
     def command_doom(self, cmd):
         """doom ARGS: Start an interactive session to test changes."""
-        self.dehfile.interactive(cmd)
+        self._get_dehfile().interactive(cmd)
 
 
 def MakeTables(dehfile, connection=None):
@@ -330,7 +729,10 @@ def MakeTables(dehfile, connection=None):
     if not connection:
         connection = apsw.Connection(":memory:")
     mod = Module(dehfile)
-    connection.createmodule("deh9000", mod)
+    # Version 2 of the module interface adds savepoints, which SQLite
+    # uses to roll back failed statements inside a transaction.
+    connection.createmodule("deh9000", mod, use_no_change=True,
+                            iVersion=2)
     cursor = connection.cursor()
     for table in TABLES:
         cursor.execute("CREATE VIRTUAL TABLE %s USING deh9000()" % (
@@ -338,6 +740,421 @@ def MakeTables(dehfile, connection=None):
     return connection
 
 
+# Number of bits of the rowids of workspace tables that hold the row
+# number; the bits above hold the patch_id.
+WORKSPACE_ROW_BITS = 32
+_WORKSPACE_ROW_MASK = (1 << WORKSPACE_ROW_BITS) - 1
+
+
+class WorkspaceCursor(Cursor):
+    """Implements the apsw.VTCursor interface for a WorkspaceTable."""
+
+    def Filter(self, indexnum, indexname, constraintargs):
+        self.rows = self.table.filter_rows(indexname, constraintargs)
+        self.index = 0
+        self._seek()
+
+
+class WorkspaceTable(object):
+    """Implementation of the apsw.VTTable interface for many patches.
+
+	This joins together the same table of many DehackedFiles, with a
+	'patch_id' column added before the table's own columns. 'tables' is
+	a list of Table or StringsTable objects, indexed by patch_id. The
+	rowid of each row holds its patch_id and its row number in that
+	patch's table (see WORKSPACE_ROW_BITS).
+
+	Queries are planned once for all patches: constraints on patch_id
+	select which patches to visit, and the other constraints are
+	planned as they would be for a single table (see _best_index()),
+	using the same indexes. Workspace tables are read-only.
+	"""
+    COLUMN_PATCH_ID = 0
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.pending = {}
+        self.getters = [self._patch_id] + [
+            self._inner_getter(column)
+            for column in range(len(tables[0].column_names()))]
+
+    def column_names(self):
+        return ["patch_id"] + self.tables[0].column_names()
+
+    def _patch_id(self, position):
+        return position >> WORKSPACE_ROW_BITS
+
+    def _inner_getter(self, column):
+        tables = self.tables
+        def getter(position):
+            table = tables[position >> WORKSPACE_ROW_BITS]
+            return table.getters[column](position & _WORKSPACE_ROW_MASK)
+        return getter
+
+    def BestIndex(self, constraints, orderbys):
+        inner = self.tables[0]
+        inner_lookups = inner.lookup_columns()
+        used = []
+        plan = []
+        estimated_rows = max(sum(len(t) for t in self.tables), 1)
+        for column, op in constraints:
+            inner_column = column - 1
+            if column == WorkspaceTable.COLUMN_PATCH_ID and op == _EQ:
+                estimated_rows //= len(self.tables)
+            elif (column == WorkspaceTable.COLUMN_PATCH_ID
+                  and op in _RANGE_OPS):
+                estimated_rows //= 4
+            elif column == COLUMN_SQLITE_ROWID and op == _EQ:
+                estimated_rows = 1
+            elif inner_column in inner.SEEK_COLUMNS and op == _EQ:
+                estimated_rows //= len(inner)
+            elif inner_column in inner.SEEK_COLUMNS and op in _RANGE_OPS:
+                estimated_rows //= 4
+            elif inner_column in inner_lookups and op == _EQ:
+                estimated_rows //= len(inner)
+            else:
+                used.append(None)
+                continue
+            used.append(len(plan))
+            plan.append("%d:%d" % (column, op))
+        # Rows are returned in rowid order, which is the order of
+        # patch_id and then of the row numbers.
+        row_number_columns = [
+            column + 1 for column in inner.SEEK_COLUMNS
+            if column != COLUMN_SQLITE_ROWID]
+        orderbys = list(orderbys)
+        order_consumed = (
+            orderbys == [(COLUMN_SQLITE_ROWID, False)] or
+            orderbys[:1] == [(WorkspaceTable.COLUMN_PATCH_ID, False)] and (
+                len(orderbys) == 1 or len(orderbys) == 2 and
+                orderbys[1][0] in row_number_columns and
+                not orderbys[1][1]))
+        if not plan:
+            return (None, 0, None, order_consumed,
+                    float(estimated_rows))
+        cost = float(max(estimated_rows, 1) + len(plan))
+        return (used, 0, " ".join(plan), order_consumed, cost)
+
+    def filter_rows(self, indexname, constraintargs):
+        """Get the rowids to visit for a plan from BestIndex()."""
+        first, last = 0, len(self.tables)
+        inner_plan = []
+        inner_args = []
+        for item, value in zip((indexname or "").split(), constraintargs):
+            column, op = (int(x) for x in item.split(":"))
+            if column == WorkspaceTable.COLUMN_PATCH_ID:
+                first, last = _seek_range(op, value, first, last)
+            elif column == COLUMN_SQLITE_ROWID:
+                if not isinstance(value, int):
+                    return []
+                patch_id = value >> WORKSPACE_ROW_BITS
+                first, last = max(first, patch_id), min(last, patch_id + 1)
+                inner_plan.append("%d:%d" % (COLUMN_SQLITE_ROWID, op))
+                inner_args.append(value & _WORKSPACE_ROW_MASK)
+            else:
+                inner_plan.append("%d:%d" % (column - 1, op))
+                inner_args.append(value)
+        inner_plan = " ".join(inner_plan)
+        result = []
+        for patch_id in range(first, last):
+            base = patch_id << WORKSPACE_ROW_BITS
+            result.extend(base | row for row in _filter_rows(
+                self.tables[patch_id], 0, inner_plan, inner_args))
+        return result
+
+    def Open(self):
+        return WorkspaceCursor(self)
+
+    def Disconnect(self):
+        pass
+
+    Destroy = Disconnect
+
+    def __len__(self):
+        return sum(len(table) for table in self.tables)
+
+
+class WorkspaceModule(object):
+    """Implementation of the apsw.VTModule interface for workspaces.
+
+	Tables are created over every DehackedFile in 'dehfiles', where the
+	index of each file in the list is its patch_id.
+	"""
+
+    def __init__(self, dehfiles):
+        self.dehfiles = dehfiles
+
+    def Create(self, connection, modulename,
+               databasename, tablename, *args):
+        if len(args) > 0:
+            raise ValueError("no arguments permitted")
+        if tablename not in TABLES:
+            raise ValueError("valid tables: %s" % (
+                "; ".join(TABLES.keys())))
+        table = WorkspaceTable([_make_table(dehfile, tablename)
+                                for dehfile in self.dehfiles])
+        create_sql = "CREATE TABLE %s (%s);" % (
+            tablename, ", ".join(table.column_names()),
+        )
+        return create_sql, table
+
+    Connect = Create
+
+
+def MakeWorkspace(filenames, connection=None, workers=None,
+                  warnings=None):
+    """Create virtual tables covering many Dehacked files at once.
+
+	Each file is loaded as a separate patch, in parallel (see
+	deh9000.file.load_many()), and the tables of all of them are
+	queryable together: each table has a 'patch_id' column, and a
+	native 'patches' table maps each patch_id to its filename. Patch 0
+	is always the unmodified tables, with a NULL filename, so patches
+	can be compared against it, eg.
+
+	  SELECT filename FROM patches JOIN mobjinfo USING (patch_id)
+	  WHERE enum_name = 'MT_IMP1' AND speed != (
+	    SELECT speed FROM mobjinfo
+	    WHERE patch_id = 0 AND enum_name = 'MT_IMP1')
+
+	If any file fails to load, the exception from loading it is raised.
+
+	Args:
+	  filenames: list of Dehacked files to load.
+	  connection: instance of apsw.Connection; if None then an in-memory
+	      connection is created.
+	  workers: number of processes to load files with; by default, one
+	      per CPU.
+	  warnings: list to collect warnings from loading the files in; if
+	      None, warnings are printed to stderr.
+	Returns:
+	  instance of apsw.Connection on which the tables were created.
+	"""
+    if not connection:
+        connection = apsw.Connection(":memory:")
+    filenames = list(dict.fromkeys(filenames))
+    loaded = {}
+    all_warnings = []
+    for filename, dehfile, file_warnings in load_many(filenames, workers):
+        if dehfile is None:
+            error, = file_warnings
+            raise error
+        loaded[filename] = dehfile
+        all_warnings.extend(file_warnings)
+    if warnings is not None:
+        warnings.extend(all_warnings)
+    elif all_warnings:
+        print("Warnings loading dehacked file:", file=sys.stderr)
+        for w in all_warnings:
+            print(w, file=sys.stderr)
+    dehfiles = [DehackedFile()] + [loaded[f] for f in filenames]
+
+    connection.createmodule("deh9000_workspace",
+                            WorkspaceModule(dehfiles), read_only=True)
+    cursor = connection.cursor()
+    with connection:
+        cursor.execute("CREATE TABLE patches "
+                       "(patch_id INTEGER PRIMARY KEY, filename TEXT)")
+        cursor.executemany("INSERT INTO patches VALUES (?, ?)",
+                           enumerate([None] + filenames))
+    for table in TABLES:
+        cursor.execute(
+            "CREATE VIRTUAL TABLE %s USING deh9000_workspace()" % (
+                table))
+    return connection
+
+
+# Indexes created on materialized tables, as (table, column) pairs.
+MATERIALIZED_INDEXES = (
+    ("ammodata", "enum_name"),
+    ("mobjinfo", "enum_name"),
+    ("mobjinfo", "doomednum"),
+    ("states", "enum_name"),
+    ("states", "nextstate"),
+    ("states", "sprite"),
+    ("states", "action"),
+    ("weaponinfo", "enum_name"),
+    ("strings", "name"),
+    ("sprnames", "name"),
+)
+
+# Table that triggers on the materialized tables fill in with the rows
+# that have been written to.
+CHANGES_TABLE = "deh9000_changes"
+
+
+def _materialized_columns(table):
+    """Get the column definitions of a materialized table."""
+    if isinstance(table, StringsTable):
+        return ["name TEXT", "key TEXT UNIQUE", "value TEXT"]
+    result = ["id INTEGER PRIMARY KEY", "enum_name TEXT",
+              "object_name TEXT"]
+    for colname in table.data_columns:
+        field = getattr(type(table.struct_array[0]), colname)
+        result.append("%s %s" % (
+            colname, "TEXT" if field.registry else "INTEGER"))
+    return result
+
+
+def _change_triggers(tablename, fixed, can_insert):
+    """Get statements creating the triggers for a materialized table.
+
+	Rows written are recorded in CHANGES_TABLE, for sync_back(). The
+	triggers also reject the changes that can't be made to the
+	DehackedFile, in the same way as the virtual tables do.
+	"""
+    result = [
+        """CREATE TRIGGER %(t)s_update AFTER UPDATE ON %(t)s BEGIN
+             INSERT OR IGNORE INTO %(c)s VALUES ('%(t)s', NEW.rowid);
+           END""",
+        """CREATE TRIGGER %(t)s_update_fixed
+             BEFORE UPDATE OF %(fixed)s ON %(t)s BEGIN
+             SELECT RAISE(ABORT, 'cannot change %(fixed)s of %(t)s');
+           END""",
+        """CREATE TRIGGER %(t)s_delete BEFORE DELETE ON %(t)s BEGIN
+             SELECT RAISE(ABORT, 'cannot delete rows from %(t)s');
+           END""",
+    ]
+    if can_insert:
+        result.append(
+            """CREATE TRIGGER %(t)s_insert AFTER INSERT ON %(t)s BEGIN
+                 INSERT OR IGNORE INTO %(c)s VALUES ('%(t)s', NEW.rowid);
+               END""")
+    else:
+        result.append(
+            """CREATE TRIGGER %(t)s_insert BEFORE INSERT ON %(t)s BEGIN
+                 SELECT RAISE(ABORT, 'cannot insert rows into %(t)s');
+               END""")
+    params = {"t": tablename, "c": CHANGES_TABLE,
+              "fixed": ", ".join(fixed)}
+    return [sql % params for sql in result]
+
+
+def materialize(dehfile, connection=None):
+    """Copy the tables of a DehackedFile into native SQLite tables.
+
+	Virtual tables (see MakeTables()) call back into Python for every
+	value read, while native tables can be queried at the full speed
+	of SQLite, and can be indexed; see MATERIALIZED_INDEXES. The same
+	tables are created as by MakeTables(), with the same columns, plus
+	a 'sprnames' table of sprite names. Changes made to the tables are
+	not seen by the DehackedFile until sync_back() is called.
+
+	Args:
+	  dehfile: instance of deh9000.dehfile to copy.
+	  connection: instance of apsw.Connection; if None then an in-memory
+	      connection is created.
+	Returns:
+	  instance of apsw.Connection on which the tables were created.
+	"""
+    if not connection:
+        connection = apsw.Connection(":memory:")
+    cursor = connection.cursor()
+    with connection:
+        for tablename in TABLES:
+            table = _make_table(dehfile, tablename)
+            cursor.execute("CREATE TABLE %s (%s)" % (
+                tablename, ", ".join(_materialized_columns(table))))
+            getters = table.getters
+            names = table.column_names()
+            if tablename == "strings":
+                names = ["rowid"] + names
+                getters = [int] + getters
+            cursor.executemany(
+                "INSERT INTO %s (%s) VALUES (%s)" % (
+                    tablename, ", ".join(names),
+                    ", ".join("?" * len(names))),
+                ([getter(row) for getter in getters]
+                 for row in range(len(table))))
+        cursor.execute(
+            "CREATE TABLE sprnames (id INTEGER PRIMARY KEY, name TEXT)")
+        cursor.executemany(
+            "INSERT INTO sprnames VALUES (?, ?)",
+            enumerate(dehfile.sprnames))
+        for tablename, column in MATERIALIZED_INDEXES:
+            cursor.execute("CREATE INDEX %s_%s ON %s (%s)" % (
+                tablename, column, tablename, column))
+
+        # Changes are tracked from here on.
+        cursor.execute(
+            "CREATE TABLE %s (table_name TEXT, row INTEGER, "
+            "PRIMARY KEY (table_name, row)) WITHOUT ROWID" % (
+                CHANGES_TABLE))
+        for tablename in TABLES:
+            if tablename == "strings":
+                fixed = ["name", "key"]
+            else:
+                fixed = ["id", "enum_name"]
+            for sql in _change_triggers(
+                    tablename, fixed, tablename == "strings"):
+                cursor.execute(sql)
+        for sql in _change_triggers("sprnames", ["id"], False):
+            cursor.execute(sql)
+    return connection
+
+
+def sync_back(dehfile, connection):
+    """Write changes made to materialized tables back to a DehackedFile.
+
+	Only the rows recorded as written since materialize() or the last
+	call to sync_back() are read back, and only values that differ from
+	the DehackedFile are written to it. The DehackedFile is changed
+	all at once: if a value can't be written (eg. an unknown action
+	pointer, or a sprite name that isn't four characters long), an
+	exception is raised and nothing is changed.
+
+	Returns:
+	  the number of rows that were read back.
+	"""
+    cursor = connection.cursor()
+    changes = {}
+    for tablename, row in cursor.execute(
+            "SELECT table_name, row FROM %s" % CHANGES_TABLE):
+        changes.setdefault(tablename, []).append(row)
+    tables = []
+    try:
+        for tablename in TABLES:
+            if tablename not in changes:
+                continue
+            table = _make_table(dehfile, tablename)
+            table.Begin()
+            tables.append(table)
+            names = table.column_names()
+            if tablename == "strings":
+                names = ["rowid"] + names
+            for row in changes[tablename]:
+                fields = cursor.execute(
+                    "SELECT %s FROM %s WHERE rowid=?" % (
+                        ", ".join(names), tablename), (row,)).fetchone()
+                if tablename != "strings":
+                    table.UpdateChangeRow(row, row, fields)
+                elif row < len(table):
+                    table.UpdateChangeRow(row, row, fields[1:])
+                else:
+                    table.UpdateInsertRow(None, fields[1:])
+        sprnames = {}
+        for row in changes.get("sprnames", ()):
+            name = cursor.execute(
+                "SELECT name FROM sprnames WHERE id=?", (row,)).fetchone()
+            if name is not None:
+                name, = name
+            if not isinstance(name, str) or len(name) != 4:
+                raise ValueError("Invalid sprite name %r for sprite %d" % (
+                    name, row))
+            sprnames[row] = name
+    except Exception:
+        for table in tables:
+            table.Rollback()
+        raise
+    for table in tables:
+        table.Commit()
+    for row, name in sorted(sprnames.items()):
+        if dehfile.sprnames[row] != name:
+            dehfile.sprnames[row] = name
+    cursor.execute("DELETE FROM %s" % CHANGES_TABLE)
+    return sum(len(rows) for rows in changes.values())
+
+
 class TestSqlite(unittest.TestCase):
 
     def setUp(self):
@@ -371,6 +1188,18 @@ class TestSqlite(unittest.TestCase):
         self.assertEqual(self.dehfile.states[S_PISTOL].tics, 2)
         for row in cursor.execute(query):
             self.assertEqual(row[0], 2)
+        # Floats are stored if they have an integral value:
+        cursor.execute("""
+			UPDATE states SET tics=tics*1.5
+			WHERE rowid=%d
+		""" % S_PISTOL)
+        self.assertEqual(self.dehfile.states[S_PISTOL].tics, 3)
+        with self.assertRaises(TypeError):
+            cursor.execute("""
+				UPDATE states SET tics=tics*1.5
+				WHERE rowid=%d
+			""" % S_PISTOL)
+        self.assertEqual(self.dehfile.states[S_PISTOL].tics, 3)
 
     def test_action_pointer_conversion(self):
         cursor = self.conn.cursor()
@@ -397,6 +1226,57 @@ class TestSqlite(unittest.TestCase):
         for row in cursor.execute(query):
             self.assertEqual(row[0], None)
 
+    def test_transactions(self):
+        states = self.dehfile.states
+        cursor = self.conn.cursor()
+        # A statement that fails part-way changes nothing:
+        failing_update = """
+			UPDATE states SET tics=99,
+			  action=CASE WHEN rowid=%d THEN 'A_Bogus'
+			         ELSE action END
+			WHERE rowid BETWEEN %d AND %d
+		""" % (S_PISTOL + 1, S_PISTOL, S_PISTOL + 2)
+        with self.assertRaises(NameError):
+            cursor.execute(failing_update)
+        self.assertEqual(states.changed_rows(), [])
+
+        # Writes are seen by queries, but only applied on commit:
+        query = "SELECT tics FROM states WHERE rowid=%d" % S_PISTOL
+        cursor.execute("BEGIN")
+        cursor.execute("UPDATE states SET tics=5 WHERE rowid=%d" % (
+            S_PISTOL))
+        cursor.execute("INSERT INTO strings VALUES('', 'foo', 'bar')")
+        self.assertEqual(list(cursor.execute(query)), [(5,)])
+        self.assertEqual(states[S_PISTOL].tics, 1)
+        cursor.execute("SAVEPOINT sp")
+        cursor.execute("UPDATE states SET tics=6 WHERE rowid=%d" % (
+            S_PISTOL))
+        cursor.execute("ROLLBACK TO sp")
+        cursor.execute("COMMIT")
+        self.assertEqual(states[S_PISTOL].tics, 5)
+        self.assertEqual(self.dehfile.strings["foo"], "bar")
+
+        cursor.execute("BEGIN")
+        cursor.execute("UPDATE states SET tics=7 WHERE rowid=%d" % (
+            S_PISTOL))
+        cursor.execute("INSERT INTO strings VALUES('', 'baz', 'x')")
+        cursor.execute("ROLLBACK")
+        self.assertEqual(states[S_PISTOL].tics, 5)
+        self.assertNotIn("baz", self.dehfile.strings)
+        self.assertEqual(list(cursor.execute(
+            "SELECT * FROM strings WHERE key='baz'")), [])
+
+        # Inside a transaction, rows written by a failed statement
+        # before it failed are kept, but no row is half-written:
+        pistol1 = states[S_PISTOL + 1].tics
+        cursor.execute("BEGIN")
+        with self.assertRaises(NameError):
+            cursor.execute(failing_update)
+        cursor.execute("COMMIT")
+        self.assertEqual(states[S_PISTOL].tics, 99)
+        self.assertEqual(states[S_PISTOL + 1].tics, pistol1)
+        self.assertEqual(states.changed_rows(), [S_PISTOL])
+
     def test_metadata_fields(self):
         cursor = self.conn.cursor()
         query = """
@@ -426,29 +1306,51 @@ class TestSqlite(unittest.TestCase):
 				WHERE rowid=0
 			""")
 
+    def test_index_plans(self):
+        cursor = self.conn.cursor()
+        queries = [
+            ("SELECT id FROM states WHERE rowid=%d" % S_PISTOL,
+             [S_PISTOL]),
+            ("SELECT id FROM states WHERE id BETWEEN 3 AND 6 "
+             "ORDER BY id DESC", [6, 5, 4, 3]),
+            ("SELECT id FROM states WHERE rowid > 1.5 AND rowid < 4",
+             [2, 3]),
+            ("SELECT id FROM states WHERE enum_name='S_PISTOL'",
+             [S_PISTOL]),
+            ("SELECT id FROM states WHERE enum_name='S_BOGUS'", []),
+            ("SELECT id FROM states WHERE rowid=NULL", []),
+            ("SELECT id FROM mobjinfo WHERE rowid >= %d" % (
+                len(self.dehfile.mobjinfo) - 1),
+             [len(self.dehfile.mobjinfo) - 1]),
+        ]
+        for query, expected in queries:
+            rows = [row[0] for row in cursor.execute(query)]
+            self.assertEqual(rows, expected)
+            plan = list(cursor.execute("EXPLAIN QUERY PLAN " + query))
+            self.assertIn("INDEX", plan[0][-1])
+
     def test_strings_query(self):
-        strings = self.dehfile.strings
         cursor = self.conn.cursor()
-        rows = list(cursor.execute("""
-			SELECT value FROM strings
-			WHERE key="E1M2: Nuclear Plant"
-		"""))
-        self.assertEqual(rows, [("E1M2: Nuclear Plant",)])
-        strings.HUSTR_E1M2 = "E1M2: Qux Refinery"
-        rows = list(cursor.execute("""
+        query = """
 			SELECT value FROM strings
-			WHERE key="E1M2: Nuclear Plant"
-		"""))
-        self.assertEqual(rows, [("E1M2: Qux Refinery",)])
+			WHERE key="TROO"
+		"""
+        rows = list(cursor.execute(query))
+        self.assertEqual(rows, [("TROO",)])
+        sprite = self.dehfile.sprnames.index("TROO")
+        self.dehfile.sprnames[sprite] = "ZZZZ"
+        rows = list(cursor.execute(query))
+        self.assertEqual(rows, [("ZZZZ",)])
 
     def test_strings_update(self):
         strings = self.dehfile.strings
         cursor = self.conn.cursor()
         cursor.execute("""
-			UPDATE strings SET value="E1M1: Foobar"
-			WHERE name="HUSTR_E1M1"
+			UPDATE strings SET value="ZZZZ"
+			WHERE key="TROO"
 		""")
-        self.assertEqual(strings.HUSTR_E1M1, "E1M1: Foobar")
+        self.assertEqual(strings["TROO"], "ZZZZ")
+        self.assertIn("ZZZZ", self.dehfile.sprnames)
 
         with self.assertRaises(IndexError):
             cursor.execute("""
@@ -468,12 +1370,16 @@ class TestSqlite(unittest.TestCase):
 			INSERT INTO strings VALUES('', 'foo', 'bar')
 		""")
         self.assertEqual(strings["foo"], "bar")
+        rows = list(cursor.execute("""
+			SELECT value FROM strings WHERE key='foo'
+		"""))
+        self.assertEqual(rows, [("bar",)])
 
         # Can't conflict with existing row
         with self.assertRaises(KeyError):
             cursor.execute("""
 				INSERT INTO strings
-				VALUES('', 'E1M2: Nuclear Plant', 'x')
+				VALUES('', 'TROO', 'x')
 			""")
         # Can't specify a name:
         with self.assertRaises(ValueError):
@@ -481,6 +1387,163 @@ class TestSqlite(unittest.TestCase):
 				INSERT INTO strings VALUES('x', 'y', 'z')
 			""")
 
+class TestMaterialize(unittest.TestCase):
+
+    def setUp(self):
+        self.dehfile = DehackedFile()
+        self.conn = materialize(self.dehfile)
+
+    def test_tables(self):
+        cursor = self.conn.cursor()
+        virtual = MakeTables(self.dehfile).cursor()
+        for t in TABLES:
+            query = "SELECT * FROM %s ORDER BY rowid" % t
+            self.assertEqual(list(cursor.execute(query)),
+                             list(virtual.execute(query)))
+        self.assertEqual(
+            [name for name, in cursor.execute(
+                "SELECT name FROM sprnames ORDER BY id")],
+            list(self.dehfile.sprnames))
+        rows = list(cursor.execute("""
+			WITH RECURSIVE chain(id) AS (
+			  SELECT %d
+			  UNION SELECT nextstate FROM states, chain
+			  WHERE states.id = chain.id)
+			SELECT enum_name FROM states WHERE id IN chain
+		""" % S_PLAY_RUN1))
+        self.assertEqual(rows, [("S_PLAY_RUN%d" % i,)
+                                for i in range(1, 5)])
+        plan = list(cursor.execute(
+            "EXPLAIN QUERY PLAN SELECT id FROM states WHERE nextstate=1"))
+        self.assertIn("states_nextstate", plan[0][-1])
+
+    def test_sync_back(self):
+        dehfile = self.dehfile
+        cursor = self.conn.cursor()
+        cursor.execute("""
+			UPDATE states SET tics=5, action='A_Scream'
+			WHERE id=%d
+		""" % S_PISTOL)
+        cursor.execute("UPDATE miscdata SET initial_health=42")
+        cursor.execute("INSERT INTO strings VALUES('', 'foo', 'bar')")
+        cursor.execute("UPDATE sprnames SET name='ZZZZ' WHERE id=1")
+        self.assertEqual(dehfile.states[S_PISTOL].tics, 1)
+        self.assertEqual(sync_back(dehfile, self.conn), 4)
+        self.assertEqual(dehfile.states.changed_rows(), [S_PISTOL])
+        self.assertEqual(dehfile.states[S_PISTOL].tics, 5)
+        self.assertEqual(dehfile.states[S_PISTOL].action,
+                         actions.A_Scream)
+        self.assertEqual(dehfile.miscdata.initial_health, 42)
+        self.assertEqual(dehfile.strings["foo"], "bar")
+        self.assertEqual(dehfile.sprnames[1], "ZZZZ")
+        self.assertEqual(sync_back(dehfile, self.conn), 0)
+
+        # Nothing is changed if any value can't be written:
+        cursor.execute("UPDATE states SET tics=6 WHERE id=%d" % S_PISTOL)
+        cursor.execute("UPDATE states SET action='A_Bogus' WHERE id=1")
+        with self.assertRaises(NameError):
+            sync_back(dehfile, self.conn)
+        self.assertEqual(dehfile.states[S_PISTOL].tics, 5)
+        cursor.execute("UPDATE states SET action=NULL WHERE id=1")
+        cursor.execute("UPDATE sprnames SET name=NULL WHERE id=1")
+        with self.assertRaises(ValueError):
+            sync_back(dehfile, self.conn)
+        self.assertEqual(dehfile.states[S_PISTOL].tics, 5)
+        self.assertEqual(dehfile.sprnames[1], "ZZZZ")
+
+        with self.assertRaises(apsw.ConstraintError):
+            cursor.execute("DELETE FROM states")
+        with self.assertRaises(apsw.ConstraintError):
+            cursor.execute("UPDATE mobjinfo SET id=5 WHERE id=0")
+
+
+class TestWorkspace(unittest.TestCase):
+    PATCHES = ["fastimpattack.deh", "fastbfg.deh"]
+
+    def setUp(self):
+        directory = os.path.join(
+            os.path.dirname(__file__), "examples", "deh_files")
+        self.paths = [os.path.join(directory, name)
+                      for name in self.PATCHES]
+        self.conn = MakeWorkspace(self.paths, workers=2, warnings=[])
+
+    def test_workspace(self):
+        cursor = self.conn.cursor()
+        self.assertEqual(
+            list(cursor.execute("SELECT filename FROM patches")),
+            [(None,)] + [(path,) for path in self.paths])
+        expected = []
+        for patch_id, path in enumerate([None] + self.paths):
+            dehfile = DehackedFile()
+            if path is not None:
+                dehfile.load(path, warnings=[])
+            expected.append(dehfile)
+            rows = list(cursor.execute(
+                "SELECT id, tics, action FROM states WHERE patch_id=?",
+                (patch_id,)))
+            self.assertEqual(rows, [
+                (i, state.tics,
+                 state.action.name if state.action else None)
+                for i, state in enumerate(dehfile.states)])
+
+        # Which patches change each state:
+        query = """
+			SELECT DISTINCT s.patch_id FROM states AS s
+			JOIN states AS o ON o.patch_id = 0 AND o.id = s.id
+			WHERE s.patch_id > 0 AND s.enum_name = ?
+			  AND (s.sprite != o.sprite OR s.frame != o.frame
+			       OR s.tics != o.tics OR s.action IS NOT o.action
+			       OR s.nextstate != o.nextstate
+			       OR s.misc1 != o.misc1 OR s.misc2 != o.misc2)
+		"""
+        for state_id in range(1, len(expected[0].states)):
+            changed = [
+                (patch_id,)
+                for patch_id, dehfile in enumerate(expected)
+                if patch_id > 0 and dehfile.states[state_id].diff()]
+            if changed or state_id == S_PISTOL:
+                self.assertEqual(list(cursor.execute(
+                    query, (statenum_t[state_id],))), changed)
+        plan = list(cursor.execute(
+            "EXPLAIN QUERY PLAN " + query, ("S_PISTOL",)))
+        self.assertTrue(all("INDEX" in row[-1] for row in plan))
+
+        with self.assertRaises(apsw.Error):
+            cursor.execute("UPDATE states SET tics=1")
+
+    def test_order_by(self):
+        cursor = self.conn.cursor()
+        for order, expected_ids in (("id", [0, 1, 2]),
+                                    ("id DESC", [2, 1, 0])):
+            rows = list(cursor.execute("""
+				SELECT patch_id, id FROM states WHERE id < 3
+				ORDER BY patch_id, %s
+			""" % order))
+            self.assertEqual(rows, [
+                (patch_id, state_id)
+                for patch_id in range(len(self.paths) + 1)
+                for state_id in expected_ids])
+        rows = list(cursor.execute("""
+			SELECT patch_id, id FROM states WHERE id < 2
+			ORDER BY id, patch_id DESC
+		"""))
+        self.assertEqual(rows, [
+            (patch_id, state_id) for state_id in range(2)
+            for patch_id in reversed(range(len(self.paths) + 1))])
+
+    def test_shell(self):
+        # The .deh commands have no file to use on a workspace:
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "out.deh")
+        shell = Shell(None, db=self.conn, stdout=io.StringIO(),
+                      stderr=io.StringIO())
+        with self.assertRaises(Shell.Error):
+            shell.process_command(".dehsave %s" % path)
+        with self.assertRaises(Shell.Error):
+            shell.process_command(".dehload %s" % self.paths[0])
+        self.assertFalse(os.path.exists(path))
+
 
 if __name__ == "__main__":
     unittest.main()
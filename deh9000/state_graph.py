@@ -0,0 +1,258 @@
+"""Compiled view of the graph formed by the states' nextstate fields.
+
+Every state has at most one successor: the state in its nextstate field,
+unless that is the null state (S_NULL) or the state never ends (tics < 0).
+Chains of states (see StatesArray.walk()) are paths through this graph,
+which end either at a terminal state or by looping back on themselves.
+
+StateGraph keeps the successor of every state in a flat array, which is
+updated in place when a state changes, and derives the rest from it on
+demand:
+
+ * Successor and predecessor lists in CSR (compressed sparse row) form:
+   the successors of state n are targets[offsets[n]:offsets[n + 1]].
+ * The strongly connected components of the graph. As no state has more
+   than one successor, every component is either a single state or a loop.
+ * The chain of states starting from each entry state, as a tuple and as a
+   bitset.
+
+All of these are memoized, and thrown away when a successor changes.
+"""
+
+from __future__ import absolute_import
+
+import unittest
+from array import array
+
+from deh9000.states import S_NULL
+
+# Successor value of states that have no successor.
+NO_SUCCESSOR = -1
+
+class StateGraph(object):
+	"""Graph of the successors of a list of states.
+
+	'nextstate' and 'tics' are sequences of the states' field values.
+	If tics is None, no state is treated as never ending; this is
+	useful for following nextstate links regardless of tics.
+	"""
+	def __init__(self, nextstate, tics=None):
+		self.rebuild(nextstate, tics)
+
+	def rebuild(self, nextstate, tics=None):
+		"""Rebuild the whole graph from new field values."""
+		num_states = len(nextstate)
+		self.succ = array("q", [NO_SUCCESSOR]) * num_states
+		for state_id in range(num_states):
+			self.succ[state_id] = self._successor(
+				state_id, nextstate[state_id],
+				tics[state_id] if tics is not None else 0)
+		self._invalidate()
+
+	def _successor(self, state_id, nextstate, tics):
+		if (tics < 0 or nextstate == S_NULL
+		 or not 0 <= nextstate < len(self.succ)):
+			return NO_SUCCESSOR
+		return nextstate
+
+	def _invalidate(self):
+		self._chains = {}
+		self._chain_bits = {}
+		self._csr = None
+		self._reverse_csr = None
+		self._components = None
+
+	def __len__(self):
+		return len(self.succ)
+
+	def update(self, state_id, nextstate, tics=0):
+		"""Update the graph after a state's fields have changed."""
+		succ = self._successor(state_id, nextstate, tics)
+		if self.succ[state_id] != succ:
+			self.succ[state_id] = succ
+			self._invalidate()
+
+	def is_terminal(self, state_id):
+		"""Returns True if the given state has no successor."""
+		return self.succ[state_id] == NO_SUCCESSOR
+
+	def successors_csr(self):
+		"""Returns (offsets, targets) lists of successors in CSR form."""
+		if self._csr is None:
+			offsets = array("q", [0]) * (len(self.succ) + 1)
+			targets = array("q")
+			for state_id, succ in enumerate(self.succ):
+				if succ != NO_SUCCESSOR:
+					targets.append(succ)
+				offsets[state_id + 1] = len(targets)
+			self._csr = (offsets, targets)
+		return self._csr
+
+	def predecessors_csr(self):
+		"""Returns (offsets, sources) lists of predecessors in CSR form.
+
+		The states with state n as their successor are
+		sources[offsets[n]:offsets[n + 1]], in ascending order.
+		"""
+		if self._reverse_csr is None:
+			counts = array("q", [0]) * (len(self.succ) + 1)
+			for succ in self.succ:
+				if succ != NO_SUCCESSOR:
+					counts[succ + 1] += 1
+			for i in range(len(self.succ)):
+				counts[i + 1] += counts[i]
+			fill = counts[:-1]
+			sources = array("q", [0]) * counts[-1]
+			for state_id, succ in enumerate(self.succ):
+				if succ != NO_SUCCESSOR:
+					sources[fill[succ]] = state_id
+					fill[succ] += 1
+			self._reverse_csr = (counts, sources)
+		return self._reverse_csr
+
+	def components(self):
+		"""Returns the strongly connected components of the graph.
+
+		Returned is a tuple of (component, loops): 'component' is an
+		array giving the component number of each state, and 'loops'
+		is a dict mapping component numbers of loops to the list of
+		states in the loop, in order. States not in a loop are each in
+		a component of their own.
+		"""
+		if self._components is not None:
+			return self._components
+		succ = self.succ
+		component = array("q", [-1]) * len(succ)
+		loops = {}
+		# Position of each state in the path currently being
+		# followed; states already in a component are skipped.
+		for start in range(len(succ)):
+			if component[start] != -1:
+				continue
+			path = []
+			on_path = {}
+			state_id = start
+			while (state_id != NO_SUCCESSOR
+			       and component[state_id] == -1
+			       and state_id not in on_path):
+				on_path[state_id] = len(path)
+				path.append(state_id)
+				state_id = succ[state_id]
+			if state_id in on_path:
+				# The path has looped back on itself.
+				loop = path[on_path[state_id]:]
+				del path[on_path[state_id]:]
+				for member in loop:
+					component[member] = loop[0]
+				loops[loop[0]] = loop
+			for member in path:
+				component[member] = member
+		self._components = (component, loops)
+		return self._components
+
+	def chain(self, entry):
+		"""Returns a tuple of the states in the chain from 'entry'.
+
+		This is the same sequence as StatesArray.walk(): it ends at a
+		terminal state, or just before a state already in the chain.
+		"""
+		try:
+			return self._chains[entry]
+		except KeyError:
+			pass
+		succ = self.succ
+		path = []
+		path_bits = 0
+		state_id = entry
+		while state_id != NO_SUCCESSOR and state_id != S_NULL:
+			if not 0 <= state_id < len(succ):
+				break
+			bit = 1 << state_id
+			if path_bits & bit:
+				break
+			# Reuse a memoized chain from here on, if there is
+			# one that doesn't loop back into our path.
+			rest = self._chains.get(state_id)
+			if rest is not None and not (
+			    self._chain_bits[state_id] & path_bits):
+				path.extend(rest)
+				path_bits |= self._chain_bits[state_id]
+				break
+			path.append(state_id)
+			path_bits |= bit
+			state_id = succ[state_id]
+		result = tuple(path)
+		self._chains[entry] = result
+		self._chain_bits[entry] = path_bits
+		return result
+
+	def chain_bits(self, entry):
+		"""Returns the states in the chain from 'entry' as a bitset."""
+		if entry not in self._chain_bits:
+			self.chain(entry)
+		return self._chain_bits[entry]
+
+	def is_looping(self, entry):
+		"""Returns True if the chain from 'entry' ends in a loop."""
+		chain = self.chain(entry)
+		return bool(chain) and self.succ[chain[-1]] in chain
+
+	def successor(self, entry, offset):
+		"""Get the state 'offset' steps along from 'entry'.
+
+		This follows the nextstate links, around loops if necessary.
+		None is returned if the chain ends before then.
+		"""
+		chain = self.chain(entry)
+		if offset < len(chain):
+			return chain[offset]
+		if not self.is_looping(entry):
+			return None
+		loop_start = chain.index(self.succ[chain[-1]])
+		loop_len = len(chain) - loop_start
+		return chain[loop_start + (offset - loop_start) % loop_len]
+
+
+class TestStateGraph(unittest.TestCase):
+	# 1 -> 2 -> 3 -> 1 (loop), 4 -> 2, 5 -> 6 (terminal: tics < 0),
+	# 7 -> S_NULL.
+	NEXTSTATE = [0, 2, 3, 1, 2, 6, 9, 0]
+	TICS = [0, 1, 1, 1, 1, 1, -1, 1]
+
+	def setUp(self):
+		self.graph = StateGraph(self.NEXTSTATE, self.TICS)
+
+	def test_chains(self):
+		g = self.graph
+		self.assertEqual(g.chain(4), (4, 2, 3, 1))
+		self.assertEqual(g.chain(1), (1, 2, 3))
+		self.assertEqual(g.chain(5), (5, 6))
+		self.assertEqual(g.chain(0), ())
+		self.assertEqual(g.chain_bits(5), 0b1100000)
+		self.assertTrue(g.is_looping(4))
+		self.assertFalse(g.is_looping(7))
+		self.assertEqual(g.successor(4, 5), 3)
+		self.assertEqual(g.successor(5, 2), None)
+
+	def test_csr(self):
+		offsets, targets = self.graph.successors_csr()
+		self.assertEqual(list(targets[offsets[4]:offsets[5]]), [2])
+		self.assertEqual(offsets[7], offsets[8])
+		offsets, sources = self.graph.predecessors_csr()
+		self.assertEqual(list(sources[offsets[2]:offsets[3]]), [1, 4])
+
+	def test_components(self):
+		component, loops = self.graph.components()
+		self.assertEqual(loops, {1: [1, 2, 3]})
+		self.assertEqual(component[3], 1)
+		self.assertEqual(component[4], 4)
+
+	def test_update(self):
+		g = self.graph
+		self.assertEqual(g.chain(4), (4, 2, 3, 1))
+		g.update(3, 7)
+		self.assertEqual(g.chain(4), (4, 2, 3, 7))
+		self.assertEqual(g.components()[1], {})
+
+if __name__ == "__main__":
+	unittest.main()
@@ -7,6 +7,7 @@ found in info.h.
 
 from __future__ import absolute_import
 
+from deh9000 import actions
 from deh9000 import c
 
 
@@ -25,7 +26,7 @@ class state_t(c.Struct):
     sprite = c.StructField("Sprite number")
     frame = c.StructField("Sprite subnumber")
     tics = c.StructField("Duration")
-    action = c.StructField(None)
+    action = c.StructField(None, registry=actions.registry)
     nextstate = c.StructField("Next frame")
     misc1 = c.StructField("Unknown 1")
     misc2 = c.StructField("Unknown 2")
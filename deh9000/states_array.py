@@ -6,22 +6,26 @@ import dependency.
 
 from __future__ import absolute_import
 
-import re
-
 from deh9000 import c
+from deh9000 import deh_parser
+from deh9000 import state_graph
 from deh9000 import states_parser
 from deh9000 import strings
 from deh9000.states import *
 
-# Regexp for matching Pointer section headers:
-POINTER_HEADER_RE = re.compile(r"\s*Pointer\s+(?P<index>\d+)"
-                               r"(\s+\(.*\)\s*)?", re.I)
-
-# Pointer sections only have one "field", matched by this:
-POINTER_ASSIGN_RE = re.compile(r"\s*Codep Frame"
-                               r"\s*="
-                               r"\s*(?P<frame_num>\d+)")
+_sprite_ids = None
 
+def _sprite_id(name):
+	"""Look up a sprite name in the original sprnames list."""
+	global _sprite_ids
+	if _sprite_ids is None:
+		_sprite_ids = {}
+		for i, s in enumerate(strings.sprnames):
+			_sprite_ids.setdefault(s, i)
+	try:
+		return _sprite_ids[name]
+	except KeyError:
+		raise ValueError("%r is not in list" % (name,))
 
 class StatesArray(c.StructArray):
 	"""Wrapper around StructArray that adds some extra methods."""
@@ -39,7 +43,7 @@ class StatesArray(c.StructArray):
 	# map a set of sprite names into sprite numbers. The default here is
 	# just a function that looks them up in the sprnames list.
 	def assign_sprites(self, names):
-		return [strings.sprnames.index(name) for name in names]
+		return [_sprite_id(name) for name in names]
 
 	# These states are hard-coded into the Doom source code - bits
 	# of code jump to these states.
@@ -57,49 +61,175 @@ class StatesArray(c.StructArray):
 		S_PLAY_RUN1,
 	]
 
+	def graph(self):
+		"""Get the StateGraph for the states' nextstate links.
+
+		The graph is built on first use and then kept up to date as
+		states are changed. Anything derived from it (chains, loops)
+		is memoized until the nextstate or tics of a state changes.
+		"""
+		graph = self.__dict__.get("_graph")
+		if graph is None:
+			columns = self._store.columns
+			graph = self._graph = state_graph.StateGraph(
+				columns[state_t.nextstate.order],
+				columns[state_t.tics.order])
+			self._store.watchers.append(self._update_graph)
+		return graph
+
+	def _update_graph(self, index, bits):
+		if not bits & (state_t.nextstate.bit | state_t.tics.bit):
+			return
+		if index is None:
+			columns = self._store.columns
+			self._graph.rebuild(columns[state_t.nextstate.order],
+			                    columns[state_t.tics.order])
+			return
+		state = self[index]
+		self._graph.update(index, state.nextstate, state.tics)
+
 	def walk(self, index):
 		"""Iterate over states in sequence starting from given index.
 
 		Each state in the states array has a "nextstate" field that
-		indicates a state that follows it. This function returns a
-		generator that yields the index of each state in the sequence,
+		indicates a state that follows it. This function returns an
+		iterator that yields the index of each state in the sequence,
 		ending when the NULL state (0) is reached, a state is reached
 		that never ends (tics < 0), or when a state is reached that
-		has already been reached.
+		has already been reached. Sequences come from graph(), so
+		walking the same sequence again is a lookup.
 		"""
-		previous_states = set()
-		while index != S_NULL:
-			yield index
-			previous_states.add(index)
-			if self[index].tics < 0:
-				return
-			index = self[index].nextstate
-			if index in previous_states:
-				return
+		return iter(self.graph().chain(index))
+
+	def allocator(self):
+		"""Get the StateAllocator used by parse() by default.
+
+		The allocator persists between calls, so states allocated by
+		one call to parse() are not reused by the next, even if
+		nothing references them yet; call its release() method to
+		give them back if they won't be used after all. Its free
+		states are brought up to date by calling get_alloc_states().
+		"""
+		allocator = self.__dict__.get("_allocator")
+		if allocator is None:
+			allocator = self._allocator = (
+				states_parser.StateAllocator(self.original))
+		allocator.set_free(self.get_alloc_states())
+		return allocator
+
+	def reset_to_original(self, rows=None):
+		"""Restore rows to their original values.
+
+		If no rows are given, the whole array is restored, and states
+		claimed by allocator() are released too.
+		"""
+		super(StatesArray, self).reset_to_original(rows)
+		allocator = self.__dict__.get("_allocator")
+		if rows is None and allocator is not None:
+			allocator.release()
 
 	def parse(self, defstr, alloc_states=None):
 		"""Parse list of states in DECORATE format, copying into array.
 
 		The parameter alloc_states controls which states will be
-		allocated to copy the parsed states into the array. If not
-		specified, get_alloc_states() will be called to find which
-		states are free for reuse. You may need to call
-		DehackedFile.reclaim_states() first to free up some states.
+		allocated to copy the parsed states into the array: either a
+		StateAllocator, or a collection of state IDs. If not
+		specified, allocator() is used, which calls
+		get_alloc_states() to find which states are free for reuse.
+		You may need to call mobjinfo_t.clear_states() first to free
+		up some states.
 
 		States which are used will be removed from alloc_states.
 
 		Returned is a dictionary mapping from label name to index of
 		state representing that label.
 		"""
+		return self.parse_many({None: defstr}, alloc_states)[None]
+
+	def parse_many(self, defstrs, alloc_states=None, workers=None):
+		"""Parse many lists of states in DECORATE format at once.
+
+		'defstrs' is a dictionary mapping targets (any key; eg. mobj
+		numbers) to strings to parse. All strings are parsed before
+		any states are allocated, so that free states and sprites
+		only need to be found once, and the states for all of them
+		are allocated together (see states_parser.plan_remaps()).
+		If there aren't enough states or sprites for all of them,
+		nothing is changed. Strings are parsed using the memo in
+		states_parser, and if 'workers' is given, those not in the
+		memo are parsed in parallel using a pool of that many
+		processes.
+
+		alloc_states works the same as for parse(). Returned is a
+		dictionary mapping each target to a dictionary of its labels,
+		as returned by parse().
+		"""
+		targets = list(defstrs)
+		parsed = states_parser.memo.parse_many(
+			[defstrs[target] for target in targets], workers)
+		olds = [states for states, _, _ in parsed]
+
 		if alloc_states is None:
-			alloc_states = self.get_alloc_states()
-		states, labels, sprnames = states_parser.parse(defstr)
-		states_parser.remap_sprites(
-			states, self.assign_sprites(sprnames))
-		old_to_new = states_parser.remap_states(states, self,
-		                                        alloc_states)
-		return {label: old_to_new[state_id]
-		        for label, state_id in labels.items()}
+			allocator = self.allocator()
+		elif isinstance(alloc_states, states_parser.StateAllocator):
+			allocator = alloc_states
+		else:
+			allocator = states_parser.StateAllocator(
+				self.original, alloc_states)
+		snapshot = allocator.snapshot()
+		try:
+			old_to_news = states_parser.plan_remaps(olds, allocator)
+			sprnames = list(dict.fromkeys(
+				name for _, _, names in parsed for name in names))
+			sprite_ids = dict(zip(
+				sprnames, self.assign_sprites(sprnames)))
+		except Exception:
+			allocator.restore(snapshot)
+			raise
+
+		result = {}
+		for target, (states, labels, names), old_to_new in zip(
+				targets, parsed, old_to_news):
+			states_parser.copy_remapped(
+				states, self, old_to_new,
+				[sprite_ids[name] for name in names])
+			if (alloc_states is not None
+			    and alloc_states is not allocator):
+				for new_id in old_to_new[1:]:
+					alloc_states.remove(new_id)
+			result[target] = {label: old_to_new[state_id]
+			                  for label, state_id in labels}
+		return result
+
+
+def _pointer_maps(original):
+	"""Build the pointer number maps for an original states table.
+
+	The original tables are never modified, so the maps are built once
+	and cached on the array rather than every time a DehackedFile is
+	created.
+	"""
+	try:
+		return original._pointer_maps
+	except AttributeError:
+		pass
+	state_to_pointer = {}
+	pointer_to_state = {}
+	action_to_state = {}
+	for state_id, state in enumerate(original):
+		if state.action is not None:
+			ptr_id = len(state_to_pointer)
+			state_to_pointer[state_id] = ptr_id
+			pointer_to_state[ptr_id] = state_id
+			action_to_state[state.action] = state_id
+		elif None not in action_to_state:
+			# We want action_to_state to contain at least one
+			# entry for 'None', so we can null out action
+			# pointers if desired.
+			action_to_state[None] = state_id
+	original._pointer_maps = (
+		state_to_pointer, pointer_to_state, action_to_state)
+	return original._pointer_maps
 
 
 class CodePointers(object):
@@ -116,18 +246,8 @@ class CodePointers(object):
 	def __init__(self, states):
 		self.lax_mode = False
 		self.states = states
-		self._state_to_pointer = {}
-		self._action_to_state = {}
-		for state_id, state in enumerate(states.original):
-			if state.action is not None:
-				ptr_id = len(self._state_to_pointer)
-				self._state_to_pointer[state_id] = ptr_id
-				self._action_to_state[state.action] = state_id
-			elif None not in self._action_to_state:
-				# We want _action_to_state to contain at least
-				# one entry for 'None', so we can null out
-				# action pointers if desired.
-				self._action_to_state[None] = state_id
+		(self._state_to_pointer, self._pointer_to_state,
+		 self._action_to_state) = _pointer_maps(states.original)
 
 	def match_key(self):
 		return (CodePointers,)
@@ -138,10 +258,11 @@ class CodePointers(object):
 			ptr_id, state_id,
 			self._action_to_state[state.action])
 
-	def _sanity_check_pointers(self):
+	def _sanity_check_pointers(self, state_ids):
 		if self.lax_mode:
 			return
-		for state_id, state in enumerate(self.states):
+		for state_id in state_ids:
+			state = self.states[state_id]
 			assert (state.action is None
 			     or state_id in self._state_to_pointer), (
 				"State %d has an action pointer, but it isn't "
@@ -154,10 +275,17 @@ class CodePointers(object):
 			)
 
 	def dehacked_diffs(self, other=None):
-		other = other or self.states.original
-		self._sanity_check_pointers()
+		if other is None:
+			other = self.states.original
+			# Only states with an action in the change journal
+			# can differ from the original.
+			state_ids = self.states.changed_rows("action")
+		else:
+			state_ids = range(len(self.states))
+		self._sanity_check_pointers(state_ids)
 		result = []
-		for state_id, state in enumerate(self.states):
+		for state_id in state_ids:
+			state = self.states[state_id]
 			other_state = other[state_id]
 			# We need to look up the pointer ID for this state_id.
 			# But Vanilla Dehacked (and certain source ports) only
@@ -172,27 +300,23 @@ class CodePointers(object):
 		return result
 
 	@classmethod
-	def header_regexp(cls):
-		return POINTER_HEADER_RE
-
-	def parse_section(self, stream, index):
-		index = int(index)
-		for state_id, ptr_id in self._state_to_pointer.items():
-			if ptr_id == index:
-				to_state = self.states[state_id]
-				break
-		else:
-			stream.exception("invalid pointer ID %d" % index)
-
-		while True:
-			line = stream.readline()
-			if line.strip() == "":
-				break
-			m = POINTER_ASSIGN_RE.match(line)
-			if not m:
-				stream.exception("invalid syntax: %r" % line)
-			from_id = int(m.groupdict()["frame_num"])
-			to_state.action = self.states[from_id].action
+	def header_keyword(cls):
+		return "Pointer"
+
+	def apply_event(self, event):
+		if isinstance(event, deh_parser.SectionStart):
+			if event.index not in self._pointer_to_state:
+				raise ValueError("invalid pointer ID %d" % (
+					event.index))
+			return self
+		if not isinstance(event, deh_parser.PointerAssign):
+			raise ValueError("invalid syntax: %s = %d" % (
+				event.deh_name, event.value))
+		to_state = self.states[self._pointer_to_state[event.ptr]]
+		if not 0 <= event.frame < len(self.states):
+			raise ValueError("invalid frame number %d" % (
+				event.frame))
+		to_state.action = self.states[event.frame].action
 
 # TODO: Add tests.
 
@@ -82,11 +82,20 @@ pins.
 from __future__ import absolute_import
 from __future__ import print_function
 
+import collections
+import concurrent.futures
+import hashlib
+import marshal
+import os
 import re
+import shutil
+import tempfile
 import unittest
 
 from deh9000 import actions
-from deh9000.states import state_t, statenum_t
+from deh9000 import c
+from deh9000 import state_graph
+from deh9000.states import S_PLAY, state_t, statenum_t
 
 # eg. "Spawn:"
 GOTO_LABEL_RE = re.compile(r"\s*(?P<label>\w+)\s*:\s*")
@@ -164,6 +173,58 @@ def action_pointer_for_name(name):
     return getattr(actions, name)
 
 
+# Tokens generated by tokenize(). 'kind' is one of the keys of
+# _PREFIX_TOKENS or _STATEMENT_TOKENS below, and 'params' is a dict of the
+# named groups matched by the token's regexp.
+Token = collections.namedtuple("Token", ("kind", "params", "line_number"))
+
+# Tokens which can be followed by more tokens on the same line:
+_PREFIX_TOKENS = (
+    ("label", GOTO_LABEL_RE),
+    ("pin", PIN_STATE_RE),
+)
+
+# Tokens which must be the last thing on a line:
+_STATEMENT_TOKENS = (
+    ("frame", FRAME_DEF_RE),
+    ("goto", GOTO_STATEMENT_RE),
+    ("loop", LOOP_STATEMENT_RE),
+    ("stop", STOP_STATEMENT_RE),
+)
+
+# Matches the rest of a line if there's nothing left on it.
+_END_OF_LINE_RE = re.compile(r"\s*$")
+
+
+def tokenize(defstr):
+    """Generate a stream of Tokens from a States {} definition.
+
+	The input is scanned once: each line is matched in place using a
+	cursor rather than being sliced up as tokens are consumed.
+	"""
+    for line_number, line in enumerate(defstr.split("\n"), 1):
+        m = COMMENT_RE.search(line)
+        end = m.start() if m else len(line)
+        pos = 0
+        while not _END_OF_LINE_RE.match(line, pos, end):
+            for kind, regexp in _PREFIX_TOKENS:
+                m = regexp.match(line, pos, end)
+                if m:
+                    yield Token(kind, m.groupdict(), line_number)
+                    pos = m.end()
+                    break
+            else:
+                for kind, regexp in _STATEMENT_TOKENS:
+                    m = regexp.match(line, pos, end)
+                    if m:
+                        yield Token(kind, m.groupdict(), line_number)
+                        pos = end
+                        break
+                else:
+                    raise StatesParseException(
+                        "line %d: Parse error" % line_number)
+
+
 class _Parser(object):
     def __init__(self):
         self.sprnames = []
@@ -172,46 +233,10 @@ class _Parser(object):
         self.previous_state_id = -1
         self.loop_start_id = -1
         self.saved_gotos = []
-
-    def more_lines(self):
-        while self.lines and self.lines[0].strip() == "":
-            self.line_number += 1
-            self.lines.pop(0)
-        return len(self.lines) > 0
-
-    def next_line(self):
-        if not self.more_lines():
-            return ""
-        # print("next line: %r" % self.lines[0])
-        return self.lines[0]
-
-    def matches_regexp(self, regexp):
-        line = self.next_line()
-        m = regexp.match(line)
-        if m:
-            # print("%r matches %r" % (line, regexp))
-            self.lines[0] = line[m.end():]
-            return m
-
-    def parse_labels(self):
-        labels = set()
-        while True:
-            m = self.matches_regexp(GOTO_LABEL_RE)
-            if not m:
-                break
-            labels.add(m.groupdict()["label"])
-        return labels
-
-    def parse_pin(self):
-        m = self.matches_regexp(PIN_STATE_RE)
-        if not m:
-            return None
-        statenum = m.groupdict()["statenum"]
-        result = self.parse_state_number(statenum)
-        if result is None:
-            self.exception("State ID %r for pin() unknown." % (
-                statenum))
-        return result
+        self.line_number = 0
+        # Labels and pin for the next frame definition:
+        self.pending_labels = []
+        self.pending_pin = None
 
     def exception(self, s, line_number=None):
         if line_number is None:
@@ -232,9 +257,9 @@ class _Parser(object):
         if doom_name and doom_name not in self.state_labels:
             self.state_labels[doom_name] = state_id
 
-    def alloc_new_state(self):
+    def add_state(self, state):
         result = len(self.states)
-        self.states.append(state_t())
+        self.states.append(state)
         return result
 
     def sprite_for_name(self, name):
@@ -262,15 +287,23 @@ class _Parser(object):
                 action=action,
             )
 
-    def parse_frame_def(self):
-        labels = self.parse_labels()
-        pin_id = self.parse_pin()
-        m = self.matches_regexp(FRAME_DEF_RE)
-        if not m:
-            return False
-        for state in self.construct_states(m.groupdict()):
-            state_id = self.alloc_new_state()
-            self.states[state_id].copy_from(state)
+    def parse_label(self, params):
+        self.pending_labels.append(params["label"])
+
+    def parse_pin(self, params):
+        if self.pending_pin is not None:
+            self.exception("Multiple pins for the same state.")
+        statenum = params["statenum"]
+        self.pending_pin = self.parse_state_number(statenum)
+        if self.pending_pin is None:
+            self.exception("State ID %r for pin() unknown." % (
+                statenum))
+
+    def parse_frame_def(self, params):
+        labels, self.pending_labels = self.pending_labels, []
+        pin_id, self.pending_pin = self.pending_pin, None
+        for state in self.construct_states(params):
+            state_id = self.add_state(state)
 
             # Link in states in a chain:
             if self.previous_state_id != -1:
@@ -286,14 +319,19 @@ class _Parser(object):
             if pin_id is not None:
                 self.states[state_id].pin_state_id = pin_id
             # Only the first in sequence:
-            labels = set()
+            labels = []
             pin_id = None
-        return True
 
-    def parse_loop(self):
-        if not self.matches_regexp(LOOP_STATEMENT_RE):
-            return False
+    def check_no_pending(self):
+        # Labels and pins must be followed by a frame definition
+        # for them to apply to.
+        if self.pending_labels:
+            self.exception("Label %r without a following state" % (
+                self.pending_labels[0]))
+        if self.pending_pin is not None:
+            self.exception("Pin without a following state")
 
+    def parse_loop(self, params):
         if self.previous_state_id == -1:
             self.exception("Loop without a preceding state")
         if self.loop_start_id == -1:
@@ -302,19 +340,14 @@ class _Parser(object):
         state.nextstate = self.loop_start_id
         self.previous_state_id = -1
         self.loop_start_id = -1
-        return True
-
-    def parse_stop(self):
-        if not self.matches_regexp(STOP_STATEMENT_RE):
-            return False
 
+    def parse_stop(self, params):
         if self.previous_state_id == -1:
             self.exception("Stop without a preceding state")
         state = self.states[self.previous_state_id]
         state.nextstate = 0
         self.previous_state_id = -1
         self.loop_start_id = -1
-        return True
 
     def parse_state_number(self, s):
         """Returns state number if 's' describes a specific state."""
@@ -330,13 +363,9 @@ class _Parser(object):
             pass
         return None
 
-    def parse_goto(self):
-        m = self.matches_regexp(GOTO_STATEMENT_RE)
-        if not m:
-            return False
+    def parse_goto(self, params):
         if self.previous_state_id == -1:
             self.exception("Goto without a previous state")
-        params = m.groupdict()
         label = params["label"]
 
         # Try to parse as an absolute state ID, ie. S_* enum name or
@@ -360,47 +389,240 @@ class _Parser(object):
 
         self.previous_state_id = -1
         self.loop_start_id = -1
-        return True
 
-    def resolve_goto(self, line_number, label, offset):
+    def resolve_goto(self, graph, line_number, label, offset):
         if label not in self.state_labels:
             self.exception("Goto to unknown label %r" % (label),
                            line_number=line_number)
 
         state_id = self.state_labels[label]
-        for _ in range(offset):
-            next_state_id = self.states[state_id].nextstate
-            if next_state_id == -1:
-                self.exception(
-                    "Goto offset %r + %d is longer than "
-                    "animation sequence" % (
-                        label, offset),
-                    line_number=line_number)
-            state_id = next_state_id
+        if offset == 0:
+            return state_id
+        state_id = graph.successor(state_id, offset)
+        if state_id is None:
+            self.exception(
+                "Goto offset %r + %d is longer than "
+                "animation sequence" % (
+                    label, offset),
+                line_number=line_number)
         return state_id
 
     def apply_gotos(self):
-        for line_number, state_id, label, offset in self.saved_gotos:
+        # Gotos without an offset are applied first, so that offsets
+        # can then be followed through them using the state graph.
+        # Links to absolute states in the states[] table aren't part of
+        # the parsed sequences, so they are left out of the graph.
+        gotos = sorted(self.saved_gotos, key=lambda goto: goto[3] != 0)
+        graph = None
+        for line_number, state_id, label, offset in gotos:
+            if offset != 0 and graph is None:
+                graph = state_graph.StateGraph([
+                    0 if getattr(state, "no_remap_nextstate", False)
+                    else state.nextstate
+                    for state in self.states])
             self.states[state_id].nextstate = (
-                self.resolve_goto(line_number, label, offset))
+                self.resolve_goto(graph, line_number, label, offset))
 
     def parse(self, defstr):
-        # Split string into lines and remove comments:
-        self.lines = [COMMENT_RE.sub("", line)
-                      for line in defstr.split("\n")]
-        self.line_number = 1
-        while self.more_lines():
-            if (not self.parse_frame_def() and
-                    not self.parse_loop() and
-                    not self.parse_goto() and
-                    not self.parse_stop()):
-                self.exception("Parse error")
+        handlers = {
+            "label": self.parse_label,
+            "pin": self.parse_pin,
+            "frame": self.parse_frame_def,
+            "goto": self.parse_goto,
+            "loop": self.parse_loop,
+            "stop": self.parse_stop,
+        }
+        for token in tokenize(defstr):
+            self.line_number = token.line_number
+            if token.kind not in ("label", "pin", "frame"):
+                self.check_no_pending()
+            handlers[token.kind](token.params)
+        self.check_no_pending()
         if self.previous_state_id != -1:
             self.exception("sequence should end in stop, loop, "
                            "or goto")
         self.apply_gotos()
 
 
+# A parsed state: the values of the state_t fields, in field order, and
+# the extra attributes that the parser can set on a state.
+ParsedState = collections.namedtuple(
+    "ParsedState",
+    state_t._field_names + ("pin_state_id", "no_remap_nextstate"))
+
+# The result of parsing a string, as returned by parse_ir(). This is
+# immutable, so can be shared between callers: 'states' is a tuple of
+# ParsedStates, 'labels' a tuple of (label, state index) pairs and
+# 'sprnames' a tuple of sprite names.
+ParsedStates = collections.namedtuple(
+    "ParsedStates", ("states", "labels", "sprnames"))
+
+MemoStats = collections.namedtuple(
+    "MemoStats", ("hits", "disk_hits", "misses", "entries"))
+
+# Default maximum number of entries kept in memory by a ParseMemo.
+DEFAULT_MEMO_ENTRIES = 1024
+
+# Suffix of ParseMemo disk cache entry files.
+MEMO_ENTRY_SUFFIX = ".states"
+
+
+def _parse_uncached(defstr):
+    p = _Parser()
+    p.parse(defstr)
+    states = tuple(
+        ParsedState(*[getattr(state, f) for f in state_t._field_names],
+                    pin_state_id=getattr(state, "pin_state_id", -1),
+                    no_remap_nextstate=getattr(
+                        state, "no_remap_nextstate", False))
+        for state in p.states)
+    return ParsedStates(states, tuple(p.state_labels.items()),
+                        tuple(p.sprnames))
+
+
+class ParseMemo(object):
+    """Memo of the results of parsing strings with parse_ir().
+
+	The most recently used max_entries results are kept in memory. If
+	a directory is given, results are also stored there, keyed by a
+	hash of the string, so that they can be reused by later runs.
+	Strings which fail to parse are not remembered.
+	"""
+    def __init__(self, max_entries=DEFAULT_MEMO_ENTRIES, directory=None):
+        self.max_entries = max_entries
+        self.directory = directory
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, defstr):
+        # Entries hold registry indexes for actions, so are only valid
+        # for the same format of deltas (see cache.py).
+        from deh9000 import cache
+        h = hashlib.sha256(cache.get_format_key())
+        h.update(defstr.encode())
+        return os.path.join(self.directory,
+                            h.hexdigest() + MEMO_ENTRY_SUFFIX)
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as f:
+                states, labels, sprnames = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        registry = state_t.action.registry
+        action = state_t._field_names.index("action")
+        return ParsedStates(
+            tuple(ParsedState._make(
+                      row[:action] + (registry[row[action]],)
+                      + row[action + 1:])
+                  for row in states),
+            labels, sprnames)
+
+    def _write(self, path, result):
+        registry = state_t.action.registry
+        action = state_t._field_names.index("action")
+        states = tuple(
+            tuple(state[:action]) + (registry.index(state.action),)
+            + tuple(state[action + 1:])
+            for state in result.states)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "wb") as f:
+            marshal.dump((states, result.labels, result.sprnames), f)
+        os.replace(tmp_path, path)
+
+    def _lookup(self, defstr):
+        entries = self._entries
+        result = entries.get(defstr)
+        if result is not None:
+            entries.move_to_end(defstr)
+            self.hits += 1
+            return result
+        if self.directory is not None:
+            result = self._read(self._path(defstr))
+            if result is not None:
+                self.disk_hits += 1
+                self._remember(defstr, result)
+        return result
+
+    def _remember(self, defstr, result):
+        entries = self._entries
+        entries[defstr] = result
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def _add(self, defstr, result):
+        self.misses += 1
+        if self.directory is not None:
+            self._write(self._path(defstr), result)
+        self._remember(defstr, result)
+
+    def parse(self, defstr):
+        """Get the ParsedStates for a string, parsing it if needed."""
+        result = self._lookup(defstr)
+        if result is None:
+            result = _parse_uncached(defstr)
+            self._add(defstr, result)
+        return result
+
+    def parse_many(self, defstrs, workers=None):
+        """Get a list of the ParsedStates for many strings.
+
+		If 'workers' is given, strings that need to be parsed are
+		parsed in parallel using a pool of that many processes.
+		"""
+        results = {}
+        missing = []
+        seen = set()
+        for defstr in defstrs:
+            if defstr in seen:
+                continue
+            seen.add(defstr)
+            result = self._lookup(defstr)
+            if result is None:
+                missing.append(defstr)
+            else:
+                results[defstr] = result
+        if workers is None or len(missing) < 2:
+            parsed = [_parse_uncached(defstr) for defstr in missing]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                    workers) as executor:
+                parsed = list(executor.map(_parse_uncached, missing))
+        for defstr, result in zip(missing, parsed):
+            self._add(defstr, result)
+            results[defstr] = result
+        return [results[defstr] for defstr in defstrs]
+
+    def stats(self):
+        """Get a MemoStats with the hit and miss counts."""
+        return MemoStats(self.hits, self.disk_hits, self.misses,
+                         len(self._entries))
+
+    def clear(self):
+        """Forget all results kept in memory."""
+        self._entries.clear()
+
+
+# The memo used by parse_ir(). This can be replaced, eg. with one that
+# has a disk cache directory.
+memo = ParseMemo()
+
+
+def parse_ir(defstr):
+    """Parses a string in DECORATE-style States {} syntax.
+
+	This is the same as parse(), except that the result is an immutable
+	ParsedStates, and comes from the memo if the same string has been
+	parsed before. The states can be copied into a states array using
+	copy_remapped().
+	"""
+    return memo.parse(defstr)
+
+
 def parse(defstr):
     """Parses a string in DECORATE-style States {} syntax.
 
@@ -413,87 +635,343 @@ def parse(defstr):
 	   indexes in the states list to the states they represent.
 	 - List of sprite names in the parsed states. The sprite field for each
 	   state_t is an index into this list.
+
+	The result is built from parse_ir(), so is new each time and can be
+	changed by the caller.
 	"""
-    p = _Parser()
-    p.parse(defstr)
-    return p.states, p.state_labels, p.sprnames
+    parsed = parse_ir(defstr)
+    states = []
+    for parsed_state in parsed.states:
+        state = state_t(**dict(zip(state_t._field_names, parsed_state)))
+        if parsed_state.pin_state_id != -1:
+            state.pin_state_id = parsed_state.pin_state_id
+        if parsed_state.no_remap_nextstate:
+            state.no_remap_nextstate = True
+        states.append(state)
+    return states, dict(parsed.labels), list(parsed.sprnames)
 
 
-def _generate_old_to_new(old, new, alloc_states):
-    """Generate old ID -> new ID mapping table.
+def _lowest_bit(bits):
+    return (bits & -bits).bit_length() - 1
 
-	It's assumed that state 0 is always NULL.
+
+def _runs(bits):
+    """Yield (start, length) for each run of consecutive set bits."""
+    while bits:
+        start = _lowest_bit(bits)
+        shifted = bits >> start
+        # Number of trailing one bits:
+        length = (~shifted & (shifted + 1)).bit_length() - 1
+        yield start, length
+        bits &= ~(((1 << length) - 1) << start)
+
+
+def _action_capable_bits(original):
+    """Get a bitset of the states which can have an action pointer.
+
+	These are the states which have an action pointer in the original
+	table (and so a Dehacked pointer number). The original tables are
+	never modified, so the bitset is cached on the array.
 	"""
-    if len(old) - 1 > len(alloc_states):
-        raise StateRemapException(
-            "Can't remap %d states from old: only have %d free "
-            "states to work with." % (
-                len(old) - 1, len(alloc_states)))
+    try:
+        return original._action_capable_bits
+    except AttributeError:
+        pass
+    actions = original._store.columns[state_t.action.order]
+    bits = 0
+    for state_id, action in enumerate(actions):
+        if action != 0:
+            bits |= 1 << state_id
+    original._action_capable_bits = bits
+    return bits
+
+
+class StateAllocator(object):
+    """Allocates state IDs to copy parsed states into.
+
+	Free state IDs are kept in two ordered free-lists (as bitsets): the
+	states which can have an action pointer in a Vanilla patch, which
+	are scarce, and the plain states which can't. States are allocated
+	from the list that matches what they need, and where possible a
+	sequence of states is placed in a run of adjacent state IDs, using
+	the smallest run that fits without wasting action-capable states.
+	Allocation only depends on which states are free, so the same
+	input always gives the same state IDs.
+
+	States that have been allocated are remembered as claimed until
+	they come into use: set_free() never hands them out again, even
+	though nothing references them yet. If an allocation is abandoned
+	instead, release() gives the states back.
+	"""
+    def __init__(self, original, free_states=()):
+        self.action_capable = _action_capable_bits(original)
+        self.claimed = 0
+        self.free_action = 0
+        self.free_plain = 0
+        self.set_free(free_states)
+
+    def set_free(self, free_states):
+        """Set the states which are free, eg. from free_states().
+
+		Claimed states in the given collection stay allocated; claimed
+		states not in it are now in use, and are no longer tracked.
+		"""
+        if isinstance(free_states, c.EnumSet):
+            bits = free_states.bits
+        else:
+            bits = 0
+            for state_id in free_states:
+                bits |= 1 << state_id
+        self.claimed &= bits
+        bits &= ~self.claimed
+        self.free_action = bits & self.action_capable
+        self.free_plain = bits & ~self.action_capable
+
+    def __len__(self):
+        return bin(self.free_action | self.free_plain).count("1")
+
+    def __contains__(self, state_id):
+        return bool((self.free_action | self.free_plain) >> state_id & 1)
+
+    def free_states(self):
+        """Returns an EnumSet of the states that can be allocated."""
+        return c.EnumSet.from_bits(
+            statenum_t, self.free_action | self.free_plain)
+
+    def snapshot(self):
+        """Get the allocator's state, to be passed to restore()."""
+        return self.claimed, self.free_action, self.free_plain
+
+    def restore(self, snapshot):
+        """Undo all allocations made since snapshot() was called."""
+        self.claimed, self.free_action, self.free_plain = snapshot
+
+    def release(self, state_ids=None):
+        """Stop holding claimed states, eg. after an abandoned allocation.
+
+		The given states (or every claimed state, if none are given)
+		can be allocated again once set_free() next finds them free.
+		"""
+        if state_ids is None:
+            self.claimed = 0
+            return
+        for state_id in state_ids:
+            self.claimed &= ~(1 << state_id)
+
+    def reserve(self, state_id):
+        """Allocate a specific state, eg. for a pinned state."""
+        bit = 1 << state_id
+        if not (self.free_action | self.free_plain) & bit:
+            raise StateRemapException(
+                "Can't pin parsed state to state #%d (%s); it "
+                "is not free to allocate." % (
+                    state_id, statenum_t[state_id]))
+        self.free_action &= ~bit
+        self.free_plain &= ~bit
+        self.claimed |= bit
+
+    def _best_fit(self, need_bits, count):
+        """Find a run of adjacent states for a sequence of states.
+
+		need_bits has a bit set for each state in the sequence that
+		needs an action pointer. The states must line up with free
+		states of the right kind: action-capable states exactly where
+		they are needed. Returned is the first state ID in the
+		smallest run of free states that fits, or None if none does.
+		"""
+        mask = (1 << count) - 1
+        best, best_length = None, None
+        for start, length in _runs(self.free_action | self.free_plain):
+            if length < count or (best is not None
+                                  and length >= best_length):
+                continue
+            for first in range(start, start + length - count + 1):
+                window = (self.free_action >> first) & mask
+                if window == need_bits:
+                    best, best_length = first, length
+                    break
+            if best_length == count:
+                break
+        return best
+
+    def _smallest_block(self, num_action, num_plain):
+        """Find the smallest block of states with enough free states.
+
+		Returned is a tuple of two lists of the free states in the
+		block that has the smallest range of state IDs containing at
+		least num_action action-capable states and num_plain plain
+		states: the action-capable states and the plain states.
+		"""
+        free = bin(self.free_action | self.free_plain)[:1:-1]
+        action = bin(self.free_action)[:1:-1]
+        free_ids = [state_id for state_id, bit in enumerate(free)
+                    if bit == "1"]
+        is_action = [action[state_id:state_id + 1] == "1"
+                     for state_id in free_ids]
+        counts = [0, 0]
+        best, best_span = None, None
+        lo = 0
+        for hi, state_id in enumerate(free_ids):
+            counts[is_action[hi]] += 1
+            # Shrink the block from the bottom for as long as it
+            # still has enough states of both kinds.
+            while lo < hi:
+                kind = is_action[lo]
+                counts[kind] -= 1
+                if counts[True] < num_action or counts[False] < num_plain:
+                    counts[kind] += 1
+                    break
+                lo += 1
+            if counts[True] >= num_action and counts[False] >= num_plain:
+                span = state_id - free_ids[lo]
+                if best is None or span < best_span:
+                    best, best_span = (lo, hi), span
+        block = range(best[0], best[1] + 1)
+        return ([free_ids[i] for i in block if is_action[i]],
+                [free_ids[i] for i in block if not is_action[i]])
+
+    def allocate(self, needs_action):
+        """Allocate states for a sequence of states.
+
+		needs_action is a list with a boolean for each state, true if
+		it needs an action pointer. Returned is a list of the state
+		IDs allocated, in the same order.
+		"""
+        count = len(needs_action)
+        if count > len(self):
+            raise StateRemapException(
+                "Can't allocate %d states: only have %d free "
+                "states to work with." % (count, len(self)))
+        if count == 0:
+            return []
+        need_bits = 0
+        for i, action in enumerate(needs_action):
+            if action:
+                need_bits |= 1 << i
+        first = self._best_fit(need_bits, count)
+        if first is not None:
+            result = list(range(first, first + count))
+        else:
+            result = self._allocate_block(needs_action)
+        for state_id in result:
+            self.reserve(state_id)
+        return result
+
+    def _allocate_block(self, needs_action):
+        # There's no run that the sequence fits into exactly, so
+        # place it in the smallest block that has enough states of
+        # each kind, in order within each kind. If there aren't enough
+        # action-capable states, states that need an action use plain
+        # states (which won't work, unless BEX codeptrs are used); if
+        # there aren't enough plain states, plain states use
+        # action-capable ones (wasteful, but there are no others).
+        num_free_action = bin(self.free_action).count("1")
+        num_free_plain = bin(self.free_plain).count("1")
+        num_action = sum(needs_action)
+        num_plain = len(needs_action) - num_action
+        action_in_action = min(num_action, num_free_action)
+        action_in_plain = num_action - action_in_action
+        plain_in_plain = min(num_plain, num_free_plain - action_in_plain)
+        plain_in_action = num_plain - plain_in_plain
+        action_ids, plain_ids = self._smallest_block(
+            action_in_action + plain_in_action,
+            action_in_plain + plain_in_plain)
+        action_ids = iter(action_ids)
+        plain_ids = iter(plain_ids)
+        result = []
+        for action in needs_action:
+            if action:
+                action_in_action -= 1
+                ids = action_ids if action_in_action >= 0 else plain_ids
+            else:
+                plain_in_plain -= 1
+                ids = plain_ids if plain_in_plain >= 0 else action_ids
+            result.append(next(ids))
+        return result
+
+
+def _reserve_pins(old, allocator):
+    """Reserve the states that parsed states are pinned to.
 
+	Returned is the old ID -> new ID mapping table with only the pinned
+	states filled in, and a list of the old IDs of the other states.
+	"""
     # When parsing above we can flag states to be "pinned" to particular
     # state IDs when we copy into the state table. So assign these first
     # before we do any other logic.
     old_to_new = [0] * len(old)
+    unpinned = []
     for old_id in range(1, len(old)):
         pin_id = getattr(old[old_id], "pin_state_id", -1)
         if pin_id == -1:
+            unpinned.append(old_id)
             continue
-        if pin_id not in alloc_states:
+        if pin_id not in allocator:
             raise StateRemapException(
                 "Can't pin parsed state to state #%d (%s); it "
                 "is not found in alloc_states collection." % (
                     pin_id, statenum_t[pin_id]))
-        alloc_states.remove(pin_id)
+        allocator.reserve(pin_id)
         old_to_new[old_id] = pin_id
+    return old_to_new, unpinned
 
-    # Categorize states by whether they can have an action pointer:
-    alloc_action = set()
-    alloc_non_action = set()
-    for state_id in alloc_states:
-        if new[state_id].original.action is not None:
-            alloc_action.add(state_id)
-        else:
-            alloc_non_action.add(state_id)
 
-    # Build old->new map, allocating from alloc_action for states which
-    # need an action, and from alloc_non_action for states which don't.
-    for old_id in range(1, len(old)):
-        if hasattr(old[old_id], "pin_state_id"):
-            continue
-        if old[old_id].action is not None:
-            if len(alloc_action) > 0:
-                new_id = alloc_action.pop()
-            else:
-                # Won't work, unless BEX codeptrs are used:
-                new_id = alloc_non_action.pop()
-        else:
-            if len(alloc_non_action) > 0:
-                new_id = alloc_non_action.pop()
-            else:
-                # This is "wasteful" but there are no others:
-                new_id = alloc_action.pop()
-        old_to_new[old_id] = new_id
-        alloc_states.remove(new_id)
+def plan_remaps(olds, allocator):
+    """Generate old ID -> new ID mapping tables for many lists of states.
 
-    return old_to_new
+	'olds' is a list of lists of states as returned by parse(). The
+	states are all allocated together: first the pinned states of every
+	list, and then the rest of each list as one sequence, biggest first,
+	as big sequences are the hardest to fit into a run of states. If
+	there aren't enough states for all of them, StateRemapException is
+	raised. It's assumed that state 0 of each list is always NULL.
+	"""
+    total = sum(len(old) - 1 for old in olds)
+    if total > len(allocator):
+        raise StateRemapException(
+            "Can't remap %d states from old: only have %d free "
+            "states to work with." % (total, len(allocator)))
 
+    pinned = [_reserve_pins(old, allocator) for old in olds]
+    order = sorted(range(len(olds)),
+                   key=lambda i: (-len(pinned[i][1]), i))
+    # The other states are allocated as one sequence, so that states
+    # which follow each other end up next to each other.
+    for i in order:
+        old_to_new, unpinned = pinned[i]
+        new_ids = allocator.allocate(
+            [olds[i][old_id].action is not None for old_id in unpinned])
+        for old_id, new_id in zip(unpinned, new_ids):
+            old_to_new[old_id] = new_id
 
-def remap_states(old, new, alloc_states):
-    """Copy all states from old into new, remapping state IDs.
+    return [old_to_new for old_to_new, _ in pinned]
 
-	alloc_states is a collection (list or set) of indexes into "new" which
-	can be used to store the states copied from "old". Values are removed
-	from this collection (via .pop()) that are consumed remapping states.
 
-	The first state (old[0]) is not copied; it's assumed that state ID 0
-	is a special value meaning NULL (S_NULL).
+def _generate_old_to_new(old, new, allocator):
+    """Generate old ID -> new ID mapping table.
+
+	It's assumed that state 0 is always NULL.
 	"""
-    old_to_new = _generate_old_to_new(old, new, alloc_states)
+    return plan_remaps([old], allocator)[0]
 
-    # Copy over all states.
+
+def copy_remapped(old, new, old_to_new, sprite_ids=None):
+    """Copy all states from old into new, using a mapping table.
+
+	old is a list of states as returned by parse(), or the states of a
+	ParsedStates from parse_ir(), and old_to_new is a table generated by
+	plan_remaps(). The first state (old[0]) is not copied. If sprite_ids
+	is given, the sprite fields are remapped using it, the same as
+	remap_sprites() does.
+	"""
+    if old and isinstance(old[0], ParsedState):
+        _copy_parsed(old, new, old_to_new, sprite_ids)
+        return
     for old_id in range(1, len(old)):
         new_id = old_to_new[old_id]
         new[new_id].copy_from(old[old_id])
+        if sprite_ids is not None:
+            new[new_id].sprite = sprite_ids[old[old_id].sprite]
         nextstate = new[new_id].nextstate
         # Remap the nextstate reference for the new array, unless it's
         # the "none" value of -1, or this state has been flagged to
@@ -502,6 +980,51 @@ def remap_states(old, new, alloc_states):
                 not getattr(old[old_id], "no_remap_nextstate", False)):
             new[new_id].nextstate = old_to_new[nextstate]
 
+
+def _copy_parsed(old, new, old_to_new, sprite_ids):
+    # ParsedStates hold plain values, so they're written to the array
+    # in one go as a delta (see c.StructArray.apply_delta()).
+    registry = state_t.action.registry
+    names = state_t._field_names
+    sprite = names.index("sprite")
+    action = names.index("action")
+    nextstate = names.index("nextstate")
+    delta = []
+    for old_id in range(1, len(old)):
+        state = old[old_id]
+        values = list(state[:len(names)])
+        values[action] = registry.index(state.action)
+        if sprite_ids is not None:
+            values[sprite] = sprite_ids[state.sprite]
+        if state.nextstate != -1 and not state.no_remap_nextstate:
+            values[nextstate] = old_to_new[state.nextstate]
+        new_id = old_to_new[old_id]
+        delta.append((new_id, None, tuple(enumerate(values))))
+        if new[new_id].object_name is not None:
+            new[new_id].object_name = None
+    new.apply_delta(tuple(delta))
+
+
+def remap_states(old, new, alloc_states):
+    """Copy all states from old into new, remapping state IDs.
+
+	alloc_states is either a StateAllocator or a collection (list or set)
+	of indexes into "new" which can be used to store the states copied
+	from "old". Values that are consumed remapping states are removed
+	from the collection (via .remove()).
+
+	The first state (old[0]) is not copied; it's assumed that state ID 0
+	is a special value meaning NULL (S_NULL).
+	"""
+    if isinstance(alloc_states, StateAllocator):
+        old_to_new = _generate_old_to_new(old, new, alloc_states)
+    else:
+        allocator = StateAllocator(new.original, alloc_states)
+        old_to_new = _generate_old_to_new(old, new, allocator)
+        for new_id in old_to_new[1:]:
+            alloc_states.remove(new_id)
+
+    copy_remapped(old, new, old_to_new)
     return old_to_new
 
 
@@ -511,5 +1034,158 @@ def remap_sprites(states, sprite_ids):
         state.sprite = sprite_ids[state.sprite]
 
 
+class TestParser(unittest.TestCase):
+    DEFSTR = """
+      Spawn:  # Comment
+        TROO AB 10 A_Look
+        Loop
+      See: Pin(S_PLAY):
+        TROO CD 3 bright
+        Goto Spawn+1
+      Death:
+        TROO E 5
+        Stop
+    """
+
+    def test_tokenize(self):
+        self.assertEqual(
+            [(t.kind, t.line_number) for t in tokenize(self.DEFSTR)], [
+                ("label", 2), ("frame", 3), ("loop", 4),
+                ("label", 5), ("pin", 5), ("frame", 6), ("goto", 7),
+                ("label", 8), ("frame", 9), ("stop", 10),
+            ])
+
+    def test_parse(self):
+        states, labels, sprnames = parse(self.DEFSTR)
+        self.assertEqual(sprnames, ["TROO"])
+        self.assertEqual(labels, {
+            "Spawn": 1, "spawnstate": 1,
+            "See": 3, "seestate": 3,
+            "Death": 5, "deathstate": 5,
+        })
+        self.assertEqual([s.nextstate for s in states[1:]],
+                         [2, 1, 4, 2, 0])
+        self.assertEqual(states[3].pin_state_id, statenum_t.index("S_PLAY"))
+        self.assertEqual(states[3].frame, 2 | 32768)
+        self.assertEqual(states[1].action, actions.A_Look)
+
+    def test_goto_offset(self):
+        # Offsets are followed around loops, and through other Gotos.
+        states, labels, _ = parse(
+            "Spawn:\nTROO AB 5\nGoto Next\n"
+            "Next:\nTROO C 5\nLoop\n"
+            "See:\nTROO D 5\nGoto Spawn+4\n")
+        self.assertEqual(states[labels["See"]].nextstate, labels["Next"])
+
+    def test_errors(self):
+        for defstr in ("TROO A 5", "TROO A 5\nLoop",
+                       "See:\nTROO A 5\nLoop\nFoo:",
+                       "See:\nTROO A 5\nGoto Nowhere",
+                       "See: TROO A 5 Loop",
+                       "See:\nTROO AB 5\nStop\nDeath:\nTROO C 5\n"
+                       "Goto See+2"):
+            with self.assertRaises(StatesParseException):
+                parse(defstr)
+
+
+class TestStateAllocator(unittest.TestCase):
+    # Which states from 2 to 19 have actions in the original table:
+    # 2-8 don't; 9, 11, 12, 17 and 18 do.
+
+    def setUp(self):
+        from deh9000.file import DehackedFile
+        self.states = DehackedFile().states
+
+    def test_runs(self):
+        self.assertEqual(list(_runs(0b1110011)), [(0, 2), (4, 3)])
+
+    def test_best_fit(self):
+        free = set(range(2, 6)) | set(range(8, 20))
+        allocator = StateAllocator(self.states.original, free)
+        self.assertEqual(allocator.allocate([True, False]), [9, 10])
+        # The smallest run that fits is used:
+        self.assertEqual(allocator.allocate([False, False]), [2, 3])
+        self.assertEqual(allocator.allocate([True, True, False]),
+                         [11, 12, 13])
+        self.assertNotIn(9, allocator)
+        with self.assertRaises(StateRemapException):
+            allocator.reserve(9)
+
+    def test_block(self):
+        allocator = StateAllocator(self.states.original, {8, 9, 10, 11})
+        # No run fits exactly, so states are placed by kind:
+        self.assertEqual(allocator.allocate([True, True, False]),
+                         [9, 11, 10])
+        self.assertEqual(allocator.allocate([True]), [8])
+        with self.assertRaises(StateRemapException):
+            allocator.allocate([False])
+
+    def test_parse(self):
+        self.states.get_alloc_states = lambda: {2, 3, 4}
+        labels = self.states.parse("Pin(4): TROO A 5\nSee: TROO B 5\nLoop")
+        self.assertEqual(labels["See"], 2)
+        # The state is still unreferenced, but isn't reused:
+        self.assertEqual(list(self.states.allocator().free_states()), [3])
+        # Once it comes into use and is freed again, it's reused:
+        self.states.get_alloc_states = lambda: {3}
+        self.assertEqual(len(self.states.allocator()), 1)
+        self.states.get_alloc_states = lambda: {2, 3}
+        self.assertEqual(len(self.states.allocator()), 2)
+
+    def test_release(self):
+        self.states.get_alloc_states = lambda: {2, 3, 4}
+        self.states.parse("Spawn: TROO A 5\nLoop")
+        self.assertEqual(len(self.states.allocator()), 2)
+        self.states.allocator().release()
+        self.assertEqual(len(self.states.allocator()), 3)
+        # Resetting the array releases every claimed state:
+        self.states.parse("Spawn: TROO A 5\nLoop")
+        self.states.reset_to_original()
+        self.assertEqual(len(self.states.allocator()), 3)
+
+
+class TestParseMemo(unittest.TestCase):
+    DEFSTR = "See: Pin(S_PLAY):\nTROO AB 5 A_Chase\nLoop"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_memo(self):
+        memo = ParseMemo(max_entries=1)
+        result = memo.parse(self.DEFSTR)
+        self.assertIs(memo.parse(self.DEFSTR), result)
+        memo.parse("TROO A -1\nStop")
+        self.assertIsNot(memo.parse(self.DEFSTR), result)
+        self.assertEqual(memo.stats(), MemoStats(
+            hits=1, disk_hits=0, misses=3, entries=1))
+        self.assertEqual(result.states[1].action, actions.A_Chase)
+        self.assertEqual(result.states[1].pin_state_id, S_PLAY)
+        self.assertEqual(dict(result.labels)["seestate"], 1)
+        with self.assertRaises(StatesParseException):
+            memo.parse("Goto Nowhere")
+
+    def test_disk(self):
+        expected = ParseMemo(directory=self.directory).parse(self.DEFSTR)
+        memo = ParseMemo(directory=self.directory)
+        self.assertEqual(memo.parse_many([self.DEFSTR] * 2),
+                         [expected] * 2)
+        self.assertEqual(memo.parse(self.DEFSTR), expected)
+        self.assertEqual(memo.stats(), MemoStats(
+            hits=1, disk_hits=1, misses=0, entries=1))
+
+    def test_parse_copies(self):
+        # parse() returns new objects each time, which can be changed
+        # without affecting the memo:
+        states, labels, _ = parse(self.DEFSTR)
+        states[1].tics = 99
+        labels.clear()
+        states, labels, _ = parse(self.DEFSTR)
+        self.assertEqual(states[1].tics, 5)
+        self.assertEqual(labels["See"], 1)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -2,17 +2,12 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
-import re
+import bisect
+import copy
 import unittest
 
 from deh9000 import strings
 
-# Regexp that matches the start of Text sections.
-TEXT_HEADER_RE = re.compile(r"\s*Text"
-                            r"\s+(?P<from_len>\d+)"
-                            r"\s+(?P<to_len>\d+)"
-                            r"\s*$", re.I)
-
 class StringReplacements(object):
 	"""Class that wraps the functionality of dehacked string replacements.
 
@@ -35,32 +30,80 @@ class StringReplacements(object):
 	d_englsh.h in the Doom source) just by setting a property:
 
 	  s.GOTREDSKULL = "Picked up a pink skull key."
+
+	Every replacement that is set is recorded in a change journal (even
+	one that sets a string back to its original value), so that diffs
+	only need to look at the strings that have been written.
 	"""
+	# Replaced in __init__; this is just so that __setattr__ works
+	# before then.
+	_properties = frozenset()
+
 	def __init__(self, module=None, base_module=strings):
 		self._extras = {}
+		self._dirty = set()
 		self._properties = set()
 		self._string_lists = set()
-		# Build a reverse mapping from original string back
-		# to property name.
+		# StringLists to notify when each string is replaced:
+		self._watchers = {}
+		# Build a mapping from property name to original string
+		# and a reverse mapping from original string back to
+		# property name.
+		self._forward_map = {}
 		self._reverse_map = {}
 		for propname in dir(base_module):
 			if propname.startswith("__"):
 				continue
 			value = getattr(base_module, propname)
 			if isinstance(value, str):
+				self._forward_map[propname] = value
 				self._reverse_map[value] = propname
 				self._properties.add(propname)
+				object.__setattr__(self, propname, value)
 			elif isinstance(value, (tuple, list)):
-				setattr(self, propname,
-				        StringList(self, value))
 				self._string_lists.add(propname)
+		# The lists are created once every property has a value,
+		# as they read the current values of their strings.
+		for propname in self._string_lists:
+			object.__setattr__(self, propname, StringList(
+				self, getattr(base_module, propname)))
 		# Load strings from base_module (strings.py) and then
 		# (optionally) overwrite with strings from a modified version
 		# if one has been provided.
 		self.load_from_module(base_module)
+		self._dirty.clear()
 		if module is not None:
 			self.load_from_module(module)
 
+	def __copy__(self):
+		result = StringReplacements.__new__(StringReplacements)
+		# The maps built by __init__ never change, so can be shared.
+		for name, value in self.__dict__.items():
+			object.__setattr__(result, name, value)
+		result._extras = dict(self._extras)
+		result._dirty = set(self._dirty)
+		result._watchers = {}
+		for propname in self._string_lists:
+			object.__setattr__(result, propname, StringList(
+				result, getattr(self, propname).original))
+		return result
+
+	def __setattr__(self, name, value):
+		object.__setattr__(self, name, value)
+		if name in self._properties:
+			s = self._forward_map[name]
+			self._dirty.add(s)
+			self._notify(s)
+
+	def _watch(self, string_list, strings):
+		"""Register a StringList to be told when strings change."""
+		for s in strings:
+			self._watchers.setdefault(s, []).append(string_list)
+
+	def _notify(self, s):
+		for string_list in self._watchers.get(s, ()):
+			string_list._update(s)
+
 	def load_from_module(self, module):
 		"""Load strings from the given module.
 
@@ -112,6 +155,8 @@ class StringReplacements(object):
 			setattr(self, propname, replacement)
 		else:
 			self._extras[s] = replacement
+			self._dirty.add(s)
+			self._notify(s)
 
 	def __len__(self):
 		return len(self._reverse_map) + len(self._extras)
@@ -138,13 +183,59 @@ class StringReplacements(object):
 	def values(self):
 		return list(self.itervalues())
 
+	def changed_keys(self):
+		"""Get a sorted list of the strings that have been replaced.
+
+		This comes from the change journal, so it includes strings
+		which were set back to their original value.
+		"""
+		return sorted(self._dirty)
+
+	def reset_to_original(self, keys=None):
+		"""Undo replacements, restoring strings to their originals.
+
+		If no keys are given, every replacement in the change journal
+		is undone.
+		"""
+		if keys is None:
+			keys = list(self._dirty)
+		for s in keys:
+			if s in self._reverse_map:
+				object.__setattr__(
+					self, self._reverse_map[s], s)
+			else:
+				self._extras.pop(s, None)
+			self._dirty.discard(s)
+			self._notify(s)
+
+	def delta(self):
+		"""Get a tuple of (old, new) pairs for replaced strings.
+
+		Like changed_keys(), this comes from the change journal. The
+		result can be applied to another StringReplacements object
+		with apply_delta().
+		"""
+		return tuple((s, self[s]) for s in sorted(self._dirty))
+
+	def apply_delta(self, delta):
+		"""Apply replacements returned by delta()."""
+		for s, replacement in delta:
+			self[s] = replacement
+
 	def match_key(self):
 		return (StringReplacements,)
 
 	def dehacked_diffs(self, other=None):
-		other = other or {}
+		# Against the original, only strings in the journal can
+		# have been replaced.
+		if other is None:
+			keys = sorted(self._dirty)
+			other = {}
+		else:
+			keys = sorted(self)
 		result = []
-		for old, new in sorted(self.iteritems()):
+		for old in keys:
+			new = self[old]
 			# Both have the exact same replacement? No need
 			# to repeat it.
 			if other.get(old, old) == new:
@@ -154,14 +245,11 @@ class StringReplacements(object):
 
 		return result
 
-	def header_regexp(cls):
-	        return TEXT_HEADER_RE
+	def header_keyword(self):
+		return "Text"
 
-	def parse_section(self, stream, from_len, to_len):
-		from_len, to_len = int(from_len), int(to_len)
-		from_text = stream.read(from_len)
-		to_text = stream.read(to_len)
-		self[from_text] = to_text
+	def apply_event(self, event):
+		self[event.old] = event.new
 
 
 class StringList(object):
@@ -172,17 +260,45 @@ class StringList(object):
 	implemented, but nothing is actually stored; instead it is just a
 	facade that stores any changes to its contents as modifications stored
 	in a StringReplacements object.
+
+	The current values are mirrored in the list, along with a reverse
+	index from each value to the positions holding it, so lookups by
+	value don't need to scan the list. The StringReplacements object
+	tells the list whenever one of its strings is replaced, however
+	that happens (eg. by a "Text" replacement in a dehacked file).
 	"""
 	def __init__(self, string_repls, original):
 		self.string_repls = string_repls
 		self.original = original
+		# Positions in the list of each original string:
+		self._positions = {}
+		for i, s in enumerate(original):
+			self._positions.setdefault(s, []).append(i)
+		self._values = [string_repls[s] for s in original]
+		# Sorted positions in the list of each current value:
+		self._index = {}
+		for i, value in enumerate(self._values):
+			self._index.setdefault(value, []).append(i)
+		string_repls._watch(self, self._positions)
+
+	def _update(self, s):
+		value = self.string_repls[s]
+		for i in self._positions[s]:
+			old_value = self._values[i]
+			if old_value == value:
+				continue
+			self._values[i] = value
+			positions = self._index[old_value]
+			positions.remove(i)
+			if not positions:
+				del self._index[old_value]
+			bisect.insort(self._index.setdefault(value, []), i)
 
 	def __contains__(self, value):
-		return value in list(self)
+		return value in self._index
 
 	def __getitem__(self, index):
-		s = self.original[index]
-		return self.string_repls[s]
+		return self._values[index]
 
 	def __setitem__(self, index, newvalue):
 		s = self.original[index]
@@ -192,11 +308,10 @@ class StringList(object):
 		return len(self.original)
 
 	def __iter__(self):
-		for i in range(len(self)):
-			yield self[i]
+		return iter(list(self._values))
 
 	def __repr__(self):
-		return repr(list(self))
+		return repr(self._values)
 
 	def copy_from(self, strlist):
 		if len(self) != len(strlist):
@@ -207,13 +322,47 @@ class StringList(object):
 			self[i] = v
 
 	def index(self, value):
-		for i, v in enumerate(self):
-			if v == value:
-				return i
-		else:
+		try:
+			return self._index[value][0]
+		except KeyError:
 			raise ValueError("%r not found in list" % (
 				value))
 
+
+class TestStringList(unittest.TestCase):
+	def setUp(self):
+		self.repls = StringReplacements()
+		self.sprnames = self.repls.sprnames
+
+	def test_index(self):
+		self.assertEqual(self.sprnames.index("TROO"),
+		                 strings.sprnames.index("TROO"))
+		self.assertNotIn("ZZZZ", self.sprnames)
+		with self.assertRaises(ValueError):
+			self.sprnames.index("ZZZZ")
+
+	def test_writes(self):
+		troo = self.sprnames.index("TROO")
+		self.sprnames[troo] = "ZZZZ"
+		self.assertEqual(self.sprnames.index("ZZZZ"), troo)
+		self.assertNotIn("TROO", self.sprnames)
+		# Writes to the StringReplacements are seen too:
+		self.repls["ZZZZ"] = "YYYY"
+		self.repls["TROO"] = "POSS"
+		self.assertEqual(self.sprnames.index("POSS"),
+		                 strings.sprnames.index("POSS"))
+		self.assertEqual(list(self.sprnames)[troo], "POSS")
+		self.repls.reset_to_original()
+		self.assertEqual(self.sprnames.index("TROO"), troo)
+		self.assertEqual(list(self.sprnames), list(strings.sprnames))
+
+	def test_copy(self):
+		self.sprnames[0] = "ZZZZ"
+		repls = copy.copy(self.repls)
+		repls.sprnames[0] = "YYYY"
+		self.assertEqual(self.sprnames.index("ZZZZ"), 0)
+		self.assertEqual(repls.sprnames.index("YYYY"), 0)
+
 if __name__ == '__main__':
 	unittest.main()
 